@@ -1,6 +1,7 @@
 #ensure absolute import for python3
 from __future__ import absolute_import
 
+import json
 import os.path
 import logging
 from logging import DEBUG, Formatter, StreamHandler
@@ -8,10 +9,47 @@ from logging.config import dictConfig
 import sys
 
 from flask_sqlalchemy import SQLAlchemy
-from flask import Flask
-from flasgger import Swagger
+from sqlalchemy import orm
+from flask import Flask, Response
 
-db = SQLAlchemy()
+from aardvark import replica
+from aardvark.utils import sqlite_tuning
+
+
+class _SQLAlchemy(SQLAlchemy):
+    """
+    Turns on pool_pre_ping for pooled engines unless SQLALCHEMY_ENGINE_OPTIONS says otherwise,
+    applies SQLITE_PRAGMAS to SQLite connections (see aardvark.utils.sqlite_tuning), and
+    routes API reads to SQLALCHEMY_REPLICA_URI when it is set, see aardvark.replica.
+    """
+
+    # Carries the app's SQLite PRAGMAs from apply_driver_hacks, which sees the app, to create_engine.
+    _SQLITE_PRAGMAS_OPTION = '_aardvark_sqlite_pragmas'
+
+    def init_app(self, app):
+        replica.configure(app)
+        super(_SQLAlchemy, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=replica.RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super(_SQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            options[self._SQLITE_PRAGMAS_OPTION] = sqlite_tuning.pragmas(app.config)
+        else:
+            options.setdefault('pool_pre_ping', True)
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop(self._SQLITE_PRAGMAS_OPTION, None)
+        engine = super(_SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if pragmas:
+            sqlite_tuning.listen(engine, pragmas)
+        return engine
+
+
+db = _SQLAlchemy()
 
 from aardvark.view import mod as advisor_bp  # noqa
 
@@ -22,9 +60,13 @@ BLUEPRINTS = [
 API_VERSION = '1'
 
 
-def create_app():
+def create_app(api_docs=True):
+    """
+    Build the Aardvark app.
+
+    :param api_docs: serve the Swagger UI and spec if API_DOCS allows; the CLI builds its app without them
+    """
     app = Flask(__name__, static_url_path='/static')
-    Swagger(app)
 
     path = _find_config()
     if not path:
@@ -45,6 +87,21 @@ def create_app():
         """
         return 'ok'
 
+    @app.route('/metrics')
+    def metrics():
+        """Metrics
+        Prometheus text exposition of this worker's API metrics
+        ---
+        responses:
+          200:
+            description: metrics in the Prometheus text format
+        """
+        from aardvark.metrics import CONTENT_TYPE, REGISTRY
+        return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+    from aardvark.utils import fastjson
+    fastjson.select(app.config.get('JSON_BACKEND', 'auto'))
+
     # Blueprints
     for bp in BLUEPRINTS:
         app.register_blueprint(bp, url_prefix="/api/{0}".format(API_VERSION))
@@ -52,10 +109,40 @@ def create_app():
     # Extensions:
     db.init_app(app)
     setup_logging(app)
+    if api_docs:
+        init_api_docs(app)
 
     return app
 
 
+def init_api_docs(app):
+    """
+    Serve the Swagger UI and spec for the app's routes; flasgger is only imported when needed.
+
+    API_DOCS = False leaves the docs routes out. With API_SPEC_FILE, the spec is read from
+    that file (see ``aardvark api_spec``) instead of being generated from the view docstrings.
+    """
+    if not app.config.get('API_DOCS', True):
+        return
+
+    from flasgger import Swagger
+    swagger = Swagger()
+    spec_file = app.config.get('API_SPEC_FILE')
+    if spec_file:
+        with open(spec_file) as f:
+            spec = json.load(f)
+        swagger.get_apispecs = lambda endpoint='apispec_1': spec
+    swagger.init_app(app)
+
+
+def build_api_spec(app):
+    """Generate the Swagger spec for the app's routes from the view docstrings."""
+    from flasgger import Swagger
+    swagger = Swagger(app)
+    with app.test_request_context():
+        return swagger.get_apispecs()
+
+
 def _find_config():
     """Search for config.py in order of preference and return path if it exists, else None"""
     CONFIG_PATHS = [os.path.join(os.getcwd(), 'config.py'),
@@ -0,0 +1,388 @@
+"""
+ASGI serving mode for the advisor API.
+
+``aardvark start_async_api`` serves /api/1/advisors and /api/1/advisors/bulk from
+an asyncio event loop with an async database driver (aiosqlite for SQLite,
+asyncpg for PostgreSQL), so one process can keep many slow queries in flight
+instead of tying up a sync worker per request. Requests and responses are the
+same as the Flask API's. Everything else, including /advisors with as_of, is
+passed to the Flask app on a thread.
+
+Needs ``pip install aardvark[async]``.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import asyncio
+import datetime
+import json
+import time
+from urllib.parse import parse_qs
+
+from aardvark import create_app, metrics
+from aardvark.model import QUERY_CHUNK_SIZE
+from aardvark.utils import fastjson, sqlite_tuning
+from aardvark.utils.sqla_regex import SQLITE_REGEX_FUNCTIONS
+from aardvark.view import DEFAULT_BULK_LOOKUP_MAX_ARNS, combine_usage, query_shape
+
+
+__all__ = ['AsyncAPI', 'AsyncDatabase', 'create_asgi_app']
+
+DEFAULT_POOL_SIZE = 10
+
+# Reported as the endpoint label of REQUEST_SECONDS, matching the Flask endpoints.
+ENDPOINTS = {'advisors': 'advisor.rolesearch', 'bulk': 'advisor.bulklookup'}
+
+# The messages the Flask API returns for these cases.
+NOT_FOUND = ('404 Not Found: The requested URL was not found on the server. '
+             'If you entered the URL manually please check your spelling and try again.')
+BAD_REQUEST = '400 Bad Request: The browser (or proxy) sent a request that this server could not understand.'
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+class AsyncDatabase(object):
+    """
+    A small pool of async connections to the Aardvark database.
+
+    Queries are plain SQL with placeholders from `param`, since the pinned
+    SQLAlchemy has no asyncio support.
+    """
+
+    def __init__(self, uri, pool_size=DEFAULT_POOL_SIZE, sqlite_pragmas=()):
+        scheme, _, rest = uri.partition('://')
+        self.dialect = scheme.split('+')[0]
+        if self.dialect == 'sqlite':
+            self.path = rest[1:]
+            if not self.path or self.path == ':memory:':
+                raise ValueError('The async API needs a SQLite database file, not an in-memory database.')
+        elif self.dialect in ('postgresql', 'postgres'):
+            self.dialect = 'postgresql'
+            self.dsn = 'postgresql://' + rest
+        else:
+            raise ValueError('The async API supports SQLite and PostgreSQL, not {}.'.format(self.dialect))
+        self.pool_size = pool_size
+        self.sqlite_pragmas = sqlite_pragmas
+        self._pool = None
+        self._lock = None
+
+    async def _connect(self):
+        if self.dialect == 'sqlite':
+            import aiosqlite
+
+            pool = asyncio.Queue()
+            for _ in range(self.pool_size):
+                conn = await aiosqlite.connect(self.path)
+                for statement in sqlite_tuning.statements(self.sqlite_pragmas):
+                    await conn.execute(statement)
+                for name, function in SQLITE_REGEX_FUNCTIONS.values():
+                    await conn.create_function(name, 2, function)
+                pool.put_nowait(conn)
+            return pool
+
+        import asyncpg
+        return await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+
+    async def connect(self):
+        if self._pool is not None:
+            return
+        self._lock = self._lock or asyncio.Lock()
+        async with self._lock:
+            if self._pool is None:
+                self._pool = await self._connect()
+
+    async def close(self):
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        if self.dialect == 'sqlite':
+            while not pool.empty():
+                await pool.get_nowait().close()
+        else:
+            await pool.close()
+
+    async def fetch(self, sql, params=()):
+        """Run a query and return its rows as tuples."""
+        await self.connect()
+        if self.dialect == 'sqlite':
+            conn = await self._pool.get()
+            try:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchall()
+            finally:
+                self._pool.put_nowait(conn)
+
+        async with self._pool.acquire() as conn:
+            return [tuple(row) for row in await conn.fetch(sql, *params)]
+
+    def param(self, index):
+        """The placeholder for the index'th (from 1) parameter."""
+        return '?' if self.dialect == 'sqlite' else '${}'.format(index)
+
+    def params(self, count, start):
+        return ', '.join(self.param(start + i) for i in range(count))
+
+    def ilike(self, column, placeholder):
+        if self.dialect == 'sqlite':
+            return 'lower({}) LIKE lower({})'.format(column, placeholder)
+        return '{} ILIKE {}'.format(column, placeholder)
+
+    def regexp(self, column, placeholder):
+        if self.dialect == 'sqlite':
+            return '{}({}, {})'.format(SQLITE_REGEX_FUNCTIONS['~'][0], column, placeholder)
+        return '{} ~ {}'.format(column, placeholder)
+
+
+def _datetime(value):
+    """SQLite hands TIMESTAMP columns back as the strings SQLAlchemy stored."""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return value
+
+
+class AsyncAPI(object):
+    """The ASGI application."""
+
+    def __init__(self, app=None):
+        self.app = app or create_app()
+        # Reads the replica when there is one; REPLICA_MAX_LAG only applies to the Flask app.
+        uri = self.app.config.get('SQLALCHEMY_REPLICA_URI') or self.app.config['SQLALCHEMY_DATABASE_URI']
+        self.db = AsyncDatabase(uri, self.app.config.get('ASYNC_DB_POOL_SIZE', DEFAULT_POOL_SIZE),
+                                sqlite_tuning.pragmas(self.app.config))
+        self._wsgi = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+
+        routes = {'/api/1/advisors': self.advisors, '/api/1/advisors/bulk': self.bulk}
+        handler = routes.get(scope['path'].rstrip('/'))
+        allowed = ('GET', 'POST') if handler == self.advisors else ('POST',)
+        if scope['type'] != 'http' or handler is None or scope['method'] not in allowed:
+            return await self._to_wsgi(scope, receive, send)
+
+        body = await self._read_body(receive)
+        query = {key: values for key, values in parse_qs(scope['query_string'].decode('utf-8')).items()}
+        try:
+            payload = json.loads(body) if body else None
+        except ValueError:
+            payload = None
+
+        if handler == self.advisors and self._point_in_time(query, payload):
+            # Point in time queries read the history tables; leave them to the Flask API.
+            return await self._to_wsgi(scope, self._replay(body), send)
+
+        start = time.time()
+        try:
+            await handler(query, payload, send)
+        except HTTPError as e:
+            await self._send(send, e.status, fastjson.dumps({'message': e.message}) + '\n')
+        finally:
+            metrics.REQUEST_SECONDS.observe(time.time() - start, endpoint=ENDPOINTS[handler.__name__],
+                                            shape=query_shape(query, payload))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.db.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return body
+
+    @staticmethod
+    def _replay(body):
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        return receive
+
+    async def _to_wsgi(self, scope, receive, send):
+        if self._wsgi is None:
+            try:
+                from a2wsgi import WSGIMiddleware
+            except ImportError:
+                from uvicorn.middleware.wsgi import WSGIMiddleware
+            self._wsgi = WSGIMiddleware(self.app)
+        if scope.get('server'):
+            # WSGI wants SERVER_PORT as a string; werkzeug falls back to it without a Host header.
+            scope = dict(scope, server=(scope['server'][0], str(scope['server'][1])))
+        return await self._wsgi(scope, receive, send)
+
+    @staticmethod
+    async def _start(send, status):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json')]})
+
+    async def _send(self, send, status, body):
+        await self._start(send, status)
+        await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+    async def _documents(self, items):
+        """{item_id: document} for (id, arn, lastUpdated) rows, building any not stored (see PrincipalUsage)."""
+        db = self.db
+        ids = [item[0] for item in items]
+        documents = {}
+        for start in range(0, len(ids), QUERY_CHUNK_SIZE):
+            chunk = ids[start:start + QUERY_CHUNK_SIZE]
+            documents.update(await db.fetch('SELECT item_id, document FROM principal_usage WHERE item_id IN ({})'.format(
+                db.params(len(chunk), 1)), chunk))
+
+        missing = [item for item in items if item[0] not in documents]
+        if missing:
+            services = {row[0]: row[1:] for row in await db.fetch(
+                'SELECT id, "serviceName", "serviceNamespace" FROM advisor_service')}
+            encoder = fastjson.UsageEncoder(services)
+            usage = {}
+            for start in range(0, len(missing), QUERY_CHUNK_SIZE):
+                chunk = [item[0] for item in missing[start:start + QUERY_CHUNK_SIZE]]
+                for row in await db.fetch(
+                        'SELECT item_id, service_id, "lastAuthenticated", "lastAuthenticatedEntity", '
+                        '"totalAuthenticatedEntities" FROM advisor_data WHERE item_id IN ({})'.format(
+                            db.params(len(chunk), 1)), chunk):
+                    usage.setdefault(row[0], []).append(row[1:])
+            for item_id, _, last_updated in missing:
+                documents[item_id] = encoder.encode(usage.get(item_id, []), _datetime(last_updated))
+        return documents
+
+    @staticmethod
+    def _advisor_args(query, payload):
+        """RoleSearch's arguments from the query string and JSON body: (page, count, combine, phrase, regex, arns)."""
+        args = dict((key, values[-1]) for key, values in query.items())
+        args['arn'] = query.get('arn')
+        if isinstance(payload, dict):
+            args.update((key, value) for key, value in payload.items() if key != 'arn')
+            if 'arn' in payload:
+                arn = payload['arn']
+                args['arn'] = arn if isinstance(arn, list) else [arn]
+            if not all(isinstance(arn, str) for arn in args['arn'] or ()):
+                raise HTTPError(400, 'Expected "arn" to be an ARN or a list of ARNs.')
+            for key in ('phrase', 'regex'):
+                if not isinstance(args.get(key), (str, type(None))):
+                    raise HTTPError(400, 'Expected "{}" to be a string.'.format(key))
+
+        try:
+            page = int(args.get('page') or 1)
+            count = int(args.get('count') or 30)
+        except (TypeError, ValueError):
+            raise HTTPError(400, BAD_REQUEST)
+        if page < 1 or count < 0:
+            raise HTTPError(400, NOT_FOUND)
+        combine = str(args.get('combine') or 'false').lower() == 'true'
+        return page, count, combine, args.get('phrase'), args.get('regex'), args.get('arn')
+
+    @staticmethod
+    def _point_in_time(query, payload):
+        return 'as_of' in query or (isinstance(payload, dict) and 'as_of' in payload)
+
+    async def _search(self, phrase, regex, arns, page, count):
+        """Return one page of matching (id, arn, lastUpdated) rows and the total number matching."""
+        db = self.db
+        where, params = [], []
+        if phrase:
+            params.append('%' + phrase + '%')
+            where.append(db.ilike('arn', db.param(len(params))))
+        if arns:
+            where.append('lower(arn) IN ({})'.format(db.params(len(arns), len(params) + 1)))
+            params.extend(arn.lower() for arn in arns)
+        if regex:
+            params.append(regex)
+            where.append(db.regexp('arn', db.param(len(params))))
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+
+        try:
+            items = await db.fetch('SELECT id, arn, "lastUpdated" FROM aws_iam_object{} LIMIT {} OFFSET {}'.format(
+                where, db.param(len(params) + 1), db.param(len(params) + 2)), params + [count, (page - 1) * count])
+            if not items and page != 1:
+                raise HTTPError(400, NOT_FOUND)
+            total = (await db.fetch('SELECT count(*) FROM aws_iam_object' + where, params))[0][0]
+        except HTTPError:
+            raise
+        except Exception as e:
+            raise HTTPError(400, str(e))
+        return items, total
+
+    async def _send_combined(self, send, page, total, items, documents):
+        values = dict(page=page, total=total, count=len(items))
+        values.update((arn, json.loads(documents[item_id])) for item_id, arn, _ in items)
+        await self._send(send, 200, fastjson.dumps(combine_usage(values)) + '\n')
+
+    async def _send_page(self, send, page, total, items, documents):
+        body = ['"page": {}, "total": {}, "count": {}'.format(page, total, len(items))]
+        body.extend('{}: {}'.format(fastjson.dumps(arn), documents[item_id]) for item_id, arn, _ in items)
+        await self._send(send, 200, '{{{}}}\n'.format(', '.join(body)))
+
+    async def advisors(self, query, payload, send):
+        """GET/POST /api/1/advisors, as RoleSearch.post."""
+        page, count, combine, phrase, regex, arns = self._advisor_args(query, payload)
+        items, total = await self._search(phrase, regex, arns, page, count)
+        if combine and total > len(items):
+            raise HTTPError(400, "Error: Please specify a count of at least {}.".format(total))
+
+        documents = await self._documents(items)
+        if combine:
+            return await self._send_combined(send, page, total, items, documents)
+        await self._send_page(send, page, total, items, documents)
+
+    async def bulk(self, query, payload, send):
+        """POST /api/1/advisors/bulk, as BulkLookup.post."""
+        arns = payload.get('arns') if isinstance(payload, dict) else payload
+        if not isinstance(arns, list) or not all(isinstance(arn, str) for arn in arns):
+            raise HTTPError(400, 'Expected a JSON list of ARNs, or an object with an "arns" list.')
+        max_arns = self.app.config.get('BULK_LOOKUP_MAX_ARNS', DEFAULT_BULK_LOOKUP_MAX_ARNS)
+        if len(arns) > max_arns:
+            raise HTTPError(400, 'At most {} ARNs may be looked up per request, got {}.'.format(max_arns, len(arns)))
+
+        arns = list(dict.fromkeys(arns))
+        db = self.db
+        await self._start(send, 200)
+
+        async def write(text):
+            await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+        await write('{"results": {')
+        missing = []
+        first = True
+        for start in range(0, len(arns), QUERY_CHUNK_SIZE):
+            chunk = arns[start:start + QUERY_CHUNK_SIZE]
+            rows = await db.fetch('SELECT id, arn, "lastUpdated" FROM aws_iam_object WHERE arn IN ({})'.format(
+                db.params(len(chunk), 1)), chunk)
+            items = {row[1]: row for row in rows}
+            documents = await self._documents(rows)
+            parts = []
+            for arn in chunk:
+                if arn not in items:
+                    missing.append(arn)
+                    continue
+                parts.append('{}{}: {}'.format('' if first else ', ', fastjson.dumps(arn), documents[items[arn][0]]))
+                first = False
+            if parts:
+                await write(''.join(parts))
+        await send({'type': 'http.response.body',
+                    'body': '}}, "missing": {}}}\n'.format(fastjson.dumps(missing)).encode('utf-8')})
+
+
+def create_asgi_app():
+    """Factory for ASGI servers, e.g. ``uvicorn --factory aardvark.asgi:create_asgi_app``."""
+    return AsyncAPI()
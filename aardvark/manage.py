@@ -6,20 +6,24 @@ try:
     import queue as Queue  # Queue renamed to queue in py3
 except ModuleNotFoundError:
     import Queue
+import datetime
+import functools
+import json
 import re
+import signal
+import sys
 import threading
+import time
 
-import better_exceptions # noqa
 from blinker import Signal
-from bunch import Bunch
 from flask import current_app
 from flask_script import Manager, Command, Option
-from swag_client.backend import SWAGManager
-from swag_client.exceptions import InvalidSWAGDataException
-from swag_client.util import parse_swag_config_options
 
-from aardvark import create_app, db
-from aardvark.updater import AccountToUpdate
+from aardvark import build_api_spec, create_app, db, init_api_docs, metrics
+
+# boto3/cloudaux (through aardvark.updater and aardvark.scheduler), swag_client
+# (through aardvark.swag_snapshot), gunicorn and better_exceptions are imported
+# by the commands that use them, so every command doesn't pay for them at start-up.
 
 try:               # Python 2
     raw_input
@@ -31,7 +35,8 @@ try:               # Python 2
 except NameError:  # Python 3
     unicode = str
 
-manager = Manager(create_app)
+# The commands don't serve the API docs; start_api adds them to this same app.
+manager = Manager(functools.partial(create_app, api_docs=False))
 
 ACCOUNT_QUEUE = Queue.Queue()
 DB_LOCK = threading.Lock()
@@ -47,6 +52,9 @@ DEFAULT_LOCALDB_FILENAME = 'aardvark.db'
 DEFAULT_SWAG_BUCKET = 'swag-data'
 DEFAULT_AARDVARK_ROLE = 'Aardvark'
 DEFAULT_NUM_THREADS = 5  # testing shows problems with more than 6 threads
+DEFAULT_PRUNE_GRACE_DAYS = 7
+DEFAULT_PRUNE_BATCH_SIZE = 500
+DEFAULT_CHANGE_LOG_RETENTION_DAYS = 30
 
 
 class UpdateAccountThread(threading.Thread):
@@ -64,71 +72,196 @@ class UpdateAccountThread(threading.Thread):
         while not UPDATE_DONE:
             self.on_ready.send(self)
 
-            QUEUE_LOCK.acquire()
+            try:
+                (account_num, role_name, arns, account_run) = ACCOUNT_QUEUE.get(timeout=1)
+            except Queue.Empty:
+                continue
 
-            if not ACCOUNT_QUEUE.empty():
-                (account_num, role_name, arns) = ACCOUNT_QUEUE.get()
+            metrics.QUEUE_DEPTH.set(ACCOUNT_QUEUE.qsize())
+            try:
+                self._update(account_num, role_name, arns, account_run)
+            finally:
+                ACCOUNT_QUEUE.task_done()
 
-                self.app.logger.info("Thread #{} updating account {} with {} arns".format(
-                                     self.thread_ID, account_num, 'all' if arns[0] == 'all' else len(arns)))
+    def _update(self, account_num, role_name, arns, account_run):
+        self.app.logger.info("Thread #{} updating account {} with {} arns".format(
+                             self.thread_ID, account_num, 'all' if arns[0] == 'all' else len(arns)))
 
-                self.app.logger.debug(f"ACCOUNT_QUEUE depth now ~ {ACCOUNT_QUEUE.qsize()}")
+        self.app.logger.debug(f"ACCOUNT_QUEUE depth now ~ {ACCOUNT_QUEUE.qsize()}")
 
-                QUEUE_LOCK.release()
+        from aardvark.updater import AccountToUpdate
 
-                try:
-                    account = AccountToUpdate(self.app, account_num, role_name, arns)
-                    ret_code, aa_data = account.update_account()
-                except Exception as e:
-                    self.on_failure.send(self, error=e)
-                    self.app.logger.exception(f"Thread #{self.thread_ID} caught exception - {e} - while attempting to update account {account_num}. Continuing.")
-                    # Assume that whatever went wrong isn't transient; to avoid an
-                    # endless loop we don't put the account back on the queue.
-                    continue
+        start = time.time()
+        try:
+            account = AccountToUpdate(self.app, account_num, role_name, arns,
+                                      enumerated_arns=arns if account_run else None)
+            if account_run is None and self._split(account, start):
+                return
+            ret_code, aa_data = account.update_account()
+        except Exception as e:
+            metrics.ACCOUNTS.inc(status='failure')
+            self.on_failure.send(self, error=e)
+            self.app.logger.exception(f"Thread #{self.thread_ID} caught exception - {e} - while attempting to update account {account_num}. Continuing.")
+            # Assume that whatever went wrong isn't transient; to avoid an
+            # endless loop we don't put the account back on the queue.
+            if account_run:
+                account_run.chunk_done(success=False)
+            return
 
-                if ret_code != 0:  # retrieve wasn't successful, put back on queue
-                    self.on_failure.send(self)
-                    QUEUE_LOCK.acquire()
-                    ACCOUNT_QUEUE.put((account_num, role_name, arns))
-                    QUEUE_LOCK.release()
+        if ret_code != 0:  # retrieve wasn't successful, put back on queue
+            metrics.ACCOUNTS.inc(status='retry')
+            self.on_failure.send(self)
+            QUEUE_LOCK.acquire()
+            ACCOUNT_QUEUE.put((account_num, role_name, arns, account_run))
+            metrics.QUEUE_DEPTH.set(ACCOUNT_QUEUE.qsize())
+            QUEUE_LOCK.release()
+
+        self.app.logger.info("Thread #{} persisting data for account {}".format(self.thread_ID, account_num))
+
+        chunk_reported = False
+        with DB_LOCK:
+            try:
+                with metrics.PHASE_SECONDS.time(phase='persistence'):
+                    persist_aa_data(self.app, aa_data)
+                if ret_code == 0:
+                    if account_run is None and arns == ['all']:
+                        _mark_collected(self.app, account_num, time.time() - start, account.principal_count)
+                        _prune(self.app, account_num, account.enumerated_arns)
+                        _refresh_rollups(self.app, account_num)
+                    elif account_run is not None:
+                        chunk_reported = True
+                        # Account-level work waits for the last chunk, rather than repeating per chunk.
+                        if account_run.chunk_done():
+                            _mark_collected(self.app, account_num, time.time() - account_run.start,
+                                            account_run.principal_count)
+                            _prune(self.app, account_num, account_run.arns)
+                            _refresh_rollups(self.app, account_num)
+                    else:
+                        _refresh_rollups(self.app, account_num)
+            except Exception as e:
+                metrics.ACCOUNTS.inc(status='failure')
+                self.on_failure.send(self, error=e)
+                self.app.logger.exception(f"Thread #{self.thread_ID} caught exception - {e} - while persisting account {account_num}. Continuing.")
+                # A chunk put back on the queue above reports itself when it is retried.
+                if account_run and ret_code == 0 and not chunk_reported:
+                    account_run.chunk_done(success=False)
+                return
+
+        if ret_code == 0:
+            metrics.ACCOUNTS.inc(status='success')
+        self.on_complete.send(self)
+        self.app.logger.info("Thread #{} FINISHED persisting data for account {}".format(self.thread_ID, account_num))
+
+    def _split(self, account, start):
+        """
+        Queue an account larger than ACCOUNT_CHUNK_SIZE principals as chunks any thread can pick up.
+        Returns True if the account was split.
+        """
+        from aardvark.updater import AccountRun, chunked
+
+        chunk_size = self.app.config.get('ACCOUNT_CHUNK_SIZE')
+        if not chunk_size or account.arn_list != ['all']:
+            return False
+
+        arns = account.enumerate_arns()
+        chunks = chunked(arns, chunk_size)
+        if len(chunks) <= 1:
+            return False
+
+        self.app.logger.info("Thread #{} splitting account {} ({} arns) into {} chunks".format(
+                             self.thread_ID, account.account_number, len(arns), len(chunks)))
+        account_run = AccountRun(account.account_number, len(arns), len(chunks), start=start, arns=arns)
+        QUEUE_LOCK.acquire()
+        for chunk in chunks:
+            ACCOUNT_QUEUE.put((account.account_number, account.role_name, chunk, account_run))
+        metrics.QUEUE_DEPTH.set(ACCOUNT_QUEUE.qsize())
+        QUEUE_LOCK.release()
+        return True
+
+
+def persist_aa_data(app, aa_data, observed_at=None):
+    """
+    Persists access advisor data ({arn: [ServiceUsage, ...]}) to our database
+
+    Returns the rows written, as returned by AdvisorData.upsert_many. With USAGE_HISTORY
+    enabled they are also appended to the advisor_history table, stamped with observed_at
+    (epoch milliseconds, default now), after a baseline of the existing rows of principals that
+    have no history yet. Unless CHANGE_LOG is False they, and the principals and
+    services seen for the first time, are added to the change_log, and entries older than
+    CHANGE_LOG_RETENTION_DAYS (0 keeps them all) are expired. The principals' API documents
+    are rebuilt, as are those of every principal using a service AWS renamed. Account rollups
+    are left to _refresh_rollups, once the whole account is persisted.
+    """
+    from aardvark.model import (AWSIAMObject, AdvisorData, AdvisorHistory, ChangeLog, PrincipalUsage,
+                                ServiceCache)
 
-                self.app.logger.info("Thread #{} persisting data for account {}".format(self.thread_ID, account_num))
+    with app.app_context():
+        if not aa_data:
+            app.logger.warn('Cannot persist Access Advisor Data as no data was collected.')
+            return []
+
+        if app.config.get('USAGE_HISTORY'):
+            AdvisorHistory.append_baseline(AWSIAMObject.find_many(list(aa_data)), observed_at)
+
+        services = ServiceCache()
+        created = []
+        item_ids = AWSIAMObject.get_or_create_many(aa_data, created=created)
+        changes = AdvisorData.upsert_many({item_ids[arn]: data for arn, data in aa_data.items()}, services)
+        arns = {item_id: arn for arn, item_id in item_ids.items()}
+        if app.config.get('USAGE_HISTORY'):
+            AdvisorHistory.append(changes, arns, observed_at)
+        if app.config.get('CHANGE_LOG', True):
+            ChangeLog.append(changes, arns, created, services.created, observed_at)
+            retention_days = app.config.get('CHANGE_LOG_RETENTION_DAYS', DEFAULT_CHANGE_LOG_RETENTION_DAYS)
+            if retention_days:
+                ChangeLog.expire(retention_days, observed_at)
+        PrincipalUsage.refresh(list(item_ids.values()))
+        PrincipalUsage.refresh_services(services.renamed, skip=item_ids.values())
+        metrics.ROWS_UPSERTED.inc(sum(len(data) for data in aa_data.values()))
+        db.session.commit()
+        return changes
 
-                DB_LOCK.acquire()
-                persist_aa_data(self.app, aa_data)
-                DB_LOCK.release()
 
-                self.on_complete.send(self)
-                self.app.logger.info("Thread #{} FINISHED persisting data for account {}".format(self.thread_ID, account_num))
-            else:
-                QUEUE_LOCK.release()
+def _mark_collected(app, account_number, duration, principal_count):
+    from aardvark.model import AccountCollection
 
+    with app.app_context():
+        AccountCollection.mark_collected(account_number, duration=duration, principal_count=principal_count)
 
-def persist_aa_data(app, aa_data):
+
+def _prune(app, account_number, inventory):
     """
-    Reads access advisor JSON file & persists to our database
+    Delete the account's principals missing from its full inventory, unless PRUNE_PRINCIPALS is False.
+    Only principals not seen for PRUNE_GRACE_DAYS are deleted, so one incomplete listing can't drop
+    data that is still wanted.
     """
-    from aardvark.model import AWSIAMObject, AdvisorData
+    from aardvark.model import AWSIAMObject
+
+    if not app.config.get('PRUNE_PRINCIPALS', True):
+        return 0
 
+    grace = datetime.timedelta(days=app.config.get('PRUNE_GRACE_DAYS', DEFAULT_PRUNE_GRACE_DAYS))
     with app.app_context():
-        if not aa_data:
-            app.logger.warn('Cannot persist Access Advisor Data as no data was collected.')
-            return
+        pruned = AWSIAMObject.prune(account_number, inventory, datetime.datetime.utcnow() - grace,
+                                    batch_size=app.config.get('PRUNE_BATCH_SIZE', DEFAULT_PRUNE_BATCH_SIZE),
+                                    record_changes=app.config.get('CHANGE_LOG', True))
+        if pruned:
+            app.logger.info('Pruned {} principals no longer in account {}'.format(pruned, account_number))
+            metrics.PRINCIPALS_PRUNED.inc(pruned)
+        return pruned
 
-        arn_cache = {}
-        for arn, data in aa_data.items():
-            if arn in arn_cache:
-                item = arn_cache[arn]
-            else:
-                item = AWSIAMObject.get_or_create(arn)
-                arn_cache[arn] = item
-            for service in data:
-                AdvisorData.create_or_update(item.id,
-                                             service['LastAuthenticated'],
-                                             service['ServiceName'],
-                                             service['ServiceNamespace'],
-                                             service.get('LastAuthenticatedEntity'),
-                                             service['TotalAuthenticatedEntities'])
+
+def _refresh_rollups(app, account_number):
+    """
+    Rebuild the account's rollups, and the per-service ones, unless USAGE_ROLLUPS is False. Run once
+    an account's collection is persisted, and after pruning, since both rescan the whole account.
+    """
+    from aardvark.model import AccountServiceRollup
+
+    if not app.config.get('USAGE_ROLLUPS', True):
+        return
+    with app.app_context():
+        AccountServiceRollup.refresh({account_number})
         db.session.commit()
 
 
@@ -144,6 +277,65 @@ def create_db():
     db.create_all()
 
 
+@manager.command
+def upgrade_db():
+    """ Upgrades a database created by an earlier release to the current schema. """
+    from aardvark.migrations import upgrade
+
+    upgrade(db.engine, current_app.logger)
+
+
+@manager.option('-o', '--output', dest='output', type=unicode, default=None)
+def api_spec(output):
+    """
+    Writes the API's Swagger spec as JSON, to --output or stdout.
+
+    Point API_SPEC_FILE at the file to serve it instead of generating the spec
+    from the view docstrings in every API worker.
+    """
+    spec = json.dumps(build_api_spec(current_app._get_current_object()), indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(spec + '\n')
+    else:
+        print(spec)
+
+
+@manager.option('--accounts', dest='accounts', type=int, default=10)
+@manager.option('--principals', dest='principals', type=int, default=1000, help='principals per account')
+@manager.option('--namespaces', dest='namespaces', type=int, default=50, help='services per principal')
+@manager.option('--skew', dest='skew', type=float, default=1.0,
+                help='namespace popularity exponent; 0 marks every service used')
+@manager.option('--seed', dest='random_seed', type=int, default=0)
+@manager.option('--batch-size', dest='batch_size', type=int, default=1000)
+def seed(accounts, principals, namespaces, skew, random_seed, batch_size):
+    """
+    Fills the database with synthetic principals and usage, for load testing.
+
+    Writes accounts x principals x namespaces advisor_data rows through the
+    same path as a collection run (see aardvark/synthetic.py for the data's
+    shape), and marks each account collected. Accounts are numbered from
+    100000000000; seeding again with the same options rewrites the same rows.
+    """
+    from aardvark import synthetic
+
+    app = current_app._get_current_object()
+    start = time.time()
+    account_start, account_principals, rows = start, 0, 0
+    batches = synthetic.generate(accounts, principals, namespaces, skew=skew, seed=random_seed, batch_size=batch_size)
+    for account_number, aa_data in batches:
+        persist_aa_data(app, aa_data)
+        account_principals += len(aa_data)
+        rows += len(aa_data) * namespaces
+        if account_principals == principals:
+            _mark_collected(app, account_number, time.time() - account_start, principals)
+            _refresh_rollups(app, account_number)
+            app.logger.info('Seeded account {} ({} principals) in {:.1f}s'.format(
+                account_number, principals, time.time() - account_start))
+            account_start, account_principals = time.time(), 0
+    app.logger.info('Seeded {} advisor_data rows in {:.1f}s'.format(rows, time.time() - start))
+
+
 # All of these default to None rather than the corresponding DEFAULT_* values
 # so we can tell whether they were passed or not. We don't prompt for any of
 # the options that were passed as parameters.
@@ -270,15 +462,22 @@ def config(aardvark_role_param, bucket_param, db_uri_param, num_threads_param, n
 
 @manager.option('-a', '--accounts', dest='accounts', type=unicode, default='all')
 @manager.option('-r', '--arns', dest='arns', type=unicode, default='all')
-def update(accounts, arns):
+@manager.option('--metrics-file', dest='metrics_file', type=unicode, default=None)
+@manager.option('--pushgateway', dest='pushgateway', type=unicode, default=None)
+def update(accounts, arns, metrics_file=None, pushgateway=None):
     """
     Asks AWS for new Access Advisor information.
+
+    Run metrics are written to --metrics-file (or METRICS_TEXTFILE) in the
+    Prometheus textfile format and/or pushed to --pushgateway (or
+    METRICS_PUSHGATEWAY) once every account has been processed.
     """
     accounts = _prep_accounts(accounts)
     arns = arns.split(',')
-    app = create_app()
+    app = current_app._get_current_object()
 
     global ACCOUNT_QUEUE, QUEUE_LOCK, UPDATE_DONE
+    UPDATE_DONE = False
 
     role_name = app.config.get('ROLENAME')
     num_threads = app.config.get('NUM_THREADS') or 5
@@ -286,23 +485,101 @@ def update(accounts, arns):
     if num_threads > 6:
         current_app.logger.warn('Greater than 6 threads seems to cause problems')
 
+    # Start the accounts that took longest last time first so no single large
+    # account is left running alone at the end of the run.
+    from aardvark.model import AccountCollection
+    from aardvark.scheduler import longest_first
+    accounts, predicted_makespan = longest_first(accounts, AccountCollection.history(accounts), num_threads)
+
     QUEUE_LOCK.acquire()
     for account_number in accounts:
-        ACCOUNT_QUEUE.put((account_number, role_name, arns))
+        ACCOUNT_QUEUE.put((account_number, role_name, arns, None))
+    metrics.QUEUE_DEPTH.set(ACCOUNT_QUEUE.qsize())
     current_app.logger.debug(f"Starting update operation for {ACCOUNT_QUEUE.qsize()} accounts using {num_threads} threads.")
     QUEUE_LOCK.release()
 
+    start = time.time()
     threads = []
     for thread_num in range(num_threads):
         thread = UpdateAccountThread(thread_num + 1)
         thread.start()
         threads.append(thread)
 
-    while not ACCOUNT_QUEUE.empty():
-        pass
+    # Every queued item, including chunks queued by the threads themselves, is
+    # marked done once persisted, so join() returns when the run is complete.
+    ACCOUNT_QUEUE.join()
     UPDATE_DONE = True
     current_app.logger.debug("Queue is empty; no more accounts to process.")
 
+    # Let the threads see UPDATE_DONE and exit.
+    for thread in threads:
+        thread.join()
+
+    makespan = time.time() - start
+    metrics.MAKESPAN_SECONDS.set(makespan, kind='actual')
+    if predicted_makespan is not None:
+        metrics.MAKESPAN_SECONDS.set(predicted_makespan, kind='predicted')
+        current_app.logger.info('Updated {} accounts in {:.1f}s (predicted {:.1f}s)'.format(
+            len(accounts), makespan, predicted_makespan))
+    else:
+        current_app.logger.info('Updated {} accounts in {:.1f}s (no history to predict from)'.format(
+            len(accounts), makespan))
+
+    _export_metrics(app, metrics_file or app.config.get('METRICS_TEXTFILE'),
+                    pushgateway or app.config.get('METRICS_PUSHGATEWAY'))
+
+
+@manager.option('-a', '--accounts', dest='accounts', type=unicode, default='all')
+@manager.option('-r', '--arns', dest='arns', type=unicode, default='all')
+@manager.option('--daemon', dest='daemon', action='store_true', default=False)
+def collect(accounts, arns, daemon):
+    """
+    Refreshes accounts whose Access Advisor data is older than its SLA, stalest first.
+
+    Without --daemon every account that is currently due is refreshed once and
+    the command exits. With --daemon it keeps running, refreshing each account
+    as it becomes due. COLLECT_DEFAULT_SLA and COLLECT_ACCOUNT_SLA set how old
+    an account's data may get (seconds), and IAM_API_BUDGET caps IAM calls per
+    second across all workers.
+    """
+    from aardvark.scheduler import CollectorDaemon
+
+    app = current_app._get_current_object()
+    num_threads = app.config.get('NUM_THREADS') or DEFAULT_NUM_THREADS
+
+    def resolve_accounts():
+        with app.app_context():
+            return _prep_accounts(accounts)
+
+    collector = CollectorDaemon(app, resolve_accounts, persist_aa_data, app.config.get('ROLENAME'),
+                                arns.split(','), num_threads, daemon=daemon, prune=_prune,
+                                refresh_rollups=_refresh_rollups)
+
+    def handle_sigterm(signum, frame):
+        app.logger.info('Received signal {}; stopping after in-flight accounts finish.'.format(signum))
+        collector.stop()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        collector.run()
+    except KeyboardInterrupt:
+        collector.stop()
+
+
+def _export_metrics(app, metrics_file, pushgateway):
+    """Write and/or push the collector metrics; failures are logged, not raised."""
+    if metrics_file:
+        try:
+            metrics.REGISTRY.write_textfile(metrics_file)
+        except (IOError, OSError) as e:
+            app.logger.error('Could not write metrics to {}: {}'.format(metrics_file, e))
+
+    if pushgateway:
+        try:
+            metrics.REGISTRY.push(pushgateway, job=app.config.get('METRICS_JOB', 'aardvark'))
+        except Exception as e:
+            app.logger.error('Could not push metrics to {}: {}'.format(pushgateway, e))
+
 
 def _prep_accounts(account_names):
     """
@@ -323,41 +600,21 @@ def _prep_accounts(account_names):
     if not account_names:
         return matching_accounts
 
-    try:
-        current_app.logger.info('getting bucket {}'.format(
-                                current_app.config.get('SWAG_BUCKET')))
-
-        swag = SWAGManager(**parse_swag_config_options(current_app.config.get('SWAG_OPTS')))
+    from aardvark import swag_snapshot
 
-        all_accounts = swag.get_all(current_app.config.get('SWAG_FILTER'))
-
-        service_enabled_requirement = current_app.config.get('SWAG_SERVICE_ENABLED_REQUIREMENT', None)
-        if service_enabled_requirement:
-            all_accounts = swag.get_service_enabled(service_enabled_requirement, accounts_list=all_accounts)
-
-    except (KeyError, InvalidSWAGDataException, Exception) as e:
-        current_app.logger.error('Account names passed but SWAG not configured or unavailable: {}'.format(e))
+    current_app.logger.info('getting bucket {}'.format(current_app.config.get('SWAG_BUCKET')))
+    snapshot = swag_snapshot.load(current_app.config, current_app.logger, current_app.instance_path)
 
     if 'all' in account_names:
-        return [account['id'] for account in all_accounts]
-
-    lookup = {account['name']: Bunch(account) for account in all_accounts}
-
-    for account in all_accounts:
-        # get the right key, depending on whether we're using swag v1 or v2
-        alias_key = 'aliases' if account['schemaVersion'] == '2' else 'alias'
-        for alias in account[alias_key]:
-            lookup[alias] = Bunch(account)
+        return list(snapshot.accounts)
 
     for name in account_names:
-        if name not in lookup:
+        if name not in snapshot.index:
             current_app.logger.warn('Could not find an account named %s'
                                     % name)
             continue
 
-        account_number = lookup[name].get('id', None)
-        if account_number:
-            matching_accounts.append(account_number)
+        matching_accounts.append(snapshot.index[name])
 
     return matching_accounts
 
@@ -371,46 +628,57 @@ class GunicornServer(Command):
     For example:
     aardvark start_api -w 4 -b 127.0.0.0:8002
     Will start gunicorn with 4 workers bound to 127.0.0.0:8002
+    The app is preloaded and warmed up before the workers fork, see aardvark.serving.
     """
     description = 'Run the app within Gunicorn'
 
-    def get_options(self):
-        options = []
-        try:
-            from gunicorn.config import make_settings
-        except ImportError:
-            # Gunicorn does not yet support Windows.
-            # See issue #524. https://github.com/benoitc/gunicorn/issues/524
-            # For dev on Windows, make this an optional import.
-            print('Could not import gunicorn, skipping.')
-            return options
-
-        settings = make_settings()
-        for setting, klass in settings.items():
-            if klass.cli:
-                if klass.action:
-                    if klass.action == 'store_const':
-                        options.append(Option(*klass.cli, const=klass.const, action=klass.action))
-                    else:
-                        options.append(Option(*klass.cli, action=klass.action))
-                else:
-                    options.append(Option(*klass.cli))
-        return options
+    # gunicorn parses the command line itself (aardvark start_api --help lists
+    # its flags), so its settings are only imported when the command runs.
+    capture_all_args = True
+    help_args = ()
 
-    def run(self, *args, **kwargs):
-        from gunicorn.app.wsgiapp import WSGIApplication
+    def run(self, args):
+        from aardvark.serving import AardvarkApplication
 
-        app = WSGIApplication()
+        app = current_app._get_current_object()
+        init_api_docs(app)
+        return AardvarkApplication(app).run()
 
-        app.app_uri = 'aardvark:create_app()'
-        return app.run()
+
+class AsyncServer(Command):
+    """
+    Runs the async (ASGI) API, see aardvark.asgi, with uvicorn.
+    For example:
+    aardvark start_async_api -w 2 -b 0.0.0.0:5000
+    Will start uvicorn with 2 worker processes bound to 0.0.0.0:5000
+    """
+    description = 'Run the async API within uvicorn'
+
+    option_list = (
+        Option('-b', '--bind', dest='bind', default='127.0.0.1:8000'),
+        Option('-w', '--workers', dest='workers', type=int, default=1),
+    )
+
+    def run(self, bind, workers):
+        import uvicorn
+
+        host, _, port = bind.rpartition(':')
+        uvicorn.run('aardvark.asgi:create_asgi_app', factory=True, host=host or '127.0.0.1', port=int(port),
+                    workers=workers)
+
+
+def _excepthook(exc, value, tb):
+    """Print uncaught exceptions with better_exceptions, imported only when one happens."""
+    import better_exceptions
+    better_exceptions.excepthook(exc, value, tb)
 
 
 def main():
+    sys.excepthook = _excepthook
     manager.add_command("start_api", GunicornServer())
+    manager.add_command("start_async_api", AsyncServer())
     manager.run()
 
 
 if __name__ == '__main__':
-    manager.add_command("start_api", GunicornServer())
-    manager.run()
+    main()
@@ -0,0 +1,209 @@
+"""
+Minimal Prometheus-style metrics for the collector and the API.
+
+Metrics are process-local and rendered in the Prometheus text exposition format,
+either from the API's ``/metrics`` route or, for ``aardvark update``, written to a
+node_exporter textfile or pushed to a Pushgateway once the run finishes.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+PHASE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# WSGI environ key marking a request that isn't real traffic (e.g. warm-up) and must not be recorded.
+UNMETERED = 'aardvark.unmetered'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry(object):
+    """Holds metrics and renders them in registration order."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            for metric in self._metrics:
+                metric.reset()
+
+    def write_textfile(self, path):
+        """Atomically write the current values for node_exporter's textfile collector."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.aardvark-metrics')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp_path, path)
+
+    def push(self, gateway_url, job='aardvark'):
+        """Replace this job's metrics on a Prometheus Pushgateway."""
+        import requests
+
+        url = '{}/metrics/job/{}'.format(gateway_url.rstrip('/'), job)
+        response = requests.put(url, data=self.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+        response.raise_for_status()
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, *extra):
+        return _format_labels(list(zip(self.labelnames, key)) + list(extra))
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return ['{}{} {}'.format(self.name, self._labels(key), _format_value(value))
+                    for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=PHASE_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels)) or ([0], 0.0)
+        return counts[-1]
+
+    def sum(self, **labels):
+        _, total = self._values.get(self._key(labels)) or ([0], 0.0)
+        return total
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, self._labels(key, ('le', _format_value(bound))), _format_value(count)))
+                lines.append('{}_sum{} {}'.format(self.name, self._labels(key), _format_value(total)))
+                lines.append('{}_count{} {}'.format(self.name, self._labels(key), _format_value(counts[-1])))
+        return lines
+
+
+# Collector
+PHASE_SECONDS = Histogram('aardvark_collector_phase_seconds',
+                          'Time spent per account in each collection phase.', ['phase'])
+API_CALLS = Counter('aardvark_iam_api_calls_total', 'IAM API calls made, including retried attempts.',
+                    ['operation'])
+API_THROTTLES = Counter('aardvark_iam_throttles_total', 'IAM API calls rejected with a throttling error.',
+                        ['operation'])
+ACCOUNTS = Counter('aardvark_collector_accounts_total', 'Accounts processed by outcome.', ['status'])
+QUEUE_DEPTH = Gauge('aardvark_collector_queue_depth', 'Accounts waiting in the collector queue.')
+MAKESPAN_SECONDS = Gauge('aardvark_collector_makespan_seconds',
+                         'Predicted and actual wall time of the last update run.', ['kind'])
+ROWS_UPSERTED = Counter('aardvark_advisor_rows_upserted_total', 'Access Advisor rows written or checked.')
+PRINCIPALS_PRUNED = Counter('aardvark_principals_pruned_total',
+                            'Principals deleted because they no longer exist in their account.')
+
+# API
+REQUEST_SECONDS = Histogram('aardvark_api_request_seconds', 'API request latency by endpoint and query shape.',
+                            ['endpoint', 'shape'], buckets=REQUEST_BUCKETS)
+REPLICA_LAG_SECONDS = Gauge('aardvark_api_replica_lag_seconds',
+                            'How far the read replica trailed the primary when last checked.')
+REPLICA_FALLBACKS = Counter('aardvark_api_replica_fallbacks_total',
+                            'API requests sent to the primary because the read replica was too far behind.')
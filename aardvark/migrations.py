@@ -0,0 +1,219 @@
+"""
+Schema migrations for databases created by earlier releases.
+
+``aardvark create_db`` always builds the current schema. ``aardvark upgrade_db``
+brings an existing database up to date by running each step below in order and
+then creating any tables that are missing. Every step inspects the schema before
+changing it, so running the upgrade again is harmless.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+from aardvark import db
+
+
+MIGRATIONS = []
+
+
+def migration(f):
+    """Register a migration step. Steps return True when they changed the schema."""
+    MIGRATIONS.append(f)
+    return f
+
+
+def upgrade(engine, logger):
+    for step in MIGRATIONS:
+        with engine.begin() as conn:
+            if step(conn, sa.inspect(conn)):
+                logger.info('Applied migration {}'.format(step.__name__))
+    db.create_all()
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _column_names(inspector, table_name):
+    return {column['name'] for column in inspector.get_columns(table_name)}
+
+
+def _add_columns(conn, inspector, table):
+    """Add any of the table's model columns that the database is missing."""
+    if table.name not in inspector.get_table_names():
+        return False
+
+    existing = _column_names(inspector, table.name)
+    added = False
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            _quote(conn, table.name), _quote(conn, column.name), column.type.compile(dialect=conn.dialect)))
+        added = True
+    return added
+
+
+@migration
+def normalize_advisor_services(conn, inspector):
+    """
+    advisor_data.serviceName/serviceNamespace moved to advisor_service, referenced by service_id.
+    Rows without a serviceNamespace can't reference a service and are deleted.
+    """
+    from aardvark.model import AdvisorService
+
+    if 'advisor_data' not in inspector.get_table_names():
+        return False
+    if 'serviceNamespace' not in _column_names(inspector, 'advisor_data'):
+        return False
+
+    if conn.dialect.name == 'sqlite' and conn.dialect.dbapi.sqlite_version_info < (3, 35, 0):
+        raise RuntimeError('Upgrading advisor_data requires SQLite 3.35 or later for ALTER TABLE DROP COLUMN.')
+
+    def q(name):
+        return _quote(conn, name)
+
+    AdvisorService.__table__.create(conn, checkfirst=True)
+
+    conn.execute('DELETE FROM advisor_data WHERE {ns} IS NULL'.format(ns=q('serviceNamespace')))
+    conn.execute(
+        'INSERT INTO advisor_service ({ns}, {name}) '
+        'SELECT {ns}, MAX({name}) FROM advisor_data '
+        'WHERE {ns} NOT IN (SELECT {ns} FROM advisor_service) '
+        'GROUP BY {ns}'.format(ns=q('serviceNamespace'), name=q('serviceName')))
+
+    conn.execute('ALTER TABLE advisor_data ADD COLUMN service_id INTEGER REFERENCES advisor_service (id)')
+    conn.execute(
+        'UPDATE advisor_data SET service_id = '
+        '(SELECT id FROM advisor_service WHERE advisor_service.{ns} = advisor_data.{ns})'.format(
+            ns=q('serviceNamespace')))
+
+    for index in inspector.get_indexes('advisor_data'):
+        if set(index['column_names']) & {'serviceName', 'serviceNamespace'}:
+            conn.execute('DROP INDEX {}'.format(q(index['name'])))
+    for column in ('serviceName', 'serviceNamespace'):
+        conn.execute('ALTER TABLE advisor_data DROP COLUMN {}'.format(q(column)))
+    conn.execute('CREATE INDEX ix_advisor_data_service_id ON advisor_data (service_id)')
+    return True
+
+
+@migration
+def unique_advisor_data_service(conn, inspector):
+    """advisor_data allows one row per (item_id, service_id); duplicates keep the newest lastAuthenticated."""
+    if 'advisor_data' not in inspector.get_table_names():
+        return False
+    indexes = {index['name'] for index in inspector.get_indexes('advisor_data')}
+    if 'ix_advisor_data_item_service' in indexes:
+        return False
+
+    last = _quote(conn, 'lastAuthenticated')
+    conn.execute(
+        'DELETE FROM advisor_data WHERE EXISTS ('
+        'SELECT 1 FROM advisor_data newer '
+        'WHERE newer.item_id = advisor_data.item_id AND newer.service_id = advisor_data.service_id '
+        'AND (COALESCE(newer.{last}, 0) > COALESCE(advisor_data.{last}, 0) '
+        'OR (COALESCE(newer.{last}, 0) = COALESCE(advisor_data.{last}, 0) AND newer.id > advisor_data.id)))'.format(
+            last=last))
+
+    conn.execute('CREATE UNIQUE INDEX ix_advisor_data_item_service ON advisor_data (item_id, service_id)')
+    # The composite index covers lookups by item_id alone.
+    if 'ix_advisor_data_item_id' in indexes:
+        conn.execute('DROP INDEX ix_advisor_data_item_id')
+    return True
+
+
+@migration
+def add_aws_iam_object_account_number(conn, inspector):
+    """aws_iam_object gained an indexed accountNumber, filled in from each ARN."""
+    from aardvark.model import AWSIAMObject, account_number
+
+    table = AWSIAMObject.__table__
+    if not _add_columns(conn, inspector, table):
+        return False
+
+    rows = conn.execute(sa.select([table.c.id, table.c.arn]).where(table.c.accountNumber.is_(None))).fetchall()
+    if rows:
+        conn.execute(table.update().where(table.c.id == sa.bindparam('row_id')).values(
+            accountNumber=sa.bindparam('account_number')),
+            [{'row_id': row_id, 'account_number': account_number(arn or '')} for row_id, arn in rows])
+    for index in table.indexes:
+        if 'accountNumber' in index.columns.keys():
+            index.create(conn)
+    return True
+
+
+@migration
+def add_advisor_data_service_last_index(conn, inspector):
+    """advisor_data gained a covering (service_id, lastAuthenticated, item_id) index for unused-service queries."""
+    from aardvark.model import AdvisorData
+
+    if 'advisor_data' not in inspector.get_table_names():
+        return False
+    indexes = {index['name'] for index in inspector.get_indexes('advisor_data')}
+    if 'ix_advisor_data_service_last' in indexes:
+        return False
+
+    for index in AdvisorData.__table__.indexes:
+        if index.name == 'ix_advisor_data_service_last':
+            index.create(conn)
+    # The new index leads with service_id, so it replaces the single-column one.
+    if 'ix_advisor_data_service_id' in indexes:
+        conn.execute('DROP INDEX ix_advisor_data_service_id')
+    return True
+
+
+def _cascades(conn, inspector, table_name):
+    """Whether the table's item_id foreign key to aws_iam_object is ON DELETE CASCADE."""
+    if conn.dialect.name == 'sqlite':
+        # SQLAlchemy doesn't reflect ON DELETE for SQLite; the PRAGMA reports it.
+        rows = conn.execute('PRAGMA foreign_key_list({})'.format(_quote(conn, table_name))).fetchall()
+        return any(row[2] == 'aws_iam_object' and row[3] == 'item_id' and row[6] == 'CASCADE' for row in rows)
+    return any(fk['referred_table'] == 'aws_iam_object' and fk['constrained_columns'] == ['item_id'] and
+               (fk['options'].get('ondelete') or '').upper() == 'CASCADE'
+               for fk in inspector.get_foreign_keys(table_name))
+
+
+def _rebuild_sqlite_table(conn, inspector, table):
+    """
+    Recreate a SQLite table from its model, SQLite's only way to change a constraint. Rows the
+    model's foreign keys would reject, e.g. an item_id that no longer exists, are left behind.
+    """
+    def q(name):
+        return _quote(conn, name)
+
+    old_name = table.name + '_old'
+    for index in inspector.get_indexes(table.name):
+        conn.execute('DROP INDEX {}'.format(q(index['name'])))
+    conn.execute('ALTER TABLE {} RENAME TO {}'.format(q(table.name), q(old_name)))
+    table.create(conn)
+
+    columns = ', '.join(q(name) for name in table.columns.keys() if name in _column_names(inspector, old_name))
+    where = ' AND '.join(
+        '{} IN (SELECT {} FROM {})'.format(q(fk.parent.name), q(fk.column.name), q(fk.column.table.name))
+        for fk in sorted(table.foreign_keys, key=lambda fk: fk.parent.name)) or '1 = 1'
+    conn.execute('INSERT INTO {table} ({columns}) SELECT {columns} FROM {old} WHERE {where}'.format(
+        table=q(table.name), columns=columns, old=q(old_name), where=where))
+    conn.execute('DROP TABLE {}'.format(q(old_name)))
+
+
+@migration
+def cascade_principal_deletes(conn, inspector):
+    """advisor_data rows are deleted with their principal (ON DELETE CASCADE)."""
+    from aardvark.model import AdvisorData
+
+    table = AdvisorData.__table__
+    if table.name not in inspector.get_table_names() or _cascades(conn, inspector, table.name):
+        return False
+
+    if conn.dialect.name == 'sqlite':
+        _rebuild_sqlite_table(conn, inspector, table)
+    else:
+        for fk in inspector.get_foreign_keys(table.name):
+            if fk['referred_table'] == 'aws_iam_object' and fk['constrained_columns'] == ['item_id']:
+                conn.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(
+                    _quote(conn, table.name), _quote(conn, fk['name'])))
+        conn.execute('ALTER TABLE {} ADD FOREIGN KEY (item_id) REFERENCES aws_iam_object (id) '
+                     'ON DELETE CASCADE'.format(_quote(conn, table.name)))
+    return True
@@ -2,17 +2,58 @@
 from __future__ import absolute_import
 
 import datetime
+import time
 
 from flask import current_app
-from sqlalchemy import BigInteger, Column, Integer, Text, TIMESTAMP
-import sqlalchemy.exc
+import sqlalchemy as sa
+from sqlalchemy import BigInteger, Column, Float, Integer, Text, TIMESTAMP, bindparam
 from sqlalchemy.orm import relationship
-from sqlalchemy.schema import ForeignKey
+from sqlalchemy.schema import ForeignKey, Index
 
 from aardvark import db
 from aardvark.utils.sqla_regex import String
 
 
+# Upper bound on the values bound into a single IN (...) clause.
+QUERY_CHUNK_SIZE = 500
+
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+def account_number(arn):
+    """Return the account number in an IAM ARN (arn:aws:iam::123456789012:role/name), or None."""
+    parts = arn.split(':', 5)
+    return parts[4] if len(parts) == 6 else None
+
+
+def _epoch_ms(dt):
+    return int((dt - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def usage_entry(services, service_id, lastAuthenticated, lastAuthenticatedEntity, totalAuthenticatedEntities,
+                lastUpdated):
+    """
+    Build one principal's API entry for a service.
+
+    :param services: {id: (serviceName, serviceNamespace)} as returned by AdvisorService.lookup
+    """
+    service_name, service_namespace = services[service_id]
+    return dict(
+        lastAuthenticated=lastAuthenticated,
+        serviceName=service_name,
+        serviceNamespace=service_namespace,
+        lastAuthenticatedEntity=lastAuthenticatedEntity,
+        totalAuthenticatedEntities=totalAuthenticatedEntities,
+        lastUpdated=lastUpdated
+    )
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), QUERY_CHUNK_SIZE):
+        yield values[start:start + QUERY_CHUNK_SIZE]
+
+
 class AWSIAMObject(db.Model):
     """
     Meant to model AWS IAM Object Access Advisor.
@@ -20,32 +61,130 @@ class AWSIAMObject(db.Model):
     __tablename__ = "aws_iam_object"
     id = Column(Integer, primary_key=True)
     arn = Column(String(2048), nullable=True, index=True, unique=True)
+    accountNumber = Column(String(32), index=True)
     lastUpdated = Column(TIMESTAMP)
+    # Deleting a principal leaves its advisor_data and principal_usage rows to the
+    # database's ON DELETE CASCADE rather than loading them into the session first.
     usage = relationship("AdvisorData", backref="item", cascade="all, delete, delete-orphan",
-                         foreign_keys="AdvisorData.item_id")
+                         foreign_keys="AdvisorData.item_id", passive_deletes=True)
 
     @staticmethod
-    def get_or_create(arn):
-        item = AWSIAMObject.query.filter(AWSIAMObject.arn == arn).scalar()
+    def find_many(arns):
+        """Return (id, arn, lastUpdated) for each of the ARNs that exists, using chunked IN queries."""
+        found = []
+        for chunk in _chunks(arns):
+            found.extend(db.session.query(AWSIAMObject.id, AWSIAMObject.arn, AWSIAMObject.lastUpdated).filter(
+                AWSIAMObject.arn.in_(chunk)))
+        return found
 
-        added = False
-        try:
-            item = AWSIAMObject.query.filter(AWSIAMObject.arn == arn).scalar()
-        except sqlalchemy.exc.SQLAlchemyException as e:
-            current_app.logger.error('Database exception: {}'.format(e.message))
+    @staticmethod
+    def get_or_create_many(arns, created=None):
+        """
+        Mark every ARN as updated, creating the principals that don't exist yet, a chunk of
+        ARNs per query.
 
-        if not item:
-            item = AWSIAMObject(arn=arn, lastUpdated=datetime.datetime.utcnow())
-            added = True
-        else:
-            item.lastUpdated = datetime.datetime.utcnow()
-        db.session.add(item)
+        :param created: optional list the ids of the newly created principals are appended to
+        :return: {arn: id}
+        """
+        now = datetime.datetime.utcnow()
+        ids = {}
+        for chunk in _chunks(set(arns)):
+            ids.update(db.session.query(AWSIAMObject.arn, AWSIAMObject.id).filter(AWSIAMObject.arn.in_(chunk)))
+
+        for chunk in _chunks(ids.values()):
+            AWSIAMObject.query.filter(AWSIAMObject.id.in_(chunk)).update({'lastUpdated': now},
+                                                                         synchronize_session=False)
+
+        missing = [arn for arn in set(arns) if arn not in ids]
+        if missing:
+            db.session.execute(AWSIAMObject.__table__.insert(), [
+                {'arn': arn, 'accountNumber': account_number(arn), 'lastUpdated': now} for arn in missing])
+            for chunk in _chunks(missing):
+                ids.update(db.session.query(AWSIAMObject.arn, AWSIAMObject.id).filter(AWSIAMObject.arn.in_(chunk)))
+            if created is not None:
+                created.extend(ids[arn] for arn in missing)
+        return ids
 
-        # we only need a refresh if the object was created
-        if added:
+    @staticmethod
+    def prune(account_number, inventory, updated_before, batch_size=QUERY_CHUNK_SIZE, record_changes=False):
+        """
+        Delete the account's principals that are missing from its inventory and weren't
+        updated since updated_before, batch_size at a time, committing after each batch.
+        Their advisor_data and principal_usage rows go with them through ON DELETE CASCADE;
+        their advisor_history is kept.
+
+        :param inventory: every ARN the account currently has, as listed by AccountToUpdate
+        :param record_changes: add each deletion to the change_log, in the same transaction
+        :return: the number of principals deleted
+        """
+        inventory = set(inventory)
+        if not inventory:
+            # An empty listing is far more likely a failed enumeration than an empty account.
+            return 0
+
+        rows = db.session.query(AWSIAMObject.id, AWSIAMObject.arn).filter(
+            AWSIAMObject.accountNumber == account_number).filter(
+            sa.or_(AWSIAMObject.lastUpdated.is_(None), AWSIAMObject.lastUpdated < updated_before))
+        stale = [(item_id, arn) for item_id, arn in rows if arn not in inventory]
+
+        table = AWSIAMObject.__table__
+        for start in range(0, len(stale), batch_size):
+            batch = stale[start:start + batch_size]
+            db.session.execute(table.delete().where(table.c.id.in_([item_id for item_id, _ in batch])))
+            if record_changes:
+                ChangeLog.append_deletions(batch)
             db.session.commit()
-            db.session.refresh(item)
-        return item
+        return len(stale)
+
+
+class AdvisorService(db.Model):
+    """
+    The services Access Advisor reports on, stored once and referenced by AdvisorData.service_id.
+    """
+    __tablename__ = "advisor_service"
+    id = Column(Integer, primary_key=True)
+    serviceName = Column(String(128))
+    serviceNamespace = Column(String(64), nullable=False, unique=True)
+
+    @staticmethod
+    def lookup():
+        """Return {id: (serviceName, serviceNamespace)} for every known service."""
+        query = db.session.query(AdvisorService.id, AdvisorService.serviceName, AdvisorService.serviceNamespace)
+        return {service_id: (name, namespace) for service_id, name, namespace in query}
+
+
+class ServiceCache(object):
+    """
+    Maps service namespaces to AdvisorService ids for one persistence pass,
+    adding services the first time they are seen.
+    """
+
+    def __init__(self):
+        self._services = {namespace: (service_id, name) for service_id, (name, namespace)
+                          in AdvisorService.lookup().items()}
+        # (id, serviceNamespace, serviceName) of the services added through this cache, in the order they were added.
+        self.created = []
+        # Ids of the services renamed through this cache.
+        self.renamed = set()
+
+    def id_for(self, serviceNamespace, serviceName):
+        serviceNamespace = serviceNamespace[:64]
+        serviceName = serviceName[:128]
+        known = self._services.get(serviceNamespace)
+
+        if not known:
+            service = AdvisorService(serviceNamespace=serviceNamespace, serviceName=serviceName)
+            db.session.add(service)
+            db.session.flush()
+            known = self._services[serviceNamespace] = (service.id, serviceName)
+            self.created.append((service.id, serviceNamespace, serviceName))
+        elif known[1] != serviceName:
+            # AWS occasionally renames a service; keep the most recent name.
+            AdvisorService.query.filter(AdvisorService.id == known[0]).update({'serviceName': serviceName})
+            known = self._services[serviceNamespace] = (known[0], serviceName)
+            self.renamed.add(known[0])
+
+        return known[0]
 
 
 class AdvisorData(db.Model):
@@ -61,61 +200,577 @@ class AdvisorData(db.Model):
     }
     """
     __tablename__ = "advisor_data"
+    __table_args__ = (
+        # One row per principal and service; also serves lookups by item_id alone.
+        Index("ix_advisor_data_item_service", "item_id", "service_id", unique=True),
+        # Covers "which principals haven't used this service since ..." without touching the table.
+        Index("ix_advisor_data_service_last", "service_id", "lastAuthenticated", "item_id"),
+    )
     id = Column(Integer, primary_key=True)
-    item_id = Column(Integer, ForeignKey("aws_iam_object.id"), nullable=False, index=True)
+    item_id = Column(Integer, ForeignKey("aws_iam_object.id", ondelete="CASCADE"), nullable=False)
+    service_id = Column(Integer, ForeignKey("advisor_service.id"), nullable=False)
     lastAuthenticated = Column(BigInteger)
-    serviceName = Column(String(128), index=True)
-    serviceNamespace = Column(String(64), index=True)
     lastAuthenticatedEntity = Column(Text)
     totalAuthenticatedEntities = Column(Integer)
+    service = relationship("AdvisorService")
 
     @staticmethod
-    def create_or_update(item_id, lastAuthenticated, serviceName, serviceNamespace, lastAuthenticatedEntity,
-                         totalAuthenticatedEntities):
-        serviceName = serviceName[:128]
-        serviceNamespace = serviceNamespace[:64]
-        item = None
-        try:
-            item = AdvisorData.query.filter(AdvisorData.item_id == item_id).filter(AdvisorData.serviceNamespace ==
-                                                                                   serviceNamespace).scalar()
-        except sqlalchemy.exc.SQLAlchemyError as e:
-            current_app.logger.error('Database error: {} item_id: {} serviceNamespace: {}'.format(e.args[0], item_id,
-                                     serviceNamespace)) #exception.messsage not supported in py3 e.args[0] replacement
+    def upsert_many(usage_by_item, services):
+        """
+        Insert or update the advisor_data rows of many principals.
 
-        if not item:
-            item = AdvisorData(item_id=item_id,
-                               lastAuthenticated=lastAuthenticated,
-                               serviceName=serviceName,
-                               serviceNamespace=serviceNamespace,
-                               lastAuthenticatedEntity=lastAuthenticatedEntity,
-                               totalAuthenticatedEntities=totalAuthenticatedEntities)
-            db.session.add(item)
+        lastAuthenticated only moves forward, except to 0: Access Advisor omits the timestamp for a
+        service not accessed in the past 365 days (or for an entity too new to have data yet), and
+        AccountToUpdate records that as 0. A row that had a timestamp is then set to 0; any other
+        older timestamp is out of order and logged rather than written.
+
+        Existing rows are read with one indexed query per chunk of principals, then new rows are
+        inserted and changed rows updated with one executemany each.
+
+        :param usage_by_item: {item_id: [ServiceUsage, ...]}
+        :param services: ServiceCache used to resolve namespaces to AdvisorService ids
+        :return: [(item_id, service_id, previous lastAuthenticated or None for a new row, ServiceUsage), ...]
+                 for every row written
+        """
+        existing = {}
+        for chunk in _chunks(usage_by_item):
+            query = db.session.query(AdvisorData.item_id, AdvisorData.service_id, AdvisorData.id,
+                                     AdvisorData.lastAuthenticated).filter(AdvisorData.item_id.in_(chunk))
+            for item_id, service_id, row_id, lastAuthenticated in query:
+                existing[(item_id, service_id)] = (row_id, lastAuthenticated or 0)
+
+        inserts = []
+        updates = []
+        changes = []
+        for item_id, usage in usage_by_item.items():
+            for service in usage:
+                service_id = services.id_for(service.namespace, service.name)
+                lastAuthenticated = service.last_authenticated
+                row_id, previous = existing.get((item_id, service_id), (None, None))
+
+                if previous is None:
+                    inserts.append(dict(item_id=item_id,
+                                        service_id=service_id,
+                                        lastAuthenticated=lastAuthenticated,
+                                        lastAuthenticatedEntity=service.last_authenticated_entity,
+                                        totalAuthenticatedEntities=service.total_authenticated_entities))
+                    existing[(item_id, service_id)] = (None, lastAuthenticated)
+                    changes.append((item_id, service_id, None, service))
+                    continue
+
+                # row_id is None for a service repeated within this batch; the first entry wins.
+                if row_id is None or lastAuthenticated == previous:
+                    continue
+
+                if lastAuthenticated < previous:
+                    # 0 means no access in the past 365 days; anything else is out of order.
+                    if lastAuthenticated != 0:
+                        current_app.logger.error("Received an older time than previously seen for object {} service {} "
+                                                 "({la} < {ila})!".format(item_id, service.name, la=lastAuthenticated,
+                                                                          ila=previous))
+                        continue
+                    current_app.logger.warn('Previously seen object not accessed in the past 365 days '
+                                            '(got null lastAuthenticated from AA). Setting to 0. '
+                                            'Object {} service {} previous timestamp {}'.format(item_id, service.name,
+                                                                                                previous))
+
+                updates.append({'row_id': row_id, 'last_authenticated': lastAuthenticated})
+                changes.append((item_id, service_id, previous, service))
+
+        table = AdvisorData.__table__
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        if updates:
+            db.session.execute(table.update().where(table.c.id == bindparam('row_id')).values(
+                lastAuthenticated=bindparam('last_authenticated')), updates)
+        return changes
+
+    @staticmethod
+    def for_items(item_ids):
+        """
+        Return {item_id: [(service_id, lastAuthenticated, lastAuthenticatedEntity, totalAuthenticatedEntities), ...]}
+        read straight from the table, without building ORM objects.
+        """
+        usage = {}
+        for chunk in _chunks(item_ids):
+            query = db.session.query(AdvisorData.item_id, AdvisorData.service_id, AdvisorData.lastAuthenticated,
+                                     AdvisorData.lastAuthenticatedEntity,
+                                     AdvisorData.totalAuthenticatedEntities).filter(AdvisorData.item_id.in_(chunk))
+            for row in query:
+                usage.setdefault(row[0], []).append(row[1:])
+        return usage
+
+    @staticmethod
+    def unused(cutoff, account_numbers=None, namespaces=None, arns=None, after=None, limit=None):
+        """
+        Return (item_id, service_id, arn, serviceName, serviceNamespace, lastAuthenticated) for every entry
+        not used since `cutoff` (epoch milliseconds), ordered by (item_id, service_id). Entries never used
+        have lastAuthenticated 0.
+
+        Pages are keyed on the last (item_id, service_id) returned, passed as `after`, so a page walks
+        ix_advisor_data_item_service from there and costs the same however deep it is, with or without
+        filters.
+        """
+        query = db.session.query(AdvisorData.item_id, AdvisorData.service_id, AWSIAMObject.arn,
+                                 AdvisorService.serviceName, AdvisorService.serviceNamespace,
+                                 AdvisorData.lastAuthenticated).select_from(AdvisorData).join(
+            AdvisorService, AdvisorData.service_id == AdvisorService.id).join(
+            AWSIAMObject, AdvisorData.item_id == AWSIAMObject.id).filter(
+            AdvisorData.lastAuthenticated < cutoff)
+
+        if namespaces:
+            query = query.filter(AdvisorService.serviceNamespace.in_(namespaces))
+        if account_numbers:
+            query = query.filter(AWSIAMObject.accountNumber.in_(account_numbers))
+        if arns:
+            query = query.filter(AWSIAMObject.arn.in_(arns))
+        if after is not None:
+            item_id, service_id = after
+            query = query.filter(sa.or_(AdvisorData.item_id > item_id,
+                                        sa.and_(AdvisorData.item_id == item_id, AdvisorData.service_id > service_id)))
+
+        query = query.order_by(AdvisorData.item_id, AdvisorData.service_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+
+class AdvisorHistory(db.Model):
+    """
+    Append-only record of how each principal's lastAuthenticated changed over time.
+
+    Written by persist_aa_data when USAGE_HISTORY is enabled: one row per (principal, service)
+    whose Access Advisor data changed in a collection run, stamped with the run's time, after a
+    baseline of the principal's existing rows the first time it is collected with history on.
+    Rows carry the principal's ARN and outlive it: pruning a principal keeps its history, and
+    as_of looks principals up by ARN, so a principal deleted and later re-created (possibly with
+    its old id) sees one continuous history.
+    Rows are bucketed by observedDay (days since the epoch); on PostgreSQL the table is
+    range-partitioned by month on that column, so old history can be dropped a partition at a time.
+    """
+    __tablename__ = "advisor_history"
+    __table_args__ = (
+        Index("ix_advisor_history_observedDay", "observedDay"),
+        Index("ix_advisor_history_arn", "arn", "observedAt"),
+        {"postgresql_partition_by": 'RANGE ("observedDay")'},
+    )
+    # Not a foreign key: the history of deleted principals is kept.
+    item_id = Column(Integer, primary_key=True, autoincrement=False)
+    service_id = Column(Integer, ForeignKey("advisor_service.id"), primary_key=True, autoincrement=False)
+    observedAt = Column(BigInteger, primary_key=True, autoincrement=False)
+    observedDay = Column(Integer, primary_key=True, autoincrement=False)
+    lastAuthenticated = Column(BigInteger)
+    lastAuthenticatedEntity = Column(Text)
+    totalAuthenticatedEntities = Column(Integer)
+    arn = Column(String(2048))
+
+    @staticmethod
+    def _ensure_partition(observedDay):
+        """Create the month's partition on PostgreSQL; other databases keep one date-bucketed table."""
+        if db.engine.dialect.name != 'postgresql':
+            return
+        day = datetime.date(1970, 1, 1) + datetime.timedelta(days=observedDay)
+        start = day.replace(day=1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        epoch = datetime.date(1970, 1, 1)
+        db.session.execute(
+            'CREATE TABLE IF NOT EXISTS advisor_history_{:%Y%m} PARTITION OF advisor_history '
+            'FOR VALUES FROM ({}) TO ({})'.format(start, (start - epoch).days, (end - epoch).days))
+
+    @staticmethod
+    def append(changes, arns, observed_at=None):
+        """
+        :param changes: rows written by AdvisorData.upsert_many
+        :param arns: {item_id: arn} for the principals in changes
+        :param observed_at: epoch milliseconds of the collection run, defaults to now
+        """
+        if not changes:
+            return
+        observedAt = int(observed_at if observed_at is not None else time.time() * 1000)
+        observedDay = observedAt // MILLISECONDS_PER_DAY
+        AdvisorHistory._ensure_partition(observedDay)
+        db.session.execute(AdvisorHistory.__table__.insert(), [
+            dict(item_id=item_id,
+                 service_id=service_id,
+                 observedAt=observedAt,
+                 observedDay=observedDay,
+                 lastAuthenticated=service.last_authenticated,
+                 lastAuthenticatedEntity=service.last_authenticated_entity,
+                 totalAuthenticatedEntities=service.total_authenticated_entities,
+                 arn=arns[item_id])
+            for item_id, service_id, _, service in changes])
+
+    @staticmethod
+    def append_baseline(principals, observed_at=None):
+        """
+        Record the current advisor_data of principals with no history yet, stamped with when they were
+        last collected. Without it, enabling USAGE_HISTORY on an existing database would leave as_of
+        blind to every service whose usage hasn't changed since.
+
+        :param principals: (id, arn, lastUpdated) of existing principals, as returned by AWSIAMObject.find_many
+        :param observed_at: epoch milliseconds of the run about to be appended; the baseline precedes it
+        :return: the number of rows recorded
+        """
+        observedAt = int(observed_at if observed_at is not None else time.time() * 1000)
+        last_updated = {item_id: lastUpdated for item_id, _, lastUpdated in principals}
+        item_ids = {arn: item_id for item_id, arn, _ in principals}
+        arns = {item_id: arn for arn, item_id in item_ids.items()}
+        rows = []
+        for chunk in _chunks(list(item_ids)):
+            with_history = {arn for arn, in db.session.query(AdvisorHistory.arn).filter(
+                AdvisorHistory.arn.in_(chunk)).distinct()}
+            missing = [item_ids[arn] for arn in chunk if arn not in with_history]
+            if not missing:
+                continue
+            query = db.session.query(AdvisorData.item_id, AdvisorData.service_id, AdvisorData.lastAuthenticated,
+                                     AdvisorData.lastAuthenticatedEntity, AdvisorData.totalAuthenticatedEntities
+                                     ).filter(AdvisorData.item_id.in_(missing))
+            for item_id, service_id, lastAuthenticated, entity, total in query:
+                collected = last_updated[item_id]
+                stamp = min(_epoch_ms(collected), observedAt - 1) if collected else observedAt - 1
+                rows.append(dict(item_id=item_id, service_id=service_id, observedAt=stamp,
+                                 observedDay=stamp // MILLISECONDS_PER_DAY, lastAuthenticated=lastAuthenticated,
+                                 lastAuthenticatedEntity=entity, totalAuthenticatedEntities=total,
+                                 arn=arns[item_id]))
+
+        for observedDay in {row['observedDay'] for row in rows}:
+            AdvisorHistory._ensure_partition(observedDay)
+        if rows:
+            db.session.execute(AdvisorHistory.__table__.insert(), rows)
+        return len(rows)
+
+    @staticmethod
+    def as_of(arns, as_of):
+        """
+        Return {arn: [AdvisorHistory, ...]} holding each principal's latest row per service
+        observed at or before `as_of` (epoch milliseconds).
+        """
+        history = {}
+        for chunk in _chunks(arns):
+            latest = db.session.query(
+                AdvisorHistory.arn, AdvisorHistory.service_id,
+                sa.func.max(AdvisorHistory.observedAt).label('observedAt')
+            ).filter(AdvisorHistory.arn.in_(chunk), AdvisorHistory.observedAt <= as_of).group_by(
+                AdvisorHistory.arn, AdvisorHistory.service_id).subquery()
+            query = AdvisorHistory.query.join(latest, sa.and_(
+                AdvisorHistory.arn == latest.c.arn,
+                AdvisorHistory.service_id == latest.c.service_id,
+                AdvisorHistory.observedAt == latest.c.observedAt))
+            for row in query:
+                history.setdefault(row.arn, []).append(row)
+        return history
+
+
+class ChangeLog(db.Model):
+    """
+    Feed of what each collection changed, for consumers syncing incrementally.
+
+    Written by persist_aa_data unless CHANGE_LOG is False: a row for each new principal
+    (PRINCIPAL_ADDED) and each new service namespace (SERVICE_ADDED), and one per
+    (principal, service) whose lastAuthenticated moved (USAGE_CHANGED), including new rows
+    (previous is NULL) and the drop to 0 after a year without access. Pruned principals are
+    recorded as PRINCIPAL_DELETED. Every entry carries the ARN and service namespace and name
+    it describes, so it reads the same after the principal is deleted or its id reused.
+
+    seq only grows (AUTOINCREMENT on SQLite, so it is never reused), and consumers page
+    through the feed with seq > their last seen value. Persistence is serialized within a
+    process; with several processes writing one PostgreSQL database, a lower seq may commit
+    after a higher one has been read. Entries older than CHANGE_LOG_RETENTION_DAYS are
+    expired as new ones are written; a consumer whose last seen seq is older than that has
+    missed entries and must resync.
+    """
+    __tablename__ = "change_log"
+    __table_args__ = (
+        Index("ix_change_log_observedAt", "observedAt"),
+        {"sqlite_autoincrement": True},
+    )
+    seq = Column(Integer, primary_key=True)
+    kind = Column(String(16), nullable=False)
+    observedAt = Column(BigInteger, nullable=False)
+    # No foreign keys: entries outlive the principals they describe.
+    item_id = Column(Integer)
+    service_id = Column(Integer)
+    previous = Column(BigInteger)
+    lastAuthenticated = Column(BigInteger)
+    arn = Column(String(2048))
+    serviceNamespace = Column(String(64))
+    serviceName = Column(String(128))
+
+    PRINCIPAL_ADDED = 'principal'
+    SERVICE_ADDED = 'service'
+    USAGE_CHANGED = 'usage'
+    PRINCIPAL_DELETED = 'deleted'
+
+    @staticmethod
+    def _entry(kind, observedAt, item_id=None, service_id=None, previous=None, lastAuthenticated=None, arn=None,
+               serviceNamespace=None, serviceName=None):
+        # Every entry lists every column so executemany sends them as one statement.
+        return dict(kind=kind, observedAt=observedAt, item_id=item_id, service_id=service_id, previous=previous,
+                    lastAuthenticated=lastAuthenticated, arn=arn, serviceNamespace=serviceNamespace,
+                    serviceName=serviceName)
+
+    @staticmethod
+    def append(changes, arns, created_items=(), created_services=(), observed_at=None):
+        """
+        :param changes: rows written by AdvisorData.upsert_many
+        :param arns: {item_id: arn} for the principals in changes and created_items
+        :param created_items: ids of the principals created by this run
+        :param created_services: (id, serviceNamespace, serviceName) of the services created by this run,
+            as in ServiceCache.created
+        :param observed_at: epoch milliseconds of the collection run, defaults to now
+        """
+        observedAt = int(observed_at if observed_at is not None else time.time() * 1000)
+        entries = [ChangeLog._entry(ChangeLog.SERVICE_ADDED, observedAt, service_id=service_id,
+                                    serviceNamespace=namespace, serviceName=name)
+                   for service_id, namespace, name in created_services]
+        entries.extend(ChangeLog._entry(ChangeLog.PRINCIPAL_ADDED, observedAt, item_id=item_id, arn=arns[item_id])
+                       for item_id in created_items)
+        entries.extend(ChangeLog._entry(ChangeLog.USAGE_CHANGED, observedAt, item_id=item_id, service_id=service_id,
+                                        previous=previous, lastAuthenticated=service.last_authenticated,
+                                        arn=arns[item_id], serviceNamespace=service.namespace[:64],
+                                        serviceName=service.name[:128])
+                       for item_id, service_id, previous, service in changes)
+        if entries:
+            db.session.execute(ChangeLog.__table__.insert(), entries)
+
+    @staticmethod
+    def append_deletions(principals, observed_at=None):
+        """
+        :param principals: [(item_id, arn), ...] of deleted principals
+        """
+        observedAt = int(observed_at if observed_at is not None else time.time() * 1000)
+        if principals:
+            db.session.execute(ChangeLog.__table__.insert(), [
+                ChangeLog._entry(ChangeLog.PRINCIPAL_DELETED, observedAt, item_id=item_id, arn=arn)
+                for item_id, arn in principals])
+
+    @staticmethod
+    def expire(retention_days, observed_at=None):
+        """
+        Delete the entries observed more than retention_days before observed_at.
+
+        :param observed_at: epoch milliseconds of the collection run, defaults to now
+        :return: the number of entries deleted
+        """
+        observedAt = int(observed_at if observed_at is not None else time.time() * 1000)
+        expired = ChangeLog.query.filter(ChangeLog.observedAt < observedAt - retention_days * MILLISECONDS_PER_DAY)
+        return expired.delete(synchronize_session=False)
+
+    @staticmethod
+    def oldest():
+        """Return the seq of the oldest entry kept, or None if the feed is empty."""
+        return db.session.query(sa.func.min(ChangeLog.seq)).scalar()
+
+    @staticmethod
+    def since(seq, limit):
+        """
+        Return up to `limit` entries after `seq`, oldest first. Reads walk the primary key from
+        `seq`, so each page costs the same however long the feed is.
+        """
+        return ChangeLog.query.filter(ChangeLog.seq > seq).order_by(ChangeLog.seq).limit(limit).all()
+
+
+class PrincipalUsage(db.Model):
+    """
+    Each principal's /advisors entry, serialized to JSON ahead of time.
+
+    persist_aa_data rebuilds the documents of the principals it writes, and of every principal
+    using a service it renamed, so API lookups are a primary key fetch per principal with no
+    per-row work.
+    """
+    __tablename__ = "principal_usage"
+    item_id = Column(Integer, ForeignKey("aws_iam_object.id", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    document = Column(Text)
+
+    @staticmethod
+    def build(item_ids):
+        """Return {item_id: document} built from the current advisor_data rows."""
+        from aardvark.utils.fastjson import UsageEncoder
+
+        encoder = UsageEncoder(AdvisorService.lookup())
+        usage = AdvisorData.for_items(item_ids)
+        documents = {}
+        for chunk in _chunks(item_ids):
+            query = db.session.query(AWSIAMObject.id, AWSIAMObject.lastUpdated).filter(AWSIAMObject.id.in_(chunk))
+            for item_id, lastUpdated in query:
+                documents[item_id] = encoder.encode(usage.get(item_id, []), lastUpdated)
+        return documents
+
+    @staticmethod
+    def refresh(item_ids):
+        """Rebuild the documents for these principals."""
+        documents = PrincipalUsage.build(item_ids)
+        for chunk in _chunks(item_ids):
+            PrincipalUsage.query.filter(PrincipalUsage.item_id.in_(chunk)).delete(synchronize_session=False)
+        if documents:
+            db.session.execute(PrincipalUsage.__table__.insert(), [
+                {'item_id': item_id, 'document': document} for item_id, document in documents.items()])
+
+    @staticmethod
+    def refresh_services(service_ids, skip=()):
+        """
+        Rebuild the documents of every principal with an entry for these services, e.g. after they
+        were renamed, a chunk of principals at a time.
+
+        :param skip: ids of principals whose documents are already current
+        """
+        if not service_ids:
             return
+        item_ids = {item_id for item_id, in db.session.query(AdvisorData.item_id).filter(
+            AdvisorData.service_id.in_(list(service_ids))).distinct()}
+        for chunk in _chunks(item_ids.difference(skip)):
+            PrincipalUsage.refresh(chunk)
+
+    @staticmethod
+    def documents(item_ids):
+        """
+        Return {item_id: document} for these principals, building any that are missing
+        (e.g. principals last collected before the read model existed).
+        """
+        documents = {}
+        for chunk in _chunks(item_ids):
+            documents.update(db.session.query(PrincipalUsage.item_id, PrincipalUsage.document).filter(
+                PrincipalUsage.item_id.in_(chunk)))
+        missing = [item_id for item_id in item_ids if item_id not in documents]
+        if missing:
+            documents.update(PrincipalUsage.build(missing))
+        return documents
+
+
+# Rollup columns counting principals that used a service within this many days.
+ROLLUP_WINDOWS = (('used30Days', 30), ('used90Days', 90))
 
-        if lastAuthenticated > item.lastAuthenticated:
-            item.lastAuthenticated = lastAuthenticated
-            db.session.add(item)
-
-        elif lastAuthenticated < item.lastAuthenticated:
-            """
-            lastAuthenticated is obtained by calling get_service_last_accessed_details() method of the boto3 iam client.
-            When there is no AA data about a service, the lastAuthenticated key is missing from the returned dictionary.
-            This is perfectly valid, either because the service in question was not accessed in the past 365 days or
-            the entity granting  access to it was created recently enough that no AA data is available yet (it can take up to
-            4 hours for this to happen).
-            When this happens, the AccountToUpdate._get_job_results() method will set lastAuthenticated to 0.
-            Usually we don't want to persist such an entity, with one exception: there's already a recorded, non-zero lastAuthenticated
-            timestamp persisted for this item. That means the service was accessed at some point in time, but now more than 365 passed since
-            the last access, so AA no longer returns a timestamp for it.
-            """
-            if lastAuthenticated == 0:
-                current_app.logger.warn('Previously seen object not accessed in the past 365 days '
-                                        '(got null lastAuthenticated from AA). Setting to 0. '
-                                        'Object {} service {} previous timestamp {}'.format(item.item_id, item.serviceName, item.lastAuthenticated))
-                item.lastAuthenticated = 0
-                db.session.add(item)
-            else:
-                current_app.logger.error("Received an older time than previously seen for object {} service {} ({la} < {ila})!".format(item.item_id,
-                                                                                                                                       item.serviceName,
-                                                                                                                                       la=lastAuthenticated,
-                                                                                                                                       ila=item.lastAuthenticated))
+
+class AccountServiceRollup(db.Model):
+    """
+    Access Advisor data summarized per account and service.
+
+    Rebuilt once per collected account, after it is persisted. usedCount counts principals
+    with any recorded access (Access Advisor reports the past 365 days); the windowed
+    counts are relative to refreshedAt.
+    """
+    __tablename__ = "account_service_rollup"
+    accountNumber = Column(String(32), primary_key=True)
+    service_id = Column(Integer, ForeignKey("advisor_service.id"), primary_key=True, autoincrement=False)
+    principalCount = Column(Integer)
+    usedCount = Column(Integer)
+    used90Days = Column(Integer)
+    used30Days = Column(Integer)
+    lastAuthenticated = Column(BigInteger)
+    refreshedAt = Column(TIMESTAMP)
+
+    @staticmethod
+    def refresh(account_numbers, now=None):
+        """Recompute the rollup rows for these accounts, then the per-service rollup."""
+        now = now or datetime.datetime.utcnow()
+        now_ms = _epoch_ms(now)
+
+        columns = [
+            AWSIAMObject.accountNumber,
+            AdvisorData.service_id,
+            sa.func.count(),
+            sa.func.sum(sa.case([(AdvisorData.lastAuthenticated > 0, 1)], else_=0)),
+        ]
+        for _, days in ROLLUP_WINDOWS:
+            cutoff = now_ms - days * MILLISECONDS_PER_DAY
+            columns.append(sa.func.sum(sa.case([(AdvisorData.lastAuthenticated > cutoff, 1)], else_=0)))
+        columns.append(sa.func.max(AdvisorData.lastAuthenticated))
+
+        table = AccountServiceRollup.__table__
+        for chunk in _chunks(account_numbers):
+            rows = db.session.query(*columns).join(AWSIAMObject, AdvisorData.item_id == AWSIAMObject.id).filter(
+                AWSIAMObject.accountNumber.in_(chunk)).group_by(AWSIAMObject.accountNumber, AdvisorData.service_id)
+            values = []
+            for row in rows:
+                value = dict(accountNumber=row[0], service_id=row[1], principalCount=row[2], usedCount=row[3],
+                             lastAuthenticated=row[-1], refreshedAt=now)
+                value.update((name, count) for (name, _), count in zip(ROLLUP_WINDOWS, row[4:-1]))
+                values.append(value)
+
+            AccountServiceRollup.query.filter(AccountServiceRollup.accountNumber.in_(chunk)).delete(
+                synchronize_session=False)
+            if values:
+                db.session.execute(table.insert(), values)
+
+        ServiceRollup.refresh(now)
+
+
+class ServiceRollup(db.Model):
+    """
+    Access Advisor data summarized per service across all accounts, built from AccountServiceRollup.
+    """
+    __tablename__ = "service_rollup"
+    service_id = Column(Integer, ForeignKey("advisor_service.id"), primary_key=True, autoincrement=False)
+    accountCount = Column(Integer)
+    usedAccountCount = Column(Integer)
+    principalCount = Column(Integer)
+    usedCount = Column(Integer)
+    used90Days = Column(Integer)
+    used30Days = Column(Integer)
+    lastAuthenticated = Column(BigInteger)
+    refreshedAt = Column(TIMESTAMP)
+
+    @staticmethod
+    def refresh(now=None):
+        now = now or datetime.datetime.utcnow()
+        rollup = AccountServiceRollup
+        columns = [
+            rollup.service_id,
+            sa.func.count(),
+            sa.func.sum(sa.case([(rollup.usedCount > 0, 1)], else_=0)),
+            sa.func.sum(rollup.principalCount),
+            sa.func.sum(rollup.usedCount),
+        ] + [sa.func.sum(getattr(rollup, name)) for name, _ in ROLLUP_WINDOWS] + [
+            sa.func.max(rollup.lastAuthenticated),
+        ]
+
+        values = []
+        for row in db.session.query(*columns).group_by(rollup.service_id):
+            value = dict(service_id=row[0], accountCount=row[1], usedAccountCount=row[2], principalCount=row[3],
+                         usedCount=row[4], lastAuthenticated=row[-1], refreshedAt=now)
+            value.update((name, count) for (name, _), count in zip(ROLLUP_WINDOWS, row[5:-1]))
+            values.append(value)
+
+        ServiceRollup.query.delete(synchronize_session=False)
+        if values:
+            db.session.execute(ServiceRollup.__table__.insert(), values)
+
+
+class AccountCollection(db.Model):
+    """
+    Tracks when each account's Access Advisor data was last collected in full.
+    """
+    __tablename__ = "account_collection"
+    accountNumber = Column(String(32), primary_key=True)
+    lastCollected = Column(TIMESTAMP)
+    lastDuration = Column(Float)
+    principalCount = Column(Integer)
+
+    @staticmethod
+    def mark_collected(account_number, collected_at=None, duration=None, principal_count=None):
+        item = AccountCollection.query.get(account_number)
+        if not item:
+            item = AccountCollection(accountNumber=account_number)
+        item.lastCollected = collected_at or datetime.datetime.utcnow()
+        if duration is not None:
+            item.lastDuration = duration
+        if principal_count is not None:
+            item.principalCount = principal_count
+        db.session.add(item)
+        db.session.commit()
+
+    @staticmethod
+    def history(account_numbers=None):
+        """Return {account_number: (lastDuration, principalCount)} for the given (or all) accounts."""
+        query = AccountCollection.query
+        if account_numbers is not None:
+            query = query.filter(AccountCollection.accountNumber.in_(list(account_numbers)))
+        return {item.accountNumber: (item.lastDuration, item.principalCount) for item in query}
+
+    @staticmethod
+    def last_collected(account_numbers=None):
+        """Return {account_number: lastCollected} for the given (or all) accounts."""
+        query = AccountCollection.query
+        if account_numbers is not None:
+            query = query.filter(AccountCollection.accountNumber.in_(list(account_numbers)))
+        return {item.accountNumber: item.lastCollected for item in query}
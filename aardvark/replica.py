@@ -0,0 +1,131 @@
+"""
+Read replica routing for the API.
+
+With SQLALCHEMY_REPLICA_URI set, API requests read from that database while
+persist_aa_data and every other write keep using SQLALCHEMY_DATABASE_URI, so a
+collection run's write bursts don't slow the API down. The replica is an
+ordinary Flask-SQLAlchemy bind (REPLICA_BIND), pooled and configured like the
+primary engine.
+
+With REPLICA_MAX_LAG (seconds) set, the replica is only used while it is at
+most that far behind the primary: the newest AWSIAMObject.lastUpdated is
+compared on both every REPLICA_LAG_CHECK_INTERVAL seconds (default 10), and
+requests go to the primary while the replica is further behind or can't be
+reached. Without it the replica is always used.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import threading
+import time
+
+from flask_sqlalchemy import SignallingSession, get_state
+import sqlalchemy as sa
+import sqlalchemy.exc
+
+from aardvark import metrics
+
+
+REPLICA_BIND = 'replica'
+DEFAULT_LAG_CHECK_INTERVAL = 10
+
+
+def configure(app):
+    """Register SQLALCHEMY_REPLICA_URI, if set, as the replica bind."""
+    uri = app.config.get('SQLALCHEMY_REPLICA_URI')
+    if uri:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[REPLICA_BIND] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def enabled(app):
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends its queries to the replica once use_replica() marks it.
+    Flushes always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get(REPLICA_BIND) and not self._flushing:
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class LagCheck(object):
+    """Caches, per app, whether the replica is fresh enough to read from."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def fresh(self, app, db):
+        max_lag = app.config.get('REPLICA_MAX_LAG')
+        if max_lag is None:
+            return True
+
+        interval = app.config.get('REPLICA_LAG_CHECK_INTERVAL', DEFAULT_LAG_CHECK_INTERVAL)
+        with self._lock:
+            checked_at, fresh = self._checked.get(id(app), (None, None))
+            if checked_at is not None and time.time() - checked_at < interval:
+                return fresh
+
+            lag = self.lag(app, db)
+            fresh = lag is not None and lag <= max_lag
+            self._checked[id(app)] = (time.time(), fresh)
+        if not fresh:
+            app.logger.warning('Read replica is {}; reading from the primary'.format(
+                'unavailable' if lag is None else '{:.0f}s behind'.format(lag)))
+        return fresh
+
+    @staticmethod
+    def lag(app, db):
+        """Seconds the replica's newest principal update trails the primary's, or None if it can't be read."""
+        from aardvark.model import AWSIAMObject
+
+        query = sa.select([sa.func.max(AWSIAMObject.lastUpdated)])
+        primary = db.get_engine(app).execute(query).scalar()
+        try:
+            replica = db.get_engine(app, bind=REPLICA_BIND).execute(query).scalar()
+        except sa.exc.SQLAlchemyError as e:
+            app.logger.warning('Could not check the read replica: {}'.format(e))
+            return None
+        if primary is None:
+            lag = 0.0
+        elif replica is None:
+            lag = None
+        else:
+            lag = max(0.0, (primary - replica).total_seconds())
+        if lag is not None:
+            metrics.REPLICA_LAG_SECONDS.set(lag)
+        return lag
+
+    def reset(self):
+        with self._lock:
+            self._checked.clear()
+
+
+LAG_CHECK = LagCheck()
+
+
+def use_replica(app, db):
+    """
+    Send the session's queries to the replica, if one is configured and fresh enough,
+    until release() is called. Returns True if it will be used.
+    """
+    if not enabled(app):
+        return False
+    if not LAG_CHECK.fresh(app, db):
+        metrics.REPLICA_FALLBACKS.inc()
+        return False
+    db.session().info[REPLICA_BIND] = True
+    return True
+
+
+def release(db):
+    """Send the session's queries back to the primary."""
+    db.session().info.pop(REPLICA_BIND, None)
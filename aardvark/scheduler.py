@@ -0,0 +1,301 @@
+"""
+Staleness-priority scheduling for the long-running collector.
+
+Accounts are kept in an earliest-deadline-first heap keyed on when their data
+exceeds its SLA. Worker threads take the most overdue account, refresh it and
+put it back due one SLA later, so refreshes spread out over time instead of
+all landing at a cron boundary. The IAM_API_BUDGET token bucket applied in
+AccountToUpdate keeps the overall call rate even while a backlog drains.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import calendar
+import heapq
+import itertools
+import threading
+import time
+
+from aardvark import metrics
+from aardvark.updater import AccountToUpdate
+
+
+DEFAULT_SLA = 24 * 60 * 60
+DEFAULT_RETRY_DELAY = 15 * 60
+DEFAULT_ACCOUNT_REFRESH = 60 * 60
+
+
+def longest_first(accounts, history, num_workers):
+    """
+    Order accounts so the longest collections start first and predict the makespan.
+
+    An account's expected duration is its last recorded duration, or else its
+    principal count times the median seconds per principal across accounts.
+    Accounts with no history are assumed to be as long as the longest known one.
+    The predicted makespan comes from assigning each account, in order, to the
+    least loaded of num_workers workers, which is what the worker pool does.
+
+    :param history: {account_number: (lastDuration, principalCount)}
+    :return: (ordered account numbers, predicted makespan in seconds or None)
+    """
+    rates = sorted(duration / principals for duration, principals in history.values() if duration and principals)
+    rate = rates[len(rates) // 2] if rates else None
+
+    estimates = {}
+    for account_number in accounts:
+        duration, principals = history.get(account_number, (None, None))
+        if duration is None and principals and rate:
+            duration = principals * rate
+        estimates[account_number] = duration
+
+    known = [duration for duration in estimates.values() if duration is not None]
+    if not known:
+        return list(accounts), None
+
+    longest = max(known)
+    for account_number, duration in estimates.items():
+        if duration is None:
+            estimates[account_number] = longest
+
+    ordered = sorted(accounts, key=lambda account_number: estimates[account_number], reverse=True)
+    loads = [0.0] * max(num_workers, 1)
+    for account_number in ordered:
+        heapq.heapreplace(loads, loads[0] + estimates[account_number])
+    return ordered, max(loads)
+
+
+def _epoch(timestamp):
+    """Convert a naive UTC datetime to epoch seconds, treating None as never collected."""
+    if timestamp is None:
+        return 0
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+class StalenessScheduler(object):
+    """
+    Earliest-deadline-first queue of accounts.
+
+    :param default_sla: seconds an account's data may age before it is due
+    :param account_slas: optional {account_number: seconds} overrides
+    """
+
+    def __init__(self, default_sla=DEFAULT_SLA, account_slas=None):
+        self.default_sla = default_sla
+        self.account_slas = account_slas or {}
+        self._heap = []
+        self._entries = {}
+        self._in_flight = set()
+        self._counter = itertools.count()
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def sla(self, account_number):
+        return self.account_slas.get(account_number, self.default_sla)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries) + len(self._in_flight)
+
+    def _push(self, account_number, due_at):
+        entry = [due_at, next(self._counter), account_number]
+        self._entries[account_number] = entry
+        heapq.heappush(self._heap, entry)
+        metrics.QUEUE_DEPTH.set(len(self._entries))
+        self._cond.notify_all()
+
+    def add(self, account_number, last_collected=None):
+        """Schedule an account due one SLA after it was last collected (immediately, if never)."""
+        with self._cond:
+            if account_number in self._entries or account_number in self._in_flight:
+                return
+            self._push(account_number, _epoch(last_collected) + self.sla(account_number))
+
+    def remove(self, account_number):
+        with self._cond:
+            entry = self._entries.pop(account_number, None)
+            if entry:
+                entry[-1] = None  # lazily dropped when it reaches the top of the heap
+            self._in_flight.discard(account_number)
+
+    def accounts(self):
+        with self._cond:
+            return set(self._entries) | self._in_flight
+
+    def _peek(self):
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def next(self, block=True):
+        """
+        Return the most overdue account, marking it in flight.
+
+        Blocks until an account is due unless block is False, in which case
+        None is returned when nothing is due yet. Returns None once stopped.
+        """
+        with self._cond:
+            while not self._stopped:
+                entry = self._peek()
+                now = time.time()
+                if entry and entry[0] <= now:
+                    heapq.heappop(self._heap)
+                    account_number = entry[-1]
+                    del self._entries[account_number]
+                    self._in_flight.add(account_number)
+                    metrics.QUEUE_DEPTH.set(len(self._entries))
+                    return account_number
+                if not block:
+                    return None
+                self._cond.wait(entry[0] - now if entry else None)
+            return None
+
+    def done(self, account_number, collected_at=None):
+        """Reschedule a refreshed account one SLA from now."""
+        with self._cond:
+            if account_number in self._in_flight:
+                self._in_flight.discard(account_number)
+                self._push(account_number, (collected_at or time.time()) + self.sla(account_number))
+
+    def failed(self, account_number, retry_delay=DEFAULT_RETRY_DELAY):
+        with self._cond:
+            if account_number in self._in_flight:
+                self._in_flight.discard(account_number)
+                self._push(account_number, time.time() + retry_delay)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+class CollectorDaemon(object):
+    """
+    Continuously refreshes the stalest accounts with a pool of worker threads.
+
+    :param app: Flask app providing configuration and the database
+    :param resolve_accounts: callable returning the account numbers to keep fresh;
+        called again every COLLECT_ACCOUNT_REFRESH seconds to pick up new accounts
+    :param persist: callable(app, aa_data) persisting an account's results
+    :param daemon: keep running; otherwise exit once nothing is due
+    :param prune: callable(app, account_number, arns) deleting the principals missing from an
+        account's full inventory, called after each full collection
+    :param refresh_rollups: callable(app, account_number) rebuilding the account's rollups, called
+        after each persisted collection (and prune)
+    """
+
+    def __init__(self, app, resolve_accounts, persist, role_name, arns, num_threads, daemon=True, prune=None,
+                 refresh_rollups=None):
+        self.app = app
+        self.resolve_accounts = resolve_accounts
+        self.persist = persist
+        self.prune = prune
+        self.refresh_rollups = refresh_rollups
+        self.role_name = role_name
+        self.arns = arns
+        self.num_threads = num_threads
+        self.daemon = daemon
+        self.db_lock = threading.Lock()
+        self.scheduler = StalenessScheduler(
+            default_sla=app.config.get('COLLECT_DEFAULT_SLA', DEFAULT_SLA),
+            account_slas=app.config.get('COLLECT_ACCOUNT_SLA'),
+        )
+        self.retry_delay = app.config.get('COLLECT_RETRY_DELAY', DEFAULT_RETRY_DELAY)
+        self.account_refresh = app.config.get('COLLECT_ACCOUNT_REFRESH', DEFAULT_ACCOUNT_REFRESH)
+        self._stop = threading.Event()
+
+    def refresh_accounts(self):
+        """Add newly resolved accounts to the schedule and drop removed ones."""
+        from aardvark.model import AccountCollection
+
+        try:
+            accounts = set(self.resolve_accounts())
+            with self.app.app_context():
+                last_collected = AccountCollection.last_collected(accounts)
+        except Exception as e:
+            # Keep collecting the accounts already scheduled; the next refresh tries again.
+            self.app.logger.exception('Could not refresh the accounts to collect: {}'.format(e))
+            return
+
+        for account_number in self.scheduler.accounts() - accounts:
+            self.scheduler.remove(account_number)
+        for account_number in accounts:
+            self.scheduler.add(account_number, last_collected.get(account_number))
+        self.app.logger.info('Scheduling {} accounts'.format(len(accounts)))
+
+    def run(self):
+        self.refresh_accounts()
+
+        workers = [threading.Thread(target=self._work, args=(i + 1,), name='collector-{}'.format(i + 1))
+                   for i in range(self.num_threads)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            while any(worker.is_alive() for worker in workers):
+                if self._stop.wait(self.account_refresh if self.daemon else 1):
+                    break
+                if self.daemon:
+                    self.refresh_accounts()
+        finally:
+            self.stop()
+            for worker in workers:
+                worker.join()
+
+    def stop(self):
+        self._stop.set()
+        self.scheduler.stop()
+
+    def _work(self, thread_id):
+        while not self._stop.is_set():
+            account_number = self.scheduler.next(block=self.daemon)
+            if account_number is None:
+                return
+
+            self.app.logger.info('Collector #{} refreshing account {}'.format(thread_id, account_number))
+            start = time.time()
+            try:
+                account = AccountToUpdate(self.app, account_number, self.role_name, self.arns)
+                ret_code, aa_data = account.update_account()
+            except (Exception, SystemExit) as e:
+                ret_code, aa_data = 255, None
+                self.app.logger.exception('Collector #{} failed to update account {}: {}'.format(
+                    thread_id, account_number, e))
+
+            if ret_code != 0:
+                metrics.ACCOUNTS.inc(status='retry')
+                self.scheduler.failed(account_number, self.retry_delay)
+                continue
+
+            try:
+                collected_at = self._persist(account_number, account, aa_data, start)
+            except Exception as e:
+                # A database error must not cost the worker thread, or leave the account in flight forever.
+                self.app.logger.exception('Collector #{} failed to persist account {}: {}'.format(
+                    thread_id, account_number, e))
+                metrics.ACCOUNTS.inc(status='retry')
+                self.scheduler.failed(account_number, self.retry_delay)
+                continue
+
+            metrics.ACCOUNTS.inc(status='success')
+            self.scheduler.done(account_number, collected_at)
+
+    def _persist(self, account_number, account, aa_data, start):
+        """
+        Persist an account's results, mark it collected, prune it and rebuild its rollups; returns
+        when it was collected.
+        """
+        with self.db_lock:
+            with metrics.PHASE_SECONDS.time(phase='persistence'):
+                self.persist(self.app, aa_data)
+            collected_at = time.time()
+            if self.arns == ['all']:
+                from aardvark.model import AccountCollection
+                with self.app.app_context():
+                    AccountCollection.mark_collected(account_number, duration=collected_at - start,
+                                                     principal_count=account.principal_count)
+                if self.prune:
+                    self.prune(self.app, account_number, account.enumerated_arns)
+            if self.refresh_rollups:
+                self.refresh_rollups(self.app, account_number)
+        return collected_at
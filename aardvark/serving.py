@@ -0,0 +1,96 @@
+"""
+Production serving profile for ``aardvark start_api``.
+
+The app built by the aardvark command is warmed up once in the gunicorn master
+and forked into the workers (GUNICORN_PRELOAD, default on), so workers share
+its memory and don't pay for spec generation and first-query setup on their
+first request. Warm-up requests are left out of the request metrics, which the
+workers would otherwise inherit and report as traffic.
+The master's database connections, the read replica's included, are disposed
+of before forking and again in each worker, so no connection is ever shared
+between processes; each worker then opens its own on start-up.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+from gunicorn.app.wsgiapp import WSGIApplication
+
+from aardvark import db, metrics
+
+
+__all__ = ['AardvarkApplication', 'dispose_engine', 'warm_up']
+
+# Requests made during warm-up; they load everything a real request needs, and
+# the docs spec is generated (or read from API_SPEC_FILE) once for all workers.
+WARM_UP_PATHS = ('/healthcheck', '/api/1/advisors?count=1', '/apispec_1.json')
+
+
+def dispose_engine(app):
+    """
+    Drop the app's pooled database connections, the primary's and every bind's (e.g. the read
+    replica's, which warm-up and the lag check open); new ones are opened on demand.
+    """
+    with app.app_context():
+        for bind in [None] + sorted(app.config.get('SQLALCHEMY_BINDS') or {}):
+            db.get_engine(app, bind=bind).dispose()
+
+
+def warm_up(app):
+    """
+    Run a few requests through the app so imports, caches and the database are ready.
+    They are marked unmetered, so they don't show up in the request latency metrics.
+    """
+    client = app.test_client()
+    for path in WARM_UP_PATHS:
+        try:
+            client.get(path, environ_base={metrics.UNMETERED: True})
+        except Exception as e:
+            app.logger.warning('Warm-up request {} failed: {}'.format(path, e))
+
+
+def post_fork(server, worker):
+    # With preload the worker inherits the master's app; make sure it owns no connections.
+    app = worker.app.callable
+    if app is not None:
+        dispose_engine(app)
+
+
+def post_worker_init(worker):
+    # Open this worker's first connection before it takes traffic.
+    app = worker.wsgi
+    try:
+        with app.app_context():
+            db.engine.execute('SELECT 1')
+    except Exception as e:
+        app.logger.warning('Could not connect to the database during worker start-up: {}'.format(e))
+
+
+class AardvarkApplication(WSGIApplication):
+    """
+    gunicorn application serving an Aardvark app with the production profile.
+
+    :param flask_app: the app to serve; its config is read for GUNICORN_PRELOAD and API_WARM_UP
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        super(AardvarkApplication, self).__init__()
+
+    def load_default_config(self):
+        super(AardvarkApplication, self).load_default_config()
+        # Defaults only: gunicorn command line flags and config files still take precedence.
+        self.cfg.set('preload_app', self.config.get('GUNICORN_PRELOAD', True))
+        self.cfg.set('post_fork', post_fork)
+        self.cfg.set('post_worker_init', post_worker_init)
+
+    def init(self, parser, opts, args):
+        self.cfg.set('default_proc_name', 'aardvark')
+
+    def load(self):
+        # Without preload this runs in each worker, on its inherited copy of the app.
+        if self.config.get('API_WARM_UP', True):
+            warm_up(self.flask_app)
+        dispose_engine(self.flask_app)
+        return self.flask_app
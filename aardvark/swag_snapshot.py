@@ -0,0 +1,167 @@
+"""
+Local snapshot of the SWAG accounts, for resolving account names on the command line.
+
+Fetching every account from SWAG (and, with SWAG_SERVICE_ENABLED_REQUIREMENT,
+checking each one's services) takes seconds, and ``update`` did it on every run,
+even for a single account name. The accounts selected by SWAG_OPTS, SWAG_FILTER
+and SWAG_SERVICE_ENABLED_REQUIREMENT are kept in SWAG_SNAPSHOT_FILE as their
+account numbers plus an index of lower-cased names and aliases. It defaults to
+swag_snapshot.json in the app's instance folder, whatever directory aardvark is
+run from.
+
+The snapshot is used as is for SWAG_SNAPSHOT_TTL seconds (default 300). After
+that the backend is asked whether its data changed (the S3 object's ETag or the
+file backend's modification time and size) and the data is only fetched again
+if it did or the backend can't tell (DynamoDB). If SWAG can't be reached, a
+snapshot up to SWAG_SNAPSHOT_MAX_STALE seconds old (default a day) is used.
+Set SWAG_SNAPSHOT_FILE to None to fetch from SWAG every time.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+DEFAULT_SNAPSHOT_FILE = 'swag_snapshot.json'
+DEFAULT_TTL = 300
+DEFAULT_MAX_STALE = 24 * 60 * 60
+
+
+class Snapshot(object):
+    """
+    :param accounts: every selected account number
+    :param index: {lower-cased account name or alias: account number}
+    :param version: the backend's fingerprint of the data, or None
+    """
+
+    def __init__(self, accounts, index, version=None, fetched_at=None, key=None):
+        self.accounts = accounts
+        self.index = index
+        self.version = version
+        self.fetched_at = fetched_at or time.time()
+        self.key = key
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def to_dict(self):
+        return dict(key=self.key, version=self.version, fetchedAt=self.fetched_at, accounts=self.accounts,
+                    index=self.index)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['accounts'], values['index'], values.get('version'), values['fetchedAt'], values.get('key'))
+
+
+def _key(config):
+    """Identifies the SWAG settings a snapshot was taken with, so changing them invalidates it."""
+    settings = [config.get('SWAG_OPTS'), config.get('SWAG_FILTER'), config.get('SWAG_SERVICE_ENABLED_REQUIREMENT')]
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _options(config):
+    from swag_client.util import parse_swag_config_options
+
+    return parse_swag_config_options(config.get('SWAG_OPTS') or {})
+
+
+def backend_version(options):
+    """Return a fingerprint that changes whenever the backend's data does, or None if it has none."""
+    data_file = options.get('data_file')
+    if options['type'] == 's3':
+        import boto3
+
+        response = boto3.client('s3', region_name=options['region']).head_object(
+            Bucket=options['bucket_name'], Key=data_file or options['namespace'] + '.json')
+        return response['ETag']
+    if options['type'] == 'file':
+        stat = os.stat(data_file or os.path.join(options['data_dir'], options['namespace'] + '.json'))
+        return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+    return None
+
+
+def fetch(config, options, version=None):
+    """Read the selected accounts from SWAG and index them."""
+    from swag_client.backend import SWAGManager
+
+    swag = SWAGManager(**options)
+    all_accounts = swag.get_all(config.get('SWAG_FILTER'))
+
+    service_enabled_requirement = config.get('SWAG_SERVICE_ENABLED_REQUIREMENT', None)
+    if service_enabled_requirement:
+        all_accounts = swag.get_service_enabled(service_enabled_requirement, accounts_list=all_accounts)
+
+    index = {}
+    for account in all_accounts:
+        # get the right key, depending on whether we're using swag v1 or v2
+        alias_key = 'aliases' if account['schemaVersion'] == '2' else 'alias'
+        for name in [account['name']] + list(account[alias_key]):
+            index[name.lower()] = account['id']
+    return Snapshot([account['id'] for account in all_accounts], index, version=version, key=_key(config))
+
+
+def read(path):
+    try:
+        with open(path) as f:
+            return Snapshot.from_dict(json.load(f))
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def write(path, snapshot):
+    """Replace the snapshot file atomically, so concurrent readers see the old or the new one whole."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.swag_snapshot')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot.to_dict(), f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load(config, logger, instance_path):
+    """
+    Return the current Snapshot of the SWAG accounts, refreshing the snapshot file as needed.
+    If SWAG is unavailable and there is no usable snapshot, the Snapshot is empty.
+
+    :param instance_path: the app's instance folder, where the snapshot file is kept by default
+    """
+    path = config.get('SWAG_SNAPSHOT_FILE', os.path.join(instance_path, DEFAULT_SNAPSHOT_FILE))
+    cached = read(path) if path else None
+    if cached is not None and cached.key != _key(config):
+        cached = None
+    if cached is not None and cached.age() < config.get('SWAG_SNAPSHOT_TTL', DEFAULT_TTL):
+        return cached
+
+    try:
+        options = _options(config)
+        version = backend_version(options)
+        if cached is not None and version is not None and version == cached.version:
+            logger.debug('SWAG data unchanged; keeping the snapshot in {}'.format(path))
+            snapshot = cached
+            snapshot.fetched_at = time.time()
+        else:
+            logger.info('Fetching accounts from SWAG ({})'.format(options['type']))
+            snapshot = fetch(config, options, version)
+    except Exception as e:
+        if cached is not None and cached.age() < config.get('SWAG_SNAPSHOT_MAX_STALE', DEFAULT_MAX_STALE):
+            logger.warning('SWAG unavailable ({}); using the snapshot from {:.0f}s ago'.format(e, cached.age()))
+            return cached
+        logger.error('Account names passed but SWAG not configured or unavailable: {}'.format(e))
+        return Snapshot([], {})
+
+    if path:
+        try:
+            write(path, snapshot)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write the SWAG snapshot to {}: {}'.format(path, e))
+    return snapshot
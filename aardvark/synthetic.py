@@ -0,0 +1,116 @@
+"""
+Synthetic principals and Access Advisor usage, for load testing at production scale.
+
+Every principal gets an entry for every namespace, so a dataset has exactly
+accounts x principals x namespaces advisor_data rows. Namespaces are ranked
+like real fleets: the namespace of rank r (s3 first, then ec2, iam, ...) is
+used by a principal with probability r ** -skew, so skew 0 marks everything
+used and higher values leave the long tail unused. Recent use is more common
+than old: last access is exponentially distributed with a mean of
+MEAN_DAYS_SINCE_USE, within the 365 days Access Advisor reports.
+
+Generation is deterministic for a given seed, whatever the batch size.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import random
+import time
+
+from aardvark.updater.records import ServiceUsage
+
+
+FIRST_ACCOUNT = 100000000000
+MEAN_DAYS_SINCE_USE = 30
+MAX_DAYS_SINCE_USE = 365
+MILLISECONDS_PER_DAY = 24 * 60 * 60 * 1000
+
+# The most used namespaces first; further namespaces are named svc<rank>.
+NAMESPACES = [
+    ('s3', 'Amazon S3'), ('ec2', 'Amazon EC2'), ('iam', 'AWS Identity and Access Management'),
+    ('sts', 'AWS Security Token Service'), ('logs', 'Amazon CloudWatch Logs'), ('kms', 'AWS Key Management Service'),
+    ('cloudwatch', 'Amazon CloudWatch'), ('dynamodb', 'Amazon DynamoDB'), ('sqs', 'Amazon SQS'),
+    ('sns', 'Amazon SNS'), ('lambda', 'AWS Lambda'), ('cloudformation', 'AWS CloudFormation'),
+    ('autoscaling', 'Amazon EC2 Auto Scaling'), ('elasticloadbalancing', 'Elastic Load Balancing'),
+    ('ecr', 'Amazon Elastic Container Registry'), ('ecs', 'Amazon Elastic Container Service'),
+    ('ssm', 'AWS Systems Manager'), ('secretsmanager', 'AWS Secrets Manager'), ('route53', 'Amazon Route 53'),
+    ('rds', 'Amazon RDS'), ('kinesis', 'Amazon Kinesis'), ('firehose', 'Amazon Kinesis Firehose'),
+    ('events', 'Amazon EventBridge'), ('states', 'AWS Step Functions'), ('elasticache', 'Amazon ElastiCache'),
+    ('es', 'Amazon Elasticsearch Service'), ('athena', 'Amazon Athena'), ('glue', 'AWS Glue'),
+    ('cloudtrail', 'AWS CloudTrail'), ('config', 'AWS Config'), ('acm', 'AWS Certificate Manager'),
+    ('apigateway', 'Amazon API Gateway'), ('cloudfront', 'Amazon CloudFront'), ('redshift', 'Amazon Redshift'),
+    ('elasticmapreduce', 'Amazon Elastic MapReduce'), ('sagemaker', 'Amazon SageMaker'),
+    ('codebuild', 'AWS CodeBuild'), ('codepipeline', 'AWS CodePipeline'), ('organizations', 'AWS Organizations'),
+]
+
+# (ARN resource type, paths, share of principals)
+PRINCIPAL_KINDS = [
+    ('role', ['', 'service-role/', 'app/'], 0.7),
+    ('user', ['', 'humans/'], 0.2),
+    ('group', [''], 0.05),
+    ('policy', ['', 'managed/'], 0.05),
+]
+TEAMS = ['payments', 'search', 'billing', 'identity', 'streaming', 'platform', 'data', 'security']
+APPS = ['api', 'worker', 'batch', 'etl', 'web', 'scheduler', 'cache', 'deploy']
+
+
+def namespaces(count):
+    """Return the first count (namespace, service name) pairs by rank."""
+    return NAMESPACES[:count] + [('svc{}'.format(rank), 'Service {}'.format(rank))
+                                 for rank in range(len(NAMESPACES) + 1, count + 1)]
+
+
+def account_numbers(count):
+    return ['{:012d}'.format(FIRST_ACCOUNT + index) for index in range(count)]
+
+
+def _arn(rng, account_number, index):
+    kind = rng.choices(PRINCIPAL_KINDS, weights=[share for _, _, share in PRINCIPAL_KINDS])[0]
+    name = '{}-{}-{}'.format(rng.choice(TEAMS), rng.choice(APPS), index)
+    return 'arn:aws:iam::{}:{}/{}{}'.format(account_number, kind[0], rng.choice(kind[1]), name), kind[0]
+
+
+def _usage(rng, arn, kind, account_number, services, use_probabilities, now_ms):
+    records = []
+    for (namespace, name), probability in zip(services, use_probabilities):
+        if rng.random() >= probability:
+            records.append(ServiceUsage(namespace, name, 0, None, 0))
+            continue
+        days_ago = min(rng.expovariate(1.0 / MEAN_DAYS_SINCE_USE), MAX_DAYS_SINCE_USE)
+        if kind in ('role', 'user'):
+            entity, entities = arn, 1
+        else:
+            # Groups and policies are used through their members.
+            entity = 'arn:aws:iam::{}:user/{}-{}'.format(account_number, rng.choice(TEAMS), rng.randint(0, 99))
+            entities = rng.randint(1, 5)
+        records.append(ServiceUsage(namespace, name, now_ms - int(days_ago * MILLISECONDS_PER_DAY), entity,
+                                    entities))
+    return records
+
+
+def generate(accounts, principals, namespace_count, skew=1.0, seed=0, batch_size=1000, now=None):
+    """
+    Yield (account_number, {arn: [ServiceUsage, ...]}) batches of at most batch_size principals,
+    account by account.
+
+    :param accounts: number of accounts
+    :param principals: principals per account
+    :param namespace_count: services every principal has an entry for
+    :param skew: exponent of the namespace popularity power law
+    :param now: epoch seconds last use is relative to (default now)
+    """
+    services = namespaces(namespace_count)
+    use_probabilities = [rank ** -skew for rank in range(1, namespace_count + 1)]
+    now_ms = int((now or time.time()) * 1000)
+    for account_number in account_numbers(accounts):
+        rng = random.Random('{}-{}'.format(seed, account_number))
+        batch = {}
+        for index in range(principals):
+            arn, kind = _arn(rng, account_number, index)
+            batch[arn] = _usage(rng, arn, kind, account_number, services, use_probabilities, now_ms)
+            if len(batch) == batch_size:
+                yield account_number, batch
+                batch = {}
+        if batch:
+            yield account_number, batch
@@ -1,12 +1,19 @@
 # ensure absolute import for python3
 from __future__ import absolute_import
 
+import functools
+import threading
 import time
 
 from blinker import Signal
-from cloudaux.aws.iam import list_roles, list_users
+from botocore.exceptions import ClientError
 from cloudaux.aws.sts import boto3_cached_conn
-from cloudaux.aws.decorators import rate_limited
+from cloudaux.aws.decorators import RATE_LIMITING_ERRORS, rate_limited
+
+from aardvark import metrics
+from aardvark.updater import recording
+from aardvark.updater.records import ServiceUsage
+from aardvark.utils.ratelimit import shared_bucket
 
 
 class JobNotComplete(Exception):
@@ -17,17 +24,82 @@ class JobFailed(Exception):
     pass
 
 
+def counted(operation):
+    """ Count every attempt at an API call, including those retried by rate_limited. """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            metrics.API_CALLS.inc(operation=operation)
+            try:
+                return f(*args, **kwargs)
+            except ClientError as e:
+                if e.response['Error']['Code'] in RATE_LIMITING_ERRORS:
+                    metrics.API_THROTTLES.inc(operation=operation)
+                raise
+        return decorated_function
+    return decorator
+
+
+def budgeted(f):
+    """ Wait for a token from the global and per-account IAM API budgets, if configured. """
+    @functools.wraps(f)
+    def decorated_function(self, *args, **kwargs):
+        if self.api_budget:
+            self.api_budget.acquire()
+        if self.account_api_budget:
+            self.account_api_budget.acquire()
+        return f(self, *args, **kwargs)
+    return decorated_function
+
+
+def chunked(arns, chunk_size):
+    """ Split a list of ARNs into lists of at most chunk_size. """
+    return [arns[i:i + chunk_size] for i in range(0, len(arns), chunk_size)]
+
+
+class AccountRun(object):
+    """
+    Tracks an account whose principals were split into several work items, so
+    account-level bookkeeping happens once, after the last chunk is persisted.
+    """
+
+    def __init__(self, account_number, principal_count, chunks, start=None, arns=None):
+        """
+        :param arns: the account's full inventory, pruned against once every chunk is persisted
+        """
+        self.account_number = account_number
+        self.principal_count = principal_count
+        self.arns = arns
+        self.start = start or time.time()
+        self._remaining = chunks
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def chunk_done(self, success=True):
+        """ Returns True when this was the last outstanding chunk and every chunk succeeded. """
+        with self._lock:
+            self._remaining -= 1
+            self._failed = self._failed or not success
+            return self._remaining == 0 and not self._failed
+
+
 class AccountToUpdate(object):
     on_ready = Signal()
     on_complete = Signal()
     on_error = Signal()
     on_failure = Signal()
 
-    def __init__(self, current_app, account_number, role_name, arns_list):
+    def __init__(self, current_app, account_number, role_name, arns_list, enumerated_arns=None):
+        """
+        :param arns_list: ARNs to collect, or ['all']; each is checked against the account's principals
+        :param enumerated_arns: principals already listed for this work item, e.g. one chunk of a
+            split account; when given the account is not listed again
+        """
         self.current_app = current_app
         self.account_number = account_number
         self.role_name = role_name
         self.arn_list = arns_list
+        self.enumerated_arns = enumerated_arns
         self.conn_details = {
             'account_number': account_number,
             'assume_role': role_name,
@@ -36,6 +108,16 @@ class AccountToUpdate(object):
             'arn_partition': self.current_app.config.get('ARN_PARTITION') or 'aws'
         }
         self.max_access_advisor_job_wait = 5 * 60  # Wait 5 minutes before giving up on jobs
+        self.principal_count = None
+
+        # IAM_API_BUDGET caps Access Advisor calls per second across every account in this process.
+        api_budget = self.current_app.config.get('IAM_API_BUDGET')
+        self.api_budget = shared_bucket(api_budget, self.current_app.config.get('IAM_API_BURST')) \
+            if api_budget else None
+        # IAM_ACCOUNT_API_BUDGET does the same per account, shared by every chunk of a split account.
+        account_api_budget = self.current_app.config.get('IAM_ACCOUNT_API_BUDGET')
+        self.account_api_budget = shared_bucket(account_api_budget, self.current_app.config.get('IAM_ACCOUNT_API_BURST'),
+                                                key=account_number) if account_api_budget else None
 
     def update_account(self):
         """
@@ -48,7 +130,8 @@ class AccountToUpdate(object):
         :return: Return code and JSON Access Advisor data for given account
         """
         self.on_ready.send(self)
-        arns = self._get_arns()
+        arns = self.enumerate_arns()
+        self.principal_count = len(arns)
 
         if not arns:
             self.current_app.logger.warn("Zero ARNs collected. Exiting")
@@ -65,6 +148,16 @@ class AccountToUpdate(object):
             self.on_complete.send(self)
             return 0, details
 
+    def enumerate_arns(self):
+        """
+        Lists the principals to collect, once; later calls reuse the result.
+        :return: list of ARNs
+        """
+        if self.enumerated_arns is None:
+            with metrics.PHASE_SECONDS.time(phase='enumeration'):
+                self.enumerated_arns = list(self._get_arns())
+        return self.enumerated_arns
+
     def _get_arns(self):
         """
         Gets a list of all Role ARNs in a given account, optionally limited by
@@ -74,20 +167,11 @@ class AccountToUpdate(object):
         client = self._get_client()
 
         account_arns = set()
-
-        for role in list_roles(**self.conn_details):
-            account_arns.add(role['Arn'])
-
-        for user in list_users(**self.conn_details):
-            account_arns.add(user['Arn'])
-
-        for page in client.get_paginator('list_policies').paginate(Scope='Local'):
-            for policy in page['Policies']:
-                account_arns.add(policy['Arn'])
-
-        for page in client.get_paginator('list_groups').paginate():
-            for group in page['Groups']:
-                account_arns.add(group['Arn'])
+        for operation, key, params in (('list_roles', 'Roles', {}), ('list_users', 'Users', {}),
+                                       ('list_policies', 'Policies', {'Scope': 'Local'}),
+                                       ('list_groups', 'Groups', {})):
+            for principal in self._list(client, operation, key, **params):
+                account_arns.add(principal['Arn'])
 
         result_arns = set()
         for arn in self.arn_list:
@@ -107,15 +191,31 @@ class AccountToUpdate(object):
         """
         Assumes into the target account and obtains IAM client
 
+        If IAM_CLIENT_FACTORY is configured it is called with the connection
+        details instead, which lets benchmarks and tests supply a stand-in client.
+        IAM_REPLAY_FILE serves the calls from a recording, and IAM_RECORD_FILE
+        records the calls made through the client (see aardvark.updater.recording).
+
         :return: boto3 IAM client in target account & role
         """
         try:
-            client = boto3_cached_conn(
-                'iam', **self.conn_details)
+            config = self.current_app.config
+            client_factory = config.get('IAM_CLIENT_FACTORY')
+            if config.get('IAM_REPLAY_FILE'):
+                client = recording.open_replay(config['IAM_REPLAY_FILE'], config.get('IAM_REPLAY_SPEED')).client(
+                    **self.conn_details)
+            elif client_factory:
+                client = client_factory(**self.conn_details)
+            else:
+                client = boto3_cached_conn(
+                    'iam', **self.conn_details)
 
             if not client:
                 raise ValueError(f"boto3_cached_conn returned null IAM client for {self.account_number}")
 
+            if config.get('IAM_RECORD_FILE'):
+                client = recording.open_recording(config['IAM_RECORD_FILE']).wrap(client, self.account_number)
+
             return client
 
         except Exception as e:
@@ -123,20 +223,42 @@ class AccountToUpdate(object):
             self.current_app.logger.exception(f"Failed to obtain boto3 IAM client for account {self.account_number}.", exc_info=False)
             raise e
 
+    @rate_limited()
+    @budgeted
+    def _list_page(self, iam, operation, **params):
+        """ One page of an IAM list call; each counts against the API budget like any other call. """
+        return getattr(iam, operation)(**params)
+
+    def _list(self, iam, operation, key, **params):
+        """ Yield every item of a Marker-paginated IAM list call, a page at a time. """
+        while True:
+            page = self._list_page(iam, operation, **params)
+            for item in page[key]:
+                yield item
+            if not page.get('IsTruncated'):
+                return
+            params['Marker'] = page['Marker']
+
     def _call_access_advisor(self, iam, arns):
-        jobs = self._generate_job_ids(iam, arns)
-        details = self._process_jobs(iam, jobs)
+        with metrics.PHASE_SECONDS.time(phase='job_generation'):
+            jobs = self._generate_job_ids(iam, arns)
+        with metrics.PHASE_SECONDS.time(phase='polling'):
+            details = self._process_jobs(iam, jobs)
         if arns and not details:
             self.current_app.logger.error("Didn't get any results from Access Advisor")
         return details
 
     @rate_limited()
+    @counted('GenerateServiceLastAccessedDetails')
+    @budgeted
     def _generate_service_last_accessed_details(self, iam, arn):
         """ Wrapping the actual AWS API calls for rate limiting protection. """
         self.current_app.logger.debug('generating last accessed details for role %s', arn)
         return iam.generate_service_last_accessed_details(Arn=arn)['JobId']
 
     @rate_limited()
+    @counted('GetServiceLastAccessedDetails')
+    @budgeted
     def _get_service_last_accessed_details(self, iam, job_id, marker=None):
         """ Wrapping the actual AWS API calls for rate limiting protection. """
         self.current_app.logger.debug('getting last accessed details for job %s', job_id)
@@ -229,22 +351,9 @@ class AccountToUpdate(object):
                 self.current_app.logger.error('Could not gather data from {0}.'.format(role_arn), exc_info=True)
                 continue
 
-            # Job status must be COMPLETED. Save result.
+            # Job status must be COMPLETED. Save result in compact form.
             last_job_completion_time = time.time()
-            updated_list = []
-
-            for detail in last_accessed_details:
-                # AWS gives a datetime, convert to epoch
-                last_auth = detail.get('LastAuthenticated')
-                if last_auth:
-                    last_auth = int(time.mktime(last_auth.timetuple()) * 1000)
-                else:
-                    last_auth = 0
-
-                detail['LastAuthenticated'] = last_auth
-                updated_list.append(detail)
-
-            access_details[role_arn] = updated_list
+            access_details[role_arn] = [ServiceUsage.from_detail(detail) for detail in last_accessed_details]
 
         return access_details
 
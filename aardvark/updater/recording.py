@@ -0,0 +1,259 @@
+"""
+Record the IAM calls made by a collection run and replay them later.
+
+With IAM_RECORD_FILE set, every IAM client AccountToUpdate obtains is wrapped
+in a RecordingClient, which appends each call (operation, parameters, response
+or error, when it started and how long it took) to a gzip-compressed JSON lines
+file. With IAM_REPLAY_FILE set instead, clients come from a Replay of such a
+file and no AWS credentials are needed: list calls return the recorded pages,
+and Access Advisor jobs report IN_PROGRESS until as long has passed since they
+were generated as in the recorded run. IAM_REPLAY_SPEED scales time: 1 replays
+call latencies and job durations as recorded, 10 ten times faster, and 0 (the
+default) doesn't wait at all.
+
+Recordings hold real principal ARNs and usage data; treat them like the
+database.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import atexit
+import collections
+import datetime
+import gzip
+import json
+import threading
+import time
+import zlib
+
+from botocore.exceptions import ClientError
+
+
+_RECORDINGS = {}
+_RECORDINGS_LOCK = threading.Lock()
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'$dt': value.isoformat()}
+    raise TypeError('Cannot record {!r}'.format(value))
+
+
+def _decode(value):
+    if '$dt' in value:
+        return datetime.datetime.fromisoformat(value['$dt'])
+    return value
+
+
+def _error(e):
+    """The error code and message of a failed call; modeled exceptions like NoSuchEntityException are named by code."""
+    if isinstance(e, ClientError):
+        return {'Code': e.response['Error'].get('Code'), 'Message': e.response['Error'].get('Message')}
+    name = type(e).__name__
+    return {'Code': name[:-len('Exception')] if name.endswith('Exception') else name, 'Message': str(e)}
+
+
+class Recording(object):
+    """One recording file, shared by every client wrapped for it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.time()
+        self._file = gzip.open(path, 'wt')
+        self._lock = threading.Lock()
+
+    def wrap(self, client, account_number):
+        return RecordingClient(client, self, account_number)
+
+    def write(self, started, duration, account_number, operation, params, response=None, error=None):
+        entry = dict(t=round(started - self.start, 4), d=round(duration, 4), a=account_number, op=operation,
+                     p=params)
+        if error is not None:
+            entry['e'] = error
+        else:
+            entry['r'] = {key: value for key, value in response.items() if key != 'ResponseMetadata'}
+        line = json.dumps(entry, default=_encode, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def open_recording(path):
+    """Return the Recording for path, creating it (and truncating the file) on first use in this process."""
+    with _RECORDINGS_LOCK:
+        if path not in _RECORDINGS:
+            _RECORDINGS[path] = Recording(path)
+        return _RECORDINGS[path]
+
+
+@atexit.register
+def close_recordings():
+    """Finish every open recording file; runs when the process exits."""
+    with _RECORDINGS_LOCK:
+        for key, recording in list(_RECORDINGS.items()):
+            if isinstance(recording, Recording):
+                recording.close()
+                del _RECORDINGS[key]
+
+
+class RecordingClient(object):
+    """Wraps a boto3 IAM client, recording every call made through it."""
+
+    def __init__(self, client, recording, account_number):
+        self._client = client
+        self._recording = recording
+        self._account_number = account_number
+        self.exceptions = client.exceptions
+
+    def __getattr__(self, operation):
+        method = getattr(self._client, operation)
+
+        def call(**params):
+            started = time.time()
+            try:
+                response = method(**params)
+            except Exception as e:
+                self._recording.write(started, time.time() - started, self._account_number, operation, params,
+                                      error=_error(e))
+                raise
+            self._recording.write(started, time.time() - started, self._account_number, operation, params,
+                                  response=response)
+            return response
+        return call
+
+
+def read_recording(path):
+    """Yield the recorded calls in order; a recording cut short by a crash yields what was written."""
+    with gzip.open(path, 'rt') as f:
+        try:
+            for line in f:
+                if line.endswith('\n'):
+                    yield json.loads(line, object_hook=_decode)
+        except (EOFError, zlib.error):
+            return
+
+
+class ReplayExceptions(object):
+    class NoSuchEntityException(ClientError):
+        pass
+
+
+class Replay(object):
+    """
+    Serves the calls in a recording to clients handed out by ``client``, the IAM_CLIENT_FACTORY signature.
+
+    Calls are matched on account, operation and parameters. A call recorded several times (e.g.
+    throttled, then retried) returns the recorded outcomes in order, repeating the last.
+
+    :param speed: how many times faster than recorded to run; 0 or None doesn't wait
+    """
+
+    def __init__(self, path, speed=None):
+        self.speed = speed
+        self.exceptions = ReplayExceptions
+        self._outcomes = collections.defaultdict(collections.deque)
+        # Seconds from generating each job until it was first seen COMPLETED or FAILED.
+        self._job_durations = {}
+        self._jobs_started = {}
+        self._lock = threading.Lock()
+        self.accounts = []
+
+        generated = {}
+        poll_latencies = []
+        for call in read_recording(path):
+            key = self._key(call['a'], call['op'], call['p'])
+            outcome = call.get('r')
+            if call['op'] == 'get_service_last_accessed_details':
+                if outcome is not None and outcome.get('JobStatus') == 'IN_PROGRESS':
+                    poll_latencies.append(call['d'])
+                    continue
+                job_id = call['p']['JobId']
+                if job_id in generated and job_id not in self._job_durations:
+                    self._job_durations[job_id] = max(0.0, call['t'] - generated[job_id])
+            elif call['op'] == 'generate_service_last_accessed_details' and outcome is not None:
+                generated[outcome['JobId']] = call['t'] + call['d']
+            self._outcomes[key].append(call)
+            if call['a'] not in self.accounts:
+                self.accounts.append(call['a'])
+        # Polls of unfinished jobs aren't matched to a recorded call; they take the median recorded time.
+        self._poll_latency = sorted(poll_latencies)[len(poll_latencies) // 2] if poll_latencies else 0.0
+
+    @staticmethod
+    def _key(account_number, operation, params):
+        return account_number, operation, json.dumps(params, sort_keys=True)
+
+    def client(self, account_number=None, **kwargs):
+        """IAM_CLIENT_FACTORY entry point."""
+        return ReplayClient(self, account_number)
+
+    def _wait(self, seconds):
+        if self.speed and seconds:
+            time.sleep(seconds / self.speed)
+
+    def call(self, account_number, operation, params):
+        key = self._key(account_number, operation, params)
+        polling = operation == 'get_service_last_accessed_details'
+        if polling and not self._job_ready(params['JobId']):
+            self._wait(self._poll_latency)
+            return {'JobStatus': 'IN_PROGRESS'}
+
+        with self._lock:
+            outcomes = self._outcomes.get(key)
+            if not outcomes and polling:
+                # The job never finished in the recorded run either.
+                return {'JobStatus': 'IN_PROGRESS'}
+            if not outcomes:
+                raise ClientError({'Error': {'Code': 'NotRecorded',
+                                             'Message': '{} {} was not recorded'.format(operation, params)}},
+                                  operation)
+            call = outcomes.popleft() if len(outcomes) > 1 else outcomes[0]
+
+        self._wait(call['d'])
+        if 'e' in call:
+            error = {'Error': call['e']}
+            if call['e']['Code'] == 'NoSuchEntity':
+                raise ReplayExceptions.NoSuchEntityException(error, operation)
+            raise ClientError(error, operation)
+        if operation == 'generate_service_last_accessed_details':
+            with self._lock:
+                self._jobs_started[call['r']['JobId']] = time.time()
+        return call['r']
+
+    def _job_ready(self, job_id):
+        if not self.speed:
+            return True
+        with self._lock:
+            started = self._jobs_started.get(job_id)
+        if started is None:
+            return True
+        return (time.time() - started) * self.speed >= self._job_durations.get(job_id, 0.0)
+
+
+def open_replay(path, speed=None):
+    """Return the Replay of path at this speed, loading the recording on first use in this process."""
+    with _RECORDINGS_LOCK:
+        key = ('replay', path, speed)
+        if key not in _RECORDINGS:
+            _RECORDINGS[key] = Replay(path, speed)
+        return _RECORDINGS[key]
+
+
+class ReplayClient(object):
+    """Per-account client answering the boto3 IAM methods from a Replay."""
+
+    def __init__(self, replay, account_number):
+        self._replay = replay
+        self._account_number = account_number
+        self.exceptions = replay.exceptions
+
+    def __getattr__(self, operation):
+        if operation.startswith('_'):
+            raise AttributeError(operation)
+
+        def call(**params):
+            return self._replay.call(self._account_number, operation, params)
+        return call
@@ -0,0 +1,62 @@
+"""
+Compact in-memory form of Access Advisor results.
+
+Collection holds every principal's results for a whole account until it is
+persisted. The raw botocore dicts repeat the same key and service strings for
+every entry and carry a datetime each, so results are converted on arrival to
+slotted records with interned strings and integer epoch-millisecond timestamps.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import sys
+import time
+
+
+__all__ = ['ServiceUsage']
+
+
+def _intern(value):
+    return sys.intern(value) if value is not None else None
+
+
+class ServiceUsage(object):
+    """One principal's Access Advisor entry for one service."""
+
+    __slots__ = ('namespace', 'name', 'last_authenticated', 'last_authenticated_entity',
+                 'total_authenticated_entities')
+
+    def __init__(self, namespace, name, last_authenticated, last_authenticated_entity,
+                 total_authenticated_entities):
+        self.namespace = namespace
+        self.name = name
+        self.last_authenticated = last_authenticated
+        self.last_authenticated_entity = last_authenticated_entity
+        self.total_authenticated_entities = total_authenticated_entities
+
+    @classmethod
+    def from_detail(cls, detail):
+        """Build a record from one ServicesLastAccessed entry returned by IAM."""
+        # AWS gives a datetime, convert to epoch milliseconds; 0 means no recorded access.
+        last_auth = detail.get('LastAuthenticated')
+        if last_auth:
+            last_auth = int(time.mktime(last_auth.timetuple()) * 1000)
+        else:
+            last_auth = 0
+
+        return cls(
+            _intern(detail['ServiceNamespace']),
+            _intern(detail['ServiceName']),
+            last_auth,
+            _intern(detail.get('LastAuthenticatedEntity')),
+            detail.get('TotalAuthenticatedEntities'),
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, ServiceUsage) and all(
+            getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+    def __repr__(self):
+        return 'ServiceUsage({})'.format(', '.join(
+            '{}={!r}'.format(slot, getattr(self, slot)) for slot in self.__slots__))
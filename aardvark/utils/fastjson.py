@@ -0,0 +1,103 @@
+"""
+JSON encoding for API responses.
+
+Uses orjson when it is installed and the standard library otherwise; set
+JSON_BACKEND to 'orjson' or 'stdlib' to choose explicitly. Dates are written as
+HTTP dates, the same as Flask's jsonify, so responses don't depend on the backend.
+
+UsageEncoder writes a principal's /advisors entry straight from advisor_data
+rows, with the service names encoded once per service rather than once per row.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import datetime
+import json
+
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+__all__ = ['BACKENDS', 'UsageEncoder', 'backend', 'dumps', 'select']
+
+
+def _default(o):
+    if isinstance(o, datetime.datetime):
+        return http_date(o.utctimetuple())
+    if isinstance(o, datetime.date):
+        return http_date(o.timetuple())
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=_default, separators=(',', ':'))
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_default,
+                        option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
+BACKENDS = {'stdlib': _stdlib_dumps}
+if orjson is not None:
+    BACKENDS['orjson'] = _orjson_dumps
+
+_dumps = BACKENDS.get('orjson', _stdlib_dumps)
+
+
+def select(name='auto'):
+    """Choose the encoder: 'orjson', 'stdlib' or 'auto' (orjson if installed)."""
+    global _dumps
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in BACKENDS else 'stdlib'
+    if name not in BACKENDS:
+        raise ValueError('JSON backend {} is not available, choose from {}'.format(name, sorted(BACKENDS)))
+    _dumps = BACKENDS[name]
+
+
+def backend():
+    return 'orjson' if _dumps is BACKENDS.get('orjson') else 'stdlib'
+
+
+def dumps(obj):
+    """Encode obj to a compact JSON string."""
+    return _dumps(obj)
+
+
+class UsageEncoder(object):
+    """
+    Encodes usage rows, (service_id, lastAuthenticated, lastAuthenticatedEntity,
+    totalAuthenticatedEntities) tuples, to the JSON list /advisors returns per principal.
+
+    :param services: {id: (serviceName, serviceNamespace)} as returned by AdvisorService.lookup
+    """
+
+    _ENTRY = ('{{"lastAuthenticated":{},"lastAuthenticatedEntity":{},"lastUpdated":{},{},'
+              '"totalAuthenticatedEntities":{}}}')
+
+    def __init__(self, services):
+        self._services = {
+            service_id: '"serviceName":{},"serviceNamespace":{}'.format(dumps(name), dumps(namespace))
+            for service_id, (name, namespace) in services.items()
+        }
+
+    def encode(self, rows, last_updated):
+        last_updated = dumps(last_updated)
+        entry = self._ENTRY.format
+        services = self._services
+        return '[' + ','.join(
+            entry(_scalar(last_authenticated), _string(entity), last_updated, services[service_id], _scalar(total))
+            for service_id, last_authenticated, entity, total in rows) + ']'
+
+
+def _scalar(value):
+    return 'null' if value is None else str(int(value))
+
+
+def _string(value):
+    return 'null' if value is None else dumps(value)
@@ -0,0 +1,56 @@
+"""
+Token bucket used to hold IAM API calls to a global budget across threads.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+__all__ = ['TokenBucket', 'shared_bucket']
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket refilling at `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available and take them."""
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_SHARED_BUCKETS = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def shared_bucket(rate, burst=None, key=None):
+    """
+    Return the process-wide bucket for this rate so every caller draws on one budget.
+
+    Callers passing the same `key` (e.g. an account number) share a separate bucket.
+    """
+    key = (key, float(rate), float(burst or rate))
+    with _SHARED_LOCK:
+        if key not in _SHARED_BUCKETS:
+            _SHARED_BUCKETS[key] = TokenBucket(rate, burst)
+        return _SHARED_BUCKETS[key]
@@ -0,0 +1,70 @@
+"""
+PRAGMAs applied to every new SQLite connection.
+
+SQLite's defaults suit a single process. When the API and the collector share
+one database file, the rollback journal makes readers wait for the collector's
+write transactions to commit. The defaults here switch to write-ahead logging
+(readers see the last committed data while a write is in progress), fsync only
+at checkpoints, map the file into memory, enlarge the page cache and wait up
+to five seconds for locks (pysqlite's own default timeout, made explicit). They
+also enforce foreign keys, which SQLite otherwise ignores.
+
+SQLITE_PRAGMAS in the config overrides these per PRAGMA; set one to None to
+leave SQLite's own default in place.
+"""
+
+#ensure absolute import for python3
+from __future__ import absolute_import
+
+import sqlite3
+
+from sqlalchemy import event
+
+
+__all__ = ['DEFAULT_PRAGMAS', 'pragmas', 'statements', 'listen']
+
+DEFAULT_PRAGMAS = {
+    # Readers don't block the writer and the writer doesn't block readers.
+    'journal_mode': 'WAL',
+    # With WAL, NORMAL only loses the last transactions on power loss, never corrupts.
+    'synchronous': 'NORMAL',
+    # Bytes of the file to memory-map.
+    'mmap_size': 256 * 1024 * 1024,
+    # Negative values are KiB: 64 MiB of page cache per connection.
+    'cache_size': -64 * 1024,
+    # Milliseconds to wait for a lock held by another connection.
+    'busy_timeout': 5000,
+    # Off by default in SQLite; pruning relies on ON DELETE CASCADE to remove a principal's rows.
+    'foreign_keys': 'ON',
+}
+
+# journal_mode first: the others don't depend on it, but it needs the database to itself.
+_ORDER = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout', 'foreign_keys')
+
+
+def pragmas(config):
+    """Return the [(name, value)] PRAGMAs to apply given the app config, in the order they are applied."""
+    values = dict(DEFAULT_PRAGMAS)
+    values.update(config.get('SQLITE_PRAGMAS') or {})
+    names = [name for name in _ORDER if name in values] + sorted(set(values) - set(_ORDER))
+    return [(name, values[name]) for name in names if values[name] is not None]
+
+
+def statements(pragma_values):
+    return ['PRAGMA {}={}'.format(name, value) for name, value in pragma_values]
+
+
+def listen(engine, pragma_values):
+    """Apply the PRAGMAs to each connection the engine opens."""
+    sql = statements(pragma_values)
+
+    @event.listens_for(engine, 'connect')
+    def sqlite_tuning_connect(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in sql:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
@@ -1,23 +1,128 @@
 #ensure absolute import for python3
 from __future__ import absolute_import
 
-import better_exceptions  # noqa
 import datetime
-import json
+import time
 
-from flask import abort, jsonify
+from flask import abort, current_app, g, jsonify, request, stream_with_context, Response
 from flask import Blueprint
 from flask_restful import Api, Resource, reqparse
 from flask import Flask
 import sqlalchemy as sa
 
-from aardvark.model import AWSIAMObject
+from aardvark import db, metrics, replica
+from aardvark.utils import fastjson
+from aardvark.model import (AccountCollection, AccountServiceRollup, AdvisorData, AdvisorHistory, AdvisorService,
+                            AWSIAMObject, ChangeLog, MILLISECONDS_PER_DAY, PrincipalUsage, QUERY_CHUNK_SIZE,
+                            ROLLUP_WINDOWS, ServiceRollup, usage_entry)
 
 
 mod = Blueprint('advisor', __name__)
 api = Api(mod)
 app = Flask(__name__)
 
+QUERY_SHAPE_PARAMETERS = ('arn', 'arns', 'phrase', 'regex', 'combine', 'as_of', 'account', 'namespace', 'since')
+
+DEFAULT_BULK_LOOKUP_MAX_ARNS = 100000
+DEFAULT_CHANGES_MAX_COUNT = 10000
+
+
+def query_shape(parameters, body=None):
+    """
+    Describe which filters a request used, e.g. 'arn+phrase' or 'all'; shared with the ASGI API.
+
+    :param parameters: the query string's parameter names
+    :param body: the decoded JSON body, if any
+    """
+    parameters = set(parameters)
+    if isinstance(body, dict):
+        parameters.update(body)
+    return '+'.join(p for p in QUERY_SHAPE_PARAMETERS if p in parameters) or 'all'
+
+
+def _query_shape():
+    return query_shape(request.args, request.get_json(silent=True))
+
+
+def _parse_as_of(value):
+    """Accept epoch milliseconds or an ISO 8601 date/datetime (UTC) and return epoch milliseconds."""
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            parsed = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return int((parsed - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    raise ValueError('as_of must be epoch milliseconds or an ISO 8601 date, got {}'.format(value))
+
+
+def _parse_cursor(value):
+    """Parse an `after` cursor, "<item_id>:<service_id>" as returned in `next`."""
+    try:
+        item_id, service_id = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise ValueError('after must be the next value of a previous page, not {!r}.'.format(value))
+    return item_id, service_id
+
+
+def _json_response(obj):
+    return Response(fastjson.dumps(obj) + '\n', mimetype='application/json')
+
+
+@mod.before_request
+def route_reads():
+    # Every endpoint here only reads; send them to the read replica if there is one.
+    replica.use_replica(current_app, db)
+
+
+@mod.teardown_request
+def release_replica(exc):
+    replica.release(db)
+
+
+@mod.before_request
+def _start_request_timer():
+    if not request.environ.get(metrics.UNMETERED):
+        g.request_start = time.time()
+
+
+@mod.after_request
+def _observe_request_time(response):
+    start = g.get('request_start')
+    if start is not None:
+        metrics.REQUEST_SECONDS.observe(time.time() - start, endpoint=request.endpoint or 'unknown',
+                                        shape=_query_shape())
+    return response
+
+
+def combine_usage(aa):
+    """Merge an /advisors result into one entry per service namespace."""
+    del aa['count']
+    del aa['page']
+    del aa['total']
+
+    usage = dict()
+    for arn, services in aa.items():
+        for service in services:
+            namespace = service.get('serviceNamespace')
+            last_authenticated = service.get('lastAuthenticated')
+            if namespace not in usage:
+                usage[namespace] = service
+            else:
+                count_entities = usage[namespace]['totalAuthenticatedEntities'] + service['totalAuthenticatedEntities']
+                if last_authenticated > usage[namespace]['lastAuthenticated']:
+                    usage[namespace] = service
+                usage[namespace]['totalAuthenticatedEntities'] = count_entities
+
+    for namespace, service in usage.items():
+        last_authenticated = service['lastAuthenticated']
+        dt_last_authenticated = datetime.datetime.fromtimestamp(last_authenticated / 1e3)
+        dt_starting = datetime.datetime.utcnow() - datetime.timedelta(days=90)
+        usage[namespace]['USED_LAST_90_DAYS'] = dt_last_authenticated > dt_starting
+
+    return usage
+
 
 class RoleSearch(Resource):
     """
@@ -28,30 +133,7 @@ class RoleSearch(Resource):
         self.reqparse = reqparse.RequestParser()
 
     def combine(self, aa):
-        del aa['count']
-        del aa['page']
-        del aa['total']
-
-        usage = dict()
-        for arn, services in aa.items():
-            for service in services:
-                namespace = service.get('serviceNamespace')
-                last_authenticated = service.get('lastAuthenticated')
-                if namespace not in usage:
-                    usage[namespace] = service
-                else:
-                    count_entities = usage[namespace]['totalAuthenticatedEntities'] + service['totalAuthenticatedEntities']
-                    if last_authenticated > usage[namespace]['lastAuthenticated']:
-                        usage[namespace] = service
-                    usage[namespace]['totalAuthenticatedEntities'] = count_entities
-
-        for namespace, service in usage.items():
-            last_authenticated = service['lastAuthenticated']
-            dt_last_authenticated = datetime.datetime.fromtimestamp(last_authenticated / 1e3)
-            dt_starting = datetime.datetime.utcnow() - datetime.timedelta(days=90)
-            usage[namespace]['USED_LAST_90_DAYS'] = dt_last_authenticated > dt_starting
-
-        return jsonify(usage)
+        return jsonify(combine_usage(aa))
 
     # undocumented convenience pass-through so we can query directly from browser
     @app.route('/advisors')
@@ -84,6 +166,13 @@ class RoleSearch(Resource):
             type: boolean
             description: combine access advisor data for all results [Default False]
             required: false
+          - name: as_of
+            in: query
+            type: string
+            description: |
+                return access advisor data as it was at this time, in epoch
+                milliseconds or ISO 8601 (UTC). Requires USAGE_HISTORY.
+            required: false
           - name: query
             in: body
             schema:
@@ -139,26 +228,47 @@ class RoleSearch(Resource):
           400:
             description: Bad request - error message in body
         """
+        args, as_of = self._parse_args()
+        items = self._search(args['phrase'], args['arn'], args['regex'], args['page'], args['count'])
+
+        combine = args['combine'].lower() == 'true'
+        if combine and items.total > len(items.items):
+            abort(400, "Error: Please specify a count of at least {}.".format(items.total))
+
+        if as_of is None and not combine:
+            return self._page_response(items)
+
+        values = dict(page=items.page, total=items.total, count=len(items.items))
+        values.update(self._usage(items.items, as_of))
+        if combine:
+            return self.combine(values)
+
+        return _json_response(values)
+
+    def _parse_args(self):
+        """Return the request's arguments and its as_of (epoch milliseconds or None), or abort with 400."""
         self.reqparse.add_argument('page', type=int, default=1)
         self.reqparse.add_argument('count', type=int, default=30)
         self.reqparse.add_argument('combine', type=str, default='false')
         self.reqparse.add_argument('phrase', default=None)
         self.reqparse.add_argument('regex', default=None)
         self.reqparse.add_argument('arn', default=None, action='append')
+        self.reqparse.add_argument('as_of', default=None)
         try:
             args = self.reqparse.parse_args()
+            as_of = args.pop('as_of', None)
+            if as_of is not None:
+                as_of = _parse_as_of(as_of)
         except Exception as e:
             abort(400, str(e))
 
-        page = args.pop('page')
-        count = args.pop('count')
-        combine = args.pop('combine', 'false')
-        combine = combine.lower() == 'true'
-        phrase = args.pop('phrase', '')
-        arns = args.pop('arn', [])
-        regex = args.pop('regex', '')
-        items = None
+        if as_of is not None and not current_app.config.get('USAGE_HISTORY'):
+            abort(400, 'as_of requires USAGE_HISTORY to be enabled.')
+        return args, as_of
 
+    @staticmethod
+    def _search(phrase, arns, regex, page, count):
+        """Return the page of principals matching the filters."""
         # default unfiltered query
         query = AWSIAMObject.query
 
@@ -179,27 +289,352 @@ class RoleSearch(Resource):
 
         if not items:
             items = AWSIAMObject.query.paginate(page, count)
+        return items
+
+    @staticmethod
+    def _page_response(items):
+        """The current usage of a page of principals, from their stored documents."""
+        documents = PrincipalUsage.documents([item.id for item in items.items])
+        body = ['"page": {}, "total": {}, "count": {}'.format(items.page, items.total, len(items.items))]
+        body.extend('{}: {}'.format(fastjson.dumps(item.arn), documents[item.id]) for item in items.items)
+        return Response('{{{}}}\n'.format(', '.join(body)), mimetype='application/json')
+
+    @staticmethod
+    def _usage(items, as_of):
+        """Return {arn: [usage entry, ...]} for these principals, now or as of a point in time."""
+        services = AdvisorService.lookup()
+        values = {}
+        if as_of is None:
+            usage = AdvisorData.for_items([item.id for item in items])
+            for item in items:
+                values[item.arn] = [usage_entry(services, *row, lastUpdated=item.lastUpdated)
+                                    for row in usage.get(item.id, [])]
+        else:
+            history = AdvisorHistory.as_of([item.arn for item in items], as_of)
+            for item in items:
+                values[item.arn] = [usage_entry(services, observed.service_id, observed.lastAuthenticated,
+                                                observed.lastAuthenticatedEntity, observed.totalAuthenticatedEntities,
+                                                datetime.datetime.utcfromtimestamp(observed.observedAt / 1e3))
+                                    for observed in history.get(item.arn, [])]
+        return values
+
+
+def _rollup_values(rollup, *names):
+    """Serialize the counters shared by the rollup tables, plus the named extra columns."""
+    names = names + ('principalCount', 'usedCount') + tuple(name for name, _ in ROLLUP_WINDOWS) + (
+        'lastAuthenticated', 'refreshedAt')
+    return {name: getattr(rollup, name) for name in names}
+
+
+class AccountSummary(Resource):
+    """
+    Access Advisor usage for one account, summarized per service.
+    """
+    def get(self, account_number):
+        """Get the usage summary for an account
+        Returns per-service principal counts and last use for an account, from the rollup refreshed after each collection
+        ---
+        produces:
+          - 'application/json'
+        parameters:
+          - name: account_number
+            in: path
+            type: string
+            required: true
+        responses:
+          200:
+            description: |
+                accountNumber, principalCount and lastCollected, plus services keyed by namespace with
+                serviceName, principalCount, usedCount (any access in the past 365 days), used30Days,
+                used90Days, lastAuthenticated and refreshedAt
+          404:
+            description: No data for this account
+        """
+        rollups = AccountServiceRollup.query.filter(AccountServiceRollup.accountNumber == account_number).all()
+        collection = AccountCollection.query.get(account_number)
+        if not rollups and not collection:
+            abort(404, 'No data for account {}'.format(account_number))
+
+        services = AdvisorService.lookup()
+        values = dict(accountNumber=account_number,
+                      principalCount=collection.principalCount if collection else None,
+                      lastCollected=collection.lastCollected if collection else None,
+                      services={})
+        for rollup in rollups:
+            service_name, service_namespace = services[rollup.service_id]
+            values['services'][service_namespace] = dict(_rollup_values(rollup), serviceName=service_name)
+        return _json_response(values)
+
+
+class ServiceSummary(Resource):
+    """
+    Access Advisor usage per service across all accounts.
+    """
+    def get(self, namespace=None):
+        """Get the usage summary for services
+        Returns account and principal counts and last use per service namespace, optionally for a single namespace
+        ---
+        produces:
+          - 'application/json'
+        parameters:
+          - name: namespace
+            in: path
+            type: string
+            required: false
+        responses:
+          200:
+            description: |
+                services keyed by namespace with serviceName, accountCount, usedAccountCount,
+                principalCount, usedCount, used30Days, used90Days, lastAuthenticated and refreshedAt
+          404:
+            description: Unknown service namespace
+        """
+        query = db.session.query(ServiceRollup, AdvisorService).join(
+            AdvisorService, ServiceRollup.service_id == AdvisorService.id)
+        if namespace is not None:
+            query = query.filter(AdvisorService.serviceNamespace == namespace)
 
-        values = dict(page=items.page, total=items.total, count=len(items.items))
-        for item in items.items:
-            item_values = []
-            for advisor_data in item.usage:
-                item_values.append(dict(
-                    lastAuthenticated=advisor_data.lastAuthenticated,
-                    serviceName=advisor_data.serviceName,
-                    serviceNamespace=advisor_data.serviceNamespace,
-                    lastAuthenticatedEntity=advisor_data.lastAuthenticatedEntity,
-                    totalAuthenticatedEntities=advisor_data.totalAuthenticatedEntities,
-                    lastUpdated=item.lastUpdated
-                ))
-            values[item.arn] = item_values
+        values = {}
+        for rollup, service in query:
+            values[service.serviceNamespace] = dict(_rollup_values(rollup, 'accountCount', 'usedAccountCount'),
+                                                    serviceName=service.serviceName)
+        if namespace is not None and not values:
+            abort(404, 'No data for service {}'.format(namespace))
+        return _json_response(values)
 
-        if combine and items.total > len(items.items):
-            abort(400, "Error: Please specify a count of at least {}.".format(items.total))
-        elif combine:
-            return self.combine(values)
 
-        return jsonify(values)
+class UnusedServices(Resource):
+    """
+    Services each principal has not used within a window, for least-privilege cleanup.
+    """
+    def __init__(self):
+        super(UnusedServices, self).__init__()
+        self.reqparse = reqparse.RequestParser()
+
+    def get(self):
+        """Get unused services
+        Returns, per principal, the services not used in the last `days` days
+        ---
+        produces:
+          - 'application/json'
+        parameters:
+          - name: days
+            in: query
+            type: integer
+            description: services unused for at least this many days [Default 90]
+            required: false
+          - name: account
+            in: query
+            type: array
+            items:
+              type: string
+            collectionFormat: multi
+            description: only principals in these accounts
+            required: false
+          - name: namespace
+            in: query
+            type: array
+            items:
+              type: string
+            collectionFormat: multi
+            description: only these service namespaces
+            required: false
+          - name: arn
+            in: query
+            type: array
+            items:
+              type: string
+            collectionFormat: multi
+            description: only these principals
+            required: false
+          - name: after
+            in: query
+            type: string
+            description: the `next` of the previous page [Default the first page]
+            required: false
+          - name: count
+            in: query
+            type: integer
+            description: entries per page [Default 1000]
+            required: false
+        responses:
+          200:
+            description: |
+                days, after, next (pass as after for the following page), count, more (whether a further
+                page exists) and unused, keyed by ARN, each a list of serviceName, serviceNamespace and
+                lastAuthenticated (0 if never used)
+          400:
+            description: Bad request - error message in body
+        """
+        self.reqparse.add_argument('days', type=int, default=90)
+        self.reqparse.add_argument('account', default=None, action='append')
+        self.reqparse.add_argument('namespace', default=None, action='append')
+        self.reqparse.add_argument('arn', default=None, action='append')
+        self.reqparse.add_argument('after', default=None)
+        self.reqparse.add_argument('count', type=int, default=1000)
+        try:
+            args = self.reqparse.parse_args()
+            after = _parse_cursor(args['after']) if args['after'] else None
+        except Exception as e:
+            abort(400, str(e))
+        if args['days'] < 0 or args['count'] < 1:
+            abort(400, 'days must be non-negative and count positive.')
+
+        count = args['count']
+        cutoff = int(time.time() * 1000) - args['days'] * MILLISECONDS_PER_DAY
+        # Fetch one extra entry to tell whether there is another page.
+        rows = AdvisorData.unused(cutoff, args['account'], args['namespace'], args['arn'], after=after,
+                                  limit=count + 1)
+
+        unused = {}
+        for _, _, arn, service_name, service_namespace, last_authenticated in rows[:count]:
+            unused.setdefault(arn, []).append(dict(serviceName=service_name,
+                                                   serviceNamespace=service_namespace,
+                                                   lastAuthenticated=last_authenticated))
+        last = rows[:count][-1] if rows else None
+        return _json_response(dict(days=args['days'], after=args['after'],
+                                   next='{}:{}'.format(last[0], last[1]) if last else args['after'],
+                                   count=min(len(rows), count), more=len(rows) > count, unused=unused))
+
+
+class BulkLookup(Resource):
+    """
+    Look up Access Advisor data for a large list of ARNs.
+    """
+    def post(self):
+        """Get access advisor data for many ARNs
+        Returns access advisor information for every ARN in the body, streamed as it is read
+        ---
+        consumes:
+          - 'application/json'
+        produces:
+          - 'application/json'
+        parameters:
+          - name: query
+            in: body
+            schema:
+              type: object
+              properties:
+                arns:
+                  type: array
+                  items:
+                    type: string
+            description: |
+                the ARNs to look up, matched exactly. A bare JSON list of ARNs is also accepted.
+                At most BULK_LOOKUP_MAX_ARNS (default 100000) per request.
+        responses:
+          200:
+            description: |
+                results, keyed by ARN, each a list of AdvisorData as returned by /advisors,
+                and missing, the ARNs with no data
+          400:
+            description: Bad request - error message in body
+        """
+        body = request.get_json(silent=True)
+        arns = body.get('arns') if isinstance(body, dict) else body
+        if not isinstance(arns, list) or not all(isinstance(arn, str) for arn in arns):
+            abort(400, 'Expected a JSON list of ARNs, or an object with an "arns" list.')
+
+        max_arns = current_app.config.get('BULK_LOOKUP_MAX_ARNS', DEFAULT_BULK_LOOKUP_MAX_ARNS)
+        if len(arns) > max_arns:
+            abort(400, 'At most {} ARNs may be looked up per request, got {}.'.format(max_arns, len(arns)))
+
+        # Keep the caller's order, drop repeats.
+        arns = list(dict.fromkeys(arns))
+
+        def generate():
+            yield '{"results": {'
+            missing = []
+            first = True
+            for start in range(0, len(arns), QUERY_CHUNK_SIZE):
+                chunk = arns[start:start + QUERY_CHUNK_SIZE]
+                items = {arn: item_id for item_id, arn, _ in AWSIAMObject.find_many(chunk)}
+                documents = PrincipalUsage.documents(list(items.values()))
+                for arn in chunk:
+                    if arn not in items:
+                        missing.append(arn)
+                        continue
+                    yield '{}{}: {}'.format('' if first else ', ', fastjson.dumps(arn), documents[items[arn]])
+                    first = False
+            yield '}}, "missing": {}}}\n'.format(fastjson.dumps(missing))
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+class ChangeFeed(Resource):
+    """
+    What collection changed since a consumer's last sync, in the order it was recorded.
+    """
+    def __init__(self):
+        super(ChangeFeed, self).__init__()
+        self.reqparse = reqparse.RequestParser()
+
+    def get(self):
+        """Get changes since a sequence number
+        Returns the change_log entries after `since`, oldest first. Pass the returned `next` as `since` to continue.
+        ---
+        produces:
+          - 'application/json'
+        parameters:
+          - name: since
+            in: query
+            type: integer
+            description: last sequence number already seen [Default 0, the start of the feed]
+            required: false
+          - name: count
+            in: query
+            type: integer
+            description: entries per page [Default 1000, at most CHANGES_MAX_COUNT (default 10000)]
+            required: false
+        responses:
+          200:
+            description: |
+                since, next (the seq of the last entry returned, or since when there are none), more
+                (whether further entries exist) and changes, each with seq, kind (principal, service,
+                usage or deleted), observedAt, and as applicable arn, serviceName, serviceNamespace,
+                previous (null for a new entry) and lastAuthenticated
+          400:
+            description: Bad request - error message in body
+          410:
+            description: |
+                Entries after since have expired (see CHANGE_LOG_RETENTION_DAYS). Resync from /advisors,
+                then continue from the oldest seq kept, given in the error message, minus one
+        """
+        self.reqparse.add_argument('since', type=int, default=0)
+        self.reqparse.add_argument('count', type=int, default=1000)
+        try:
+            args = self.reqparse.parse_args()
+        except Exception as e:
+            abort(400, str(e))
+        max_count = current_app.config.get('CHANGES_MAX_COUNT', DEFAULT_CHANGES_MAX_COUNT)
+        if args['since'] < 0 or not 1 <= args['count'] <= max_count:
+            abort(400, 'since must be non-negative and count between 1 and {}.'.format(max_count))
+
+        since, count = args['since'], args['count']
+        oldest = ChangeLog.oldest()
+        if oldest is not None and since < oldest - 1:
+            abort(410, 'Entries after {} have expired; the oldest kept is {}. Resync from /api/1/advisors, then '
+                       'continue from since={}.'.format(since, oldest, oldest - 1))
+        # Fetch one extra entry to tell whether there is more.
+        rows = ChangeLog.since(since, count + 1)
+
+        changes = []
+        for change in rows[:count]:
+            entry = dict(seq=change.seq, kind=change.kind, observedAt=change.observedAt)
+            if change.item_id is not None:
+                entry['arn'] = change.arn
+            if change.service_id is not None:
+                entry.update(serviceName=change.serviceName, serviceNamespace=change.serviceNamespace)
+            if change.kind == ChangeLog.USAGE_CHANGED:
+                entry.update(previous=change.previous, lastAuthenticated=change.lastAuthenticated)
+            changes.append(entry)
+        return _json_response(dict(since=since, next=changes[-1]['seq'] if changes else since,
+                                   more=len(rows) > count, changes=changes))
 
 
 api.add_resource(RoleSearch, '/advisors')
+api.add_resource(BulkLookup, '/advisors/bulk')
+api.add_resource(UnusedServices, '/unused')
+api.add_resource(AccountSummary, '/summary/accounts/<account_number>')
+api.add_resource(ServiceSummary, '/summary/services', '/summary/services/<namespace>')
+api.add_resource(ChangeFeed, '/changes')
@@ -0,0 +1,188 @@
+"""
+Load comparison of the sync (gunicorn) and async (uvicorn) API servers.
+
+Seeds a SQLite database with synthetic principals, starts each server in turn
+on it and drives it with concurrent clients issuing a mix of slow regex
+searches and fast single-ARN lookups. Reports throughput and latency
+percentiles per request kind.
+
+    python benchmarks/api_concurrency.py --principals 20000 --clients 32 --duration 20 \\
+        --sync-workers 4 --async-workers 1
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from aardvark import create_app, db
+from aardvark.manage import persist_aa_data
+from aardvark.updater.records import ServiceUsage
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--principals', type=int, default=5000)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client connections')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to drive each server')
+    parser.add_argument('--slow-fraction', type=float, default=0.2,
+                        help='fraction of requests that are full-table regex searches')
+    parser.add_argument('--sync-workers', type=int, default=4)
+    parser.add_argument('--async-workers', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+
+def seed(db_path, principals, services):
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    app.logger.setLevel(logging.WARNING)
+    rng = random.Random(0)
+    arns = ['arn:aws:iam::{:012d}:role/role{}'.format(100000000000 + i % 20, i) for i in range(principals)]
+    with app.app_context():
+        db.create_all()
+        for start in range(0, len(arns), 1000):
+            persist_aa_data(app, {arn: [ServiceUsage('svc{}'.format(s), 'Service {}'.format(s),
+                                                     rng.choice((0, 1559390400000)), arn, 1)
+                                        for s in range(services)] for arn in arns[start:start + 1000]})
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return arns
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+def drive(port, arns, args):
+    """Run the clients against the server on port and return per-kind latencies and errors."""
+    latencies = {'slow': [], 'fast': []}
+    errors = []
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+        while time.time() < deadline:
+            if rng.random() < args.slow_fraction:
+                kind, query = 'slow', {'regex': '.*role{}.*'.format(rng.randint(0, 9)), 'count': 30}
+            else:
+                kind, query = 'fast', {'arn': rng.choice(arns)}
+            start = time.time()
+            try:
+                conn.request('GET', '/api/1/advisors?' + urlencode(query))
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+                ok = False
+            with lock:
+                if ok:
+                    latencies[kind].append(time.time() - start)
+                else:
+                    errors.append(kind)
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))] if values else None
+
+
+def run_server(name, command, workdir, arns, args):
+    port = free_port()
+    process = subprocess.Popen([part.format(port=port) for part in command], cwd=workdir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        latencies, errors = drive(port, arns, args)
+    finally:
+        process.terminate()
+        process.wait()
+
+    result = dict(server=name, errors=len(errors))
+    for kind, values in latencies.items():
+        result[kind] = dict(requests=len(values),
+                            per_second=round(len(values) / args.duration, 1),
+                            p50_ms=round(percentile(values, 50) * 1000, 1) if values else None,
+                            p99_ms=round(percentile(values, 99) * 1000, 1) if values else None)
+    return result
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(workdir, 'aardvark.db')
+        with open(os.path.join(workdir, 'config.py'), 'w') as f:
+            f.write('SQLALCHEMY_DATABASE_URI = "sqlite:///{}"\n'
+                    'SQLALCHEMY_TRACK_MODIFICATIONS = False\n'
+                    'LOG_LEVEL = "WARNING"\n'.format(db_path))
+        arns = seed(db_path, args.principals, args.services)
+
+        bindir = os.path.dirname(sys.executable)
+        servers = [
+            ('gunicorn sync x{}'.format(args.sync_workers),
+             [os.path.join(bindir, 'gunicorn'), '-w', str(args.sync_workers), '-b', '127.0.0.1:{port}',
+              'aardvark:create_app()']),
+            ('uvicorn async x{}'.format(args.async_workers),
+             [os.path.join(bindir, 'uvicorn'), '--factory', 'aardvark.asgi:create_asgi_app', '--workers',
+              str(args.async_workers), '--port', '{port}', '--log-level', 'warning', '--no-access-log']),
+        ]
+        results = [run_server(name, command, workdir, arns, args) for name, command in servers]
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print('{} principals x {} services, {} clients for {}s, {:.0%} regex searches'.format(
+        args.principals, args.services, args.clients, args.duration, args.slow_fraction))
+    for result in results:
+        print(result['server'] + ('  ({} errors)'.format(result['errors']) if result['errors'] else ''))
+        for kind in ('fast', 'slow'):
+            print('  {:<5} {per_second:>8} req/s  p50 {p50_ms:>8} ms  p99 {p99_ms:>8} ms'.format(kind, **result[kind]))
+
+
+if __name__ == '__main__':
+    main()
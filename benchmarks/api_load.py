@@ -0,0 +1,174 @@
+"""
+/api/1/advisors latency and query counts at production scale.
+
+Seeds a scratch SQLite database with ``aardvark seed`` data (or, with
+--db-uri, uses an existing database, e.g. a PostgreSQL one seeded at full
+scale), then replays a shuffled mix of searches through the Flask app in this
+process:
+
+    phrase     substring match on a team-app name stem, first page
+    regex      regular expression over every ARN, first page
+    arns       lookup of --arn-list sampled ARNs
+    combine    phrase match on one principal's name, usage combined
+    deep_page  unfiltered listing, one of the last 10% of pages
+
+Reports p50/p99 latency and the SQL statements issued per request for each
+kind. Requests don't go through a server, so the latencies are the app's and
+the database's alone.
+
+    python benchmarks/api_load.py --accounts 20 --principals 2500 --namespaces 40 --requests 1000
+    python benchmarks/api_load.py --db-uri postgresql://aardvark@localhost/aardvark --requests 2000
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from aardvark import create_app, db
+from aardvark.manage import seed
+from aardvark.model import AWSIAMObject, AdvisorData
+
+from api_concurrency import percentile
+
+
+KINDS = ('phrase', 'regex', 'arns', 'combine', 'deep_page')
+DEFAULT_MIX = 'phrase=3,regex=1,arns=3,combine=1,deep_page=2'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db-uri', default=None, help='query this database instead of seeding a scratch one')
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--principals', type=int, default=1000, help='principals per account')
+    parser.add_argument('--namespaces', type=int, default=50)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--requests', type=int, default=500, help='requests in the mix, after one warm-up each')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='relative weight of each kind')
+    parser.add_argument('--count', type=int, default=30, help='page size')
+    parser.add_argument('--arn-list', type=int, default=10, help='ARNs per arns lookup')
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+
+def make_app(db_uri):
+    app = create_app(api_docs=False)
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    app.logger.setLevel(logging.CRITICAL)
+    return app
+
+
+class QueryCounter(object):
+    """Counts the SQL statements executed by every engine in this process."""
+
+    def __init__(self):
+        self.count = 0
+        event.listen(Engine, 'before_cursor_execute', self._executed)
+
+    def _executed(self, *args):
+        self.count += 1
+
+
+def stem(arn):
+    """The principal's name without its trailing number, e.g. payments-api for role/app/payments-api-12."""
+    return re.sub(r'-?\d+$', '', arn.rsplit('/', 1)[-1]) or arn.rsplit('/', 1)[-1]
+
+
+def queries(kind, rng, sample, total, args):
+    arn = rng.choice(sample)
+    if kind == 'phrase':
+        return {'phrase': stem(arn), 'count': args.count}
+    if kind == 'regex':
+        return {'regex': '.*/{}-[0-9]*{}$'.format(re.escape(stem(arn)), rng.randint(0, 9)), 'count': args.count}
+    if kind == 'arns':
+        return {'arn': rng.sample(sample, min(args.arn_list, len(sample))), 'count': args.arn_list}
+    if kind == 'combine':
+        return {'phrase': arn.rsplit('/', 1)[-1], 'combine': 'true', 'count': 1000}
+    pages = max(1, -(-total // args.count))
+    return {'page': rng.randint(max(1, pages - pages // 10), pages), 'count': args.count}
+
+
+def run(app, args):
+    rng = random.Random(0)
+    with app.app_context():
+        total = AWSIAMObject.query.count()
+        rows = AdvisorData.query.count()
+        ids = rng.sample(range(1, total + 1), min(total, 1000))
+        sample = [arn for arn, in db.session.query(AWSIAMObject.arn).filter(AWSIAMObject.id.in_(ids))]
+        db.session.remove()
+
+    weights = dict((kind, float(weight)) for kind, weight in (part.split('=') for part in args.mix.split(',')))
+    mix = list(KINDS) + rng.choices(KINDS, weights=[weights.get(kind, 0) for kind in KINDS], k=args.requests)
+    client = app.test_client()
+    counter = QueryCounter()
+    latencies, query_counts, errors = (collections.defaultdict(list) for _ in range(3))
+    for index, kind in enumerate(mix):
+        query = queries(kind, rng, sample, total, args)
+        before = counter.count
+        start = time.time()
+        response = client.get('/api/1/advisors', query_string=query)
+        elapsed = time.time() - start
+        if index < len(KINDS):
+            continue  # warm-up
+        if response.status_code != 200:
+            errors[kind].append(response.status_code)
+            continue
+        latencies[kind].append(elapsed)
+        query_counts[kind].append(counter.count - before)
+
+    results = []
+    for kind in KINDS:
+        values, counts = latencies[kind], query_counts[kind]
+        results.append(dict(kind=kind, requests=len(values), errors=len(errors[kind]),
+                            p50_ms=round(percentile(values, 50) * 1000, 1) if values else None,
+                            p99_ms=round(percentile(values, 99) * 1000, 1) if values else None,
+                            queries_per_request=round(sum(counts) / float(len(counts)), 1) if counts else None,
+                            max_queries=max(counts) if counts else None))
+    return dict(principals=total, advisor_data_rows=rows, results=results)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = None
+    try:
+        if args.db_uri:
+            app = make_app(args.db_uri)
+        else:
+            workdir = tempfile.mkdtemp()
+            app = make_app('sqlite:///' + os.path.join(workdir, 'aardvark.db'))
+            start = time.time()
+            with app.app_context():
+                db.create_all()
+                seed(args.accounts, args.principals, args.namespaces, args.skew, 0, 1000)
+                db.session.remove()
+            seed_seconds = time.time() - start
+        report = run(app, args)
+    finally:
+        if workdir:
+            shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print('{principals} principals, {advisor_data_rows} advisor_data rows'.format(**report) +
+          ('' if args.db_uri else ' (seeded in {:.1f}s)'.format(seed_seconds)))
+    for result in report['results']:
+        print('  {kind:<10} {requests:>6} requests  p50 {p50_ms!s:>8} ms  p99 {p99_ms!s:>8} ms  '
+              '{queries_per_request!s:>5} queries/request (max {max_queries})'.format(**result) +
+              ('  {} failed'.format(result['errors']) if result['errors'] else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Worker memory and cold first-request latency of ``aardvark start_api``.
+
+Starts the API on a seeded SQLite database with the production serving profile
+(preload and warm-up, the default) and without it, then reports each worker's
+proportional set size (memory not shared with the other processes is counted in
+full, shared pages are split between their users) and the latency of the first
+request each fresh connection makes. Linux only, it reads /proc.
+
+    python benchmarks/api_startup.py --workers 4
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from api_concurrency import free_port, seed, wait_for
+
+
+PROFILES = {
+    'preload + warm-up': 'GUNICORN_PRELOAD = True\nAPI_WARM_UP = True\n',
+    'lazy workers': 'GUNICORN_PRELOAD = False\nAPI_WARM_UP = False\n',
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--principals', type=int, default=1000)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+
+def children(pid):
+    with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def pss_kib(pid):
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1])
+
+
+def first_requests(port, count):
+    """Latency of one request on each of `count` new connections, made at once so they spread over the workers."""
+    connections = [http.client.HTTPConnection('127.0.0.1', port, timeout=60) for _ in range(count)]
+    starts = []
+    for conn in connections:
+        starts.append(time.time())
+        conn.request('GET', '/api/1/advisors?count=30')
+    latencies = []
+    for conn, start in zip(connections, starts):
+        conn.getresponse().read()
+        latencies.append(time.time() - start)
+        conn.close()
+    return latencies
+
+
+def run(name, settings, workdir, args):
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = "sqlite:///{}"\n'
+                'SQLALCHEMY_TRACK_MODIFICATIONS = False\n'
+                'LOG_LEVEL = "WARNING"\n{}'.format(os.path.join(workdir, 'aardvark.db'), settings))
+
+    port = free_port()
+    aardvark = os.path.join(os.path.dirname(sys.executable), 'aardvark')
+    start = time.time()
+    process = subprocess.Popen([aardvark, 'start_api', '-w', str(args.workers), '-b', '127.0.0.1:{}'.format(port)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(port)
+        # Wait for every worker to be forked before measuring.
+        while len(children(process.pid)) < args.workers:
+            time.sleep(0.1)
+        time.sleep(1)
+        listening = time.time() - start
+        latencies = first_requests(port, args.workers)
+        warm = first_requests(port, args.workers)
+        workers = children(process.pid)
+        worker_pss = [pss_kib(pid) for pid in workers]
+        master_pss = pss_kib(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+
+    return dict(profile=name,
+                listening_seconds=round(listening, 2),
+                first_request_ms=dict(max=round(max(latencies) * 1000, 1),
+                                      mean=round(sum(latencies) / len(latencies) * 1000, 1)),
+                warm_request_ms=round(sum(warm) / len(warm) * 1000, 1),
+                worker_pss_mib=round(sum(worker_pss) / len(worker_pss) / 1024.0, 1),
+                total_pss_mib=round((sum(worker_pss) + master_pss) / 1024.0, 1))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp()
+    try:
+        seed(os.path.join(workdir, 'aardvark.db'), args.principals, args.services)
+        results = [run(name, settings, workdir, args) for name, settings in sorted(PROFILES.items())]
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{} workers'.format(args.workers))
+    for result in results:
+        print('  {profile:<18} first request mean {first_request_ms[mean]:>6} ms, max {first_request_ms[max]:>6} ms '
+              '(warm {warm_request_ms:>6} ms)  PSS per worker {worker_pss_mib:>5} MiB, total {total_pss_mib:>6} MiB'
+              .format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+End-to-end collector benchmark.
+
+Runs ``manage.update`` against the FakeIAM stand-in for each database URI given
+and reports accounts per minute, IAM API calls per principal and persisted
+advisor rows per second. Every run starts from freshly created tables, so point
+--db-uri at a scratch database.
+
+    python benchmarks/collector.py --accounts 8 --principals 50,500,2000 \\
+        --job-latency exp:2 --page-size 100 --throttle-rate 0.01 \\
+        --db-uri sqlite:////tmp/aardvark-bench.db \\
+        --db-uri postgresql://localhost/aardvark_bench
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from fake_iam import FakeIAM, latency_distribution
+
+from aardvark import create_app, db
+from aardvark import manage
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=4, help='number of simulated accounts')
+    parser.add_argument('--principals', default='100',
+                        help='principals per account; a comma separated list is cycled across accounts')
+    parser.add_argument('--services', type=int, default=250, help='services returned per principal')
+    parser.add_argument('--used-fraction', type=float, default=0.2,
+                        help='fraction of services with a LastAuthenticated value')
+    parser.add_argument('--job-latency', default='fixed:0',
+                        help='Access Advisor job latency (fixed:S, uniform:LO,HI, exp:MEAN, lognormal:MU,SIGMA)')
+    parser.add_argument('--call-latency', default='fixed:0', help='per API call latency, same format')
+    parser.add_argument('--page-size', type=int, default=100, help='items per page for list and job result calls')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability that a call is throttled')
+    parser.add_argument('--threads', type=int, default=manage.DEFAULT_NUM_THREADS, help='NUM_THREADS for the run')
+    parser.add_argument('--chunk-size', type=int, default=None, help='ACCOUNT_CHUNK_SIZE for the run')
+    parser.add_argument('--db-uri', action='append', dest='db_uris',
+                        help='database to benchmark against; may be repeated (default: a temporary SQLite file)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='keep the application log output')
+    return parser.parse_args(argv)
+
+
+def build_fake_iam(args):
+    counts = [int(count) for count in args.principals.split(',')]
+    account_numbers = ['{:012d}'.format(100000000000 + i) for i in range(args.accounts)]
+    principals = {number: counts[i % len(counts)] for i, number in enumerate(account_numbers)}
+
+    fake = FakeIAM(
+        principals=principals.get,
+        services=args.services,
+        used_fraction=args.used_fraction,
+        job_latency=latency_distribution(args.job_latency),
+        call_latency=latency_distribution(args.call_latency),
+        page_size=args.page_size,
+        throttle_rate=args.throttle_rate,
+        seed=args.seed,
+    )
+    return fake, account_numbers
+
+
+def run(db_uri, args):
+    """Run one collection against db_uri and return the measurements."""
+    from aardvark.model import AWSIAMObject, AdvisorData
+
+    fake, account_numbers = build_fake_iam(args)
+
+    app = create_app()
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=db_uri,
+        NUM_THREADS=args.threads,
+        ACCOUNT_CHUNK_SIZE=args.chunk_size,
+        ROLENAME='Aardvark',
+        IAM_CLIENT_FACTORY=fake.client,
+    )
+    if not args.verbose:
+        app.logger.setLevel(logging.WARNING)
+
+    persist_times = []
+    persist_lock = threading.Lock()
+    persist_aa_data = manage.persist_aa_data
+
+    def timed_persist_aa_data(app, aa_data):
+        start = time.time()
+        persist_aa_data(app, aa_data)
+        with persist_lock:
+            persist_times.append(time.time() - start)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        manage.persist_aa_data = timed_persist_aa_data
+        try:
+            start = time.time()
+            manage.update(','.join(account_numbers), 'all')
+            elapsed = time.time() - start
+        finally:
+            manage.persist_aa_data = persist_aa_data
+
+        principals = AWSIAMObject.query.count()
+        rows = AdvisorData.query.count()
+        db.session.remove()
+        db.get_engine(app).dispose()
+
+    stats = fake.stats()
+    persist_seconds = sum(persist_times)
+    return dict(
+        db_uri=db_uri,
+        accounts=len(account_numbers),
+        principals=principals,
+        rows=rows,
+        elapsed_seconds=round(elapsed, 3),
+        persist_seconds=round(persist_seconds, 3),
+        accounts_per_minute=round(len(account_numbers) / elapsed * 60, 2),
+        api_calls_per_principal=round(stats['total_calls'] / max(fake.principal_count(), 1), 2),
+        db_rows_per_second=round(rows / persist_seconds, 1) if persist_seconds else None,
+        api_calls=stats['calls'],
+        throttles=stats['throttles'],
+    )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    db_uris = args.db_uris or ['sqlite:///{}'.format(os.path.join(tempfile.mkdtemp(), 'aardvark-bench.db'))]
+
+    results = [run(db_uri, args) for db_uri in db_uris]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print('{db_uri}\n'
+              '  accounts/min        {accounts_per_minute}\n'
+              '  API calls/principal {api_calls_per_principal} ({throttles} throttled)\n'
+              '  DB rows/sec         {db_rows_per_second} ({rows} rows, {persist_seconds}s persisting)\n'
+              '  wall time           {elapsed_seconds}s for {accounts} accounts, {principals} principals'
+              .format(**result))
+        for operation, count in sorted(result['api_calls'].items()):
+            print('    {:<36} {}'.format(operation, count))
+
+
+if __name__ == '__main__':
+    main()
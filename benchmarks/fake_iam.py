@@ -0,0 +1,211 @@
+"""
+In-process stand-in for the parts of the IAM API that Aardvark's collector uses.
+
+A FakeIAM instance holds the simulated inventory for any number of accounts and
+hands out per-account clients through its ``client`` method, which has the
+signature expected by the IAM_CLIENT_FACTORY config value. Principal counts,
+Access Advisor job latency, page sizes and the throttling rate are all
+configurable so collector runs can be reproduced without AWS credentials.
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import collections
+import datetime
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+# A handful of real namespaces; the remainder of the catalog is synthetic.
+KNOWN_NAMESPACES = [
+    ('Amazon S3', 's3'),
+    ('Amazon EC2', 'ec2'),
+    ('AWS Identity and Access Management', 'iam'),
+    ('AWS Security Token Service', 'sts'),
+    ('Amazon DynamoDB', 'dynamodb'),
+    ('Amazon Simple Queue Service', 'sqs'),
+    ('Amazon Simple Notification Service', 'sns'),
+    ('AWS Lambda', 'lambda'),
+    ('Amazon CloudWatch', 'cloudwatch'),
+    ('AWS Key Management Service', 'kms'),
+]
+
+PRINCIPAL_KINDS = ('role', 'user', 'policy', 'group')
+
+
+def latency_distribution(spec, rng=None):
+    """Build a zero-argument callable returning a latency in seconds.
+
+    Accepted specs are ``fixed:S``, ``uniform:LOW,HIGH``, ``exp:MEAN`` and
+    ``lognormal:MU,SIGMA``. A bare number is treated as ``fixed``.
+    """
+    rng = rng or random.Random()
+    kind, _, params = spec.partition(':')
+    if not params:
+        kind, params = 'fixed', kind
+    values = [float(value) for value in params.split(',')]
+
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda: rng.expovariate(1.0 / values[0]) if values[0] else 0.0
+    if kind == 'lognormal':
+        return lambda: rng.lognormvariate(values[0], values[1])
+    raise ValueError('Unknown latency distribution {}'.format(spec))
+
+
+class FakeIAM(object):
+    """
+    Simulated IAM service shared by every account client it creates.
+
+    :param principals: number of principals per account, or a callable taking
+        the account number and returning one
+    :param services: size of the service catalog returned for every principal
+    :param used_fraction: fraction of services with a LastAuthenticated value
+    :param job_latency: callable returning how long a GenerateServiceLastAccessedDetails
+        job stays IN_PROGRESS
+    :param call_latency: callable returning the round-trip time of every API call
+    :param page_size: maximum items per page for list and job result calls
+    :param throttle_rate: probability that any call is rejected with Throttling
+    """
+
+    class NoSuchEntityException(Exception):
+        pass
+
+    def __init__(self, principals=100, services=250, used_fraction=0.2, job_latency=None, call_latency=None,
+                 page_size=100, throttle_rate=0.0, seed=None):
+        self.principals = principals
+        self.used_fraction = used_fraction
+        self.job_latency = job_latency or (lambda: 0.0)
+        self.call_latency = call_latency or (lambda: 0.0)
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.seed = seed
+
+        self.catalog = list(KNOWN_NAMESPACES[:services])
+        for i in range(len(self.catalog), services):
+            self.catalog.append(('Synthetic Service {}'.format(i), 'svc{}'.format(i)))
+
+        self.calls = collections.Counter()
+        self.throttles = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._inventory = {}
+        self._jobs = {}
+
+    def client(self, account_number=None, **kwargs):
+        """IAM_CLIENT_FACTORY entry point."""
+        return FakeIAMClient(self, account_number)
+
+    def inventory(self, account_number):
+        """Return {kind: [arn, ...]} for an account, building it on first use."""
+        with self._lock:
+            if account_number not in self._inventory:
+                count = self.principals(account_number) if callable(self.principals) else self.principals
+                arns = {kind: [] for kind in PRINCIPAL_KINDS}
+                for i in range(count):
+                    kind = PRINCIPAL_KINDS[i % len(PRINCIPAL_KINDS)]
+                    arns[kind].append('arn:aws:iam::{}:{}/bench-{}-{}'.format(account_number, kind, kind, i))
+                self._inventory[account_number] = arns
+            return self._inventory[account_number]
+
+    def principal_count(self):
+        with self._lock:
+            return sum(len(arns) for account in self._inventory.values() for arns in account.values())
+
+    def stats(self):
+        with self._lock:
+            return dict(calls=dict(self.calls), total_calls=sum(self.calls.values()), throttles=self.throttles)
+
+    def _call(self, operation):
+        latency = self.call_latency()
+        if latency:
+            time.sleep(latency)
+        with self._lock:
+            self.calls[operation] += 1
+            throttled = self.throttle_rate and self._rng.random() < self.throttle_rate
+            if throttled:
+                self.throttles += 1
+        if throttled:
+            raise ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, operation)
+
+    def _page(self, items, marker):
+        start = int(marker or 0)
+        end = start + self.page_size
+        truncated = end < len(items)
+        return items[start:end], truncated, str(end) if truncated else None
+
+    def _start_job(self, arn):
+        with self._lock:
+            job_id = 'job-{}'.format(len(self._jobs))
+            self._jobs[job_id] = (arn, time.time() + self.job_latency())
+        return job_id
+
+    def _job_details(self, arn):
+        # Seed per ARN so repeated runs against the same FakeIAM see identical data.
+        rng = random.Random('{}:{}'.format(self.seed, arn))
+        now = datetime.datetime.utcnow()
+        details = []
+        for name, namespace in self.catalog:
+            detail = dict(ServiceName=name, ServiceNamespace=namespace, TotalAuthenticatedEntities=0)
+            if rng.random() < self.used_fraction:
+                detail['LastAuthenticated'] = now - datetime.timedelta(seconds=rng.randint(0, 365 * 86400))
+                detail['LastAuthenticatedEntity'] = arn
+                detail['TotalAuthenticatedEntities'] = 1
+            details.append(detail)
+        return details
+
+
+class FakeIAMClient(object):
+    """Per-account client exposing the boto3 IAM methods AccountToUpdate calls."""
+
+    def __init__(self, service, account_number):
+        self.service = service
+        self.account_number = account_number
+        self.exceptions = service
+
+    def _list(self, operation, kind, key, marker):
+        self.service._call(operation)
+        arns = self.service.inventory(self.account_number)[kind]
+        items, truncated, next_marker = self.service._page(arns, marker)
+        response = {key: [{'Arn': arn} for arn in items], 'IsTruncated': truncated}
+        if next_marker:
+            response['Marker'] = next_marker
+        return response
+
+    def list_roles(self, Marker=None, **kwargs):
+        return self._list('ListRoles', 'role', 'Roles', Marker)
+
+    def list_users(self, Marker=None, **kwargs):
+        return self._list('ListUsers', 'user', 'Users', Marker)
+
+    def list_policies(self, Marker=None, **kwargs):
+        return self._list('ListPolicies', 'policy', 'Policies', Marker)
+
+    def list_groups(self, Marker=None, **kwargs):
+        return self._list('ListGroups', 'group', 'Groups', Marker)
+
+    def generate_service_last_accessed_details(self, Arn):
+        self.service._call('GenerateServiceLastAccessedDetails')
+        inventory = self.service.inventory(self.account_number)
+        if not any(Arn in arns for arns in inventory.values()):
+            raise self.service.NoSuchEntityException(Arn)
+        return {'JobId': self.service._start_job(Arn)}
+
+    def get_service_last_accessed_details(self, JobId, Marker=None, **kwargs):
+        self.service._call('GetServiceLastAccessedDetails')
+        arn, ready_at = self.service._jobs[JobId]
+        if time.time() < ready_at:
+            return {'JobStatus': 'IN_PROGRESS'}
+
+        items, truncated, next_marker = self.service._page(self.service._job_details(arn), Marker)
+        response = {'JobStatus': 'COMPLETED', 'ServicesLastAccessed': items, 'IsTruncated': truncated}
+        if next_marker:
+            response['Marker'] = next_marker
+        return response
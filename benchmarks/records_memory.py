@@ -0,0 +1,73 @@
+"""
+Memory benchmark for collected Access Advisor results.
+
+Builds one account's worth of results twice, as the raw botocore
+ServicesLastAccessed dicts the collector used to hold and as the compact
+ServiceUsage records it holds now, and reports the memory each takes.
+
+    python benchmarks/records_memory.py --principals 5000 --services 250
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import gc
+import tracemalloc
+
+from fake_iam import FakeIAM
+
+from aardvark.updater.records import ServiceUsage
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--principals', type=int, default=2000)
+    parser.add_argument('--services', type=int, default=250)
+    parser.add_argument('--used-fraction', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fake = FakeIAM(principals=args.principals, services=args.services, used_fraction=args.used_fraction)
+    account_number = '100000000000'
+    arns = [arn for kind in fake.inventory(account_number).values() for arn in kind]
+
+    # Each response is parsed into new dicts with their own key and value strings, as botocore does.
+    def fresh(value):
+        return (value + '.')[:-1] if isinstance(value, str) else value
+
+    def parsed(arn):
+        return [{fresh(key): fresh(value) for key, value in detail.items()} for detail in fake._job_details(arn)]
+
+    def raw():
+        return {arn: parsed(arn) for arn in arns}
+
+    def compact():
+        return {arn: [ServiceUsage.from_detail(detail) for detail in parsed(arn)] for arn in arns}
+
+    raw_data, raw_bytes = measure(raw)
+    del raw_data
+    compact_data, compact_bytes = measure(compact)
+
+    entries = args.principals * args.services
+    print('{} principals x {} services = {} entries'.format(args.principals, args.services, entries))
+    print('  raw dicts         {:>10.1f} MiB  {:>6.0f} bytes/entry'.format(raw_bytes / 2.0 ** 20, raw_bytes / entries))
+    print('  ServiceUsage      {:>10.1f} MiB  {:>6.0f} bytes/entry'.format(
+        compact_bytes / 2.0 ** 20, compact_bytes / entries))
+    print('  reduction         {:>10.1f}x'.format(raw_bytes / float(compact_bytes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Replay a recorded collection run offline.
+
+Runs ``manage.update`` for every account in an IAM recording (written by a run
+with IAM_RECORD_FILE set) against a scratch SQLite database, once per --speed,
+with IAM_REPLAY_FILE serving the recorded responses. Reports the wall time, the
+time spent in each collection phase (summed over accounts) and in
+persist_aa_data, so the processing and persistence of real data shapes can be
+profiled without AWS credentials. Speed 0 doesn't wait for the recorded call
+latencies and job durations; 1 reproduces them.
+
+Without a recording, --fake-principals records a run against the FakeIAM
+stand-in first.
+
+    python benchmarks/replay.py /tmp/prod-run.jsonl.gz --speed 0 --speed 20
+    python benchmarks/replay.py --fake-principals 2000 --fake-accounts 4 --job-latency exp:2 --speed 0 --speed 10
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from fake_iam import FakeIAM, latency_distribution
+
+from aardvark import create_app, db, manage, metrics
+from aardvark.updater import recording
+
+
+PHASES = ('enumeration', 'job_generation', 'polling', 'persistence')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('recording', nargs='?', help='IAM recording to replay')
+    parser.add_argument('--speed', type=float, action='append', dest='speeds',
+                        help='replay speed, may be repeated (default 0: no waiting)')
+    parser.add_argument('--threads', type=int, default=manage.DEFAULT_NUM_THREADS)
+    parser.add_argument('--fake-accounts', type=int, default=4)
+    parser.add_argument('--fake-principals', type=int, default=500, help='principals per account')
+    parser.add_argument('--services', type=int, default=250)
+    parser.add_argument('--job-latency', default='fixed:0', help='as for benchmarks/collector.py')
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+
+def make_app(workdir, **config):
+    app = create_app(api_docs=False)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(workdir, 'replay.db'), ROLENAME='Aardvark',
+                      **config)
+    app.logger.setLevel(logging.WARNING)
+    return app
+
+
+def collect(app, accounts, threads):
+    """Run update for the accounts from scratch; returns (wall seconds, persist seconds, rows written)."""
+    from aardvark.model import AdvisorData
+
+    persist_times = []
+    persist_lock = threading.Lock()
+    persist_aa_data = manage.persist_aa_data
+
+    def timed_persist_aa_data(app, aa_data):
+        start = time.time()
+        persist_aa_data(app, aa_data)
+        with persist_lock:
+            persist_times.append(time.time() - start)
+
+    app.config['NUM_THREADS'] = threads
+    metrics.REGISTRY.reset()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        manage.persist_aa_data = timed_persist_aa_data
+        try:
+            start = time.time()
+            manage.update(','.join(accounts), 'all')
+            elapsed = time.time() - start
+        finally:
+            manage.persist_aa_data = persist_aa_data
+        rows = AdvisorData.query.count()
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return elapsed, sum(persist_times), rows
+
+
+def record_fake_run(workdir, args):
+    path = os.path.join(workdir, 'fake.jsonl.gz')
+    fake = FakeIAM(principals=args.fake_principals, services=args.services,
+                   job_latency=latency_distribution(args.job_latency), seed=0)
+    accounts = ['{:012d}'.format(100000000000 + i) for i in range(args.fake_accounts)]
+    app = make_app(workdir, IAM_CLIENT_FACTORY=fake.client, IAM_RECORD_FILE=path)
+    elapsed, _, _ = collect(app, accounts, args.threads)
+    recording.close_recordings()
+    return path, elapsed
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp()
+    try:
+        path, recorded_seconds = args.recording, None
+        if not path:
+            path, recorded_seconds = record_fake_run(workdir, args)
+
+        results = []
+        for speed in args.speeds or [0]:
+            # Loaded here, so parsing the recording is not part of the measured run.
+            replay = recording.open_replay(path, speed)
+            app = make_app(workdir, IAM_REPLAY_FILE=path, IAM_REPLAY_SPEED=speed)
+            elapsed, persist_seconds, rows = collect(app, replay.accounts, args.threads)
+            results.append(dict(speed=speed, accounts=len(replay.accounts), rows=rows,
+                                elapsed_seconds=round(elapsed, 3), persist_seconds=round(persist_seconds, 3),
+                                phase_seconds={phase: round(metrics.PHASE_SECONDS.sum(phase=phase), 3)
+                                               for phase in PHASES}))
+        recording_bytes = os.path.getsize(path)
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(dict(recording_bytes=recording_bytes, recorded_seconds=recorded_seconds, runs=results),
+                         indent=2))
+        return
+    took = '' if recorded_seconds is None else ', recorded run took {:.2f}s'.format(recorded_seconds)
+    print('recording: {:.1f} KiB{}'.format(recording_bytes / 1024.0, took))
+    for result in results:
+        print('  speed {speed:<5} {elapsed_seconds:>8}s wall  {persist_seconds:>7}s persisting  '
+              '{rows} rows from {accounts} accounts'.format(**result))
+        print('    ' + '  '.join('{} {}s'.format(phase, seconds) for phase, seconds in result['phase_seconds'].items()))
+
+
+if __name__ == '__main__':
+    main()
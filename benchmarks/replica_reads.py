@@ -0,0 +1,126 @@
+"""
+API latency during collection write bursts, with and without a read replica.
+
+Seeds a SQLite database, copies it as the "replica", and runs ``aardvark
+start_api`` on the primary alone and then with SQLALCHEMY_REPLICA_URI pointing
+at the copy. While clients issue ARN lookups, this process keeps rewriting
+batches of principals in the primary with persist_aa_data, as a collection run
+would. Reports lookup throughput and latency percentiles for each setup.
+
+    python benchmarks/replica_reads.py --principals 5000 --clients 8 --duration 10
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from aardvark import create_app, db
+from aardvark.manage import persist_aa_data
+from aardvark.updater.records import ServiceUsage
+
+from api_concurrency import drive, free_port, percentile, seed, wait_for
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--principals', type=int, default=5000)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=500, help='principals rewritten per persist_aa_data call')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+    args.slow_fraction = 0
+    return args
+
+
+def write_bursts(db_path, arns, args, stop):
+    """Rewrite random batches of principals in the primary until stop is set; returns the batches written."""
+    app = create_app(api_docs=False)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    app.logger.setLevel(logging.WARNING)
+    rng = random.Random(1)
+    batches = 0
+    with app.app_context():
+        while not stop.is_set():
+            batch = rng.sample(arns, args.batch)
+            persist_aa_data(app, {arn: [ServiceUsage('svc{}'.format(s), 'Service {}'.format(s),
+                                                     rng.randint(1559390400000, 1569390400000), arn, 1)
+                                        for s in range(args.services)] for arn in batch})
+            batches += 1
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return batches
+
+
+def run(name, workdir, arns, args, replica_path=None):
+    db_path = os.path.join(workdir, 'aardvark.db')
+    with open(os.path.join(workdir, 'config.py'), 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = "sqlite:///{}"\n'
+                'SQLALCHEMY_TRACK_MODIFICATIONS = False\n'
+                'LOG_LEVEL = "WARNING"\n'.format(db_path))
+        if replica_path:
+            f.write('SQLALCHEMY_REPLICA_URI = "sqlite:///{}"\n'.format(replica_path))
+
+    port = free_port()
+    aardvark = os.path.join(os.path.dirname(sys.executable), 'aardvark')
+    process = subprocess.Popen([aardvark, 'start_api', '-w', str(args.workers), '-b', '127.0.0.1:{}'.format(port)],
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stop = threading.Event()
+    written = []
+    writer = threading.Thread(target=lambda: written.append(write_bursts(db_path, arns, args, stop)))
+    try:
+        wait_for(port)
+        time.sleep(1)
+        writer.start()
+        latencies, errors = drive(port, arns, args)
+    finally:
+        stop.set()
+        if writer.is_alive() or written:
+            writer.join()
+        process.terminate()
+        process.wait()
+
+    values = latencies['fast']
+    return dict(setup=name, errors=len(errors), batches_written=written[0] if written else 0,
+                per_second=round(len(values) / args.duration, 1),
+                p50_ms=round(percentile(values, 50) * 1000, 1) if values else None,
+                p99_ms=round(percentile(values, 99) * 1000, 1) if values else None)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp()
+    try:
+        arns = seed(os.path.join(workdir, 'aardvark.db'), args.principals, args.services)
+        replica_path = os.path.join(workdir, 'replica.db')
+        shutil.copy(os.path.join(workdir, 'aardvark.db'), replica_path)
+        results = [run('primary only', workdir, arns, args),
+                   run('read replica', workdir, arns, args, replica_path=replica_path)]
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{} principals x {} services, {} clients for {}s, writing {} principals per batch'.format(
+        args.principals, args.services, args.clients, args.duration, args.batch))
+    for result in results:
+        print('  {setup:<14} {per_second:>8} req/s  p50 {p50_ms:>7} ms  p99 {p99_ms:>7} ms  '
+              '({batches_written} batches written, {errors} errors)'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
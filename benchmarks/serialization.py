@@ -0,0 +1,96 @@
+"""
+JSON serialization benchmark for /advisors responses.
+
+Encodes pages of synthetic principals the ways the API can: Flask's json.dumps
+over per-row dicts (what jsonify did for every response), fastjson.dumps over
+the same dicts with each available backend, and UsageEncoder straight from
+query tuples (what builds the stored per-principal documents).
+
+    python benchmarks/serialization.py --count 30,1000,5000 --services 250
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import datetime
+import random
+import timeit
+
+from flask import Flask
+from flask import json as flask_json
+
+from aardvark.model import usage_entry
+from aardvark.utils import fastjson
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', default='30,1000,5000', help='principals per page; a comma separated list')
+    parser.add_argument('--services', type=int, default=250, help='services per principal')
+    parser.add_argument('--used-fraction', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=3, help='best of this many runs')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def build_page(count, num_services, used_fraction, rng):
+    services = {i: ('Amazon Service {}'.format(i), 'svc{}'.format(i)) for i in range(num_services)}
+    last_updated = datetime.datetime(2019, 6, 1, 12, 0, 0)
+    page = {}
+    for p in range(count):
+        arn = 'arn:aws:iam::123456789012:role/role{}'.format(p)
+        rows = []
+        for service_id in range(num_services):
+            if rng.random() < used_fraction:
+                rows.append((service_id, 1559390400000 + rng.randint(0, 10 ** 9), arn, 1))
+            else:
+                rows.append((service_id, 0, None, 0))
+        page[arn] = rows
+    return services, last_updated, page
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    app = Flask('aardvark')
+
+    for count in [int(c) for c in args.count.split(',')]:
+        services, last_updated, page = build_page(count, args.services, args.used_fraction, rng)
+
+        def as_dicts():
+            values = dict(page=1, total=count, count=count)
+            for arn, rows in page.items():
+                values[arn] = [usage_entry(services, *row, lastUpdated=last_updated) for row in rows]
+            return values
+
+        def flask_dicts():
+            with app.app_context():
+                return flask_json.dumps(as_dicts())
+
+        def fast_dicts():
+            return fastjson.dumps(as_dicts())
+
+        def from_tuples():
+            encoder = fastjson.UsageEncoder(services)
+            return '{' + ','.join('{}:{}'.format(fastjson.dumps(arn), encoder.encode(rows, last_updated))
+                                  for arn, rows in page.items()) + '}'
+
+        cases = [('flask json.dumps, dicts', 'auto', flask_dicts)]
+        for name in sorted(fastjson.BACKENDS):
+            cases.append(('{} dumps, dicts'.format(name), name, fast_dicts))
+            cases.append(('{} UsageEncoder, tuples'.format(name), name, from_tuples))
+
+        print('{} principals x {} services ({:.1f} MiB)'.format(
+            count, args.services, len(from_tuples()) / 2.0 ** 20))
+        baseline = None
+        for label, backend, case in cases:
+            fastjson.select(backend)
+            seconds = min(timeit.repeat(case, number=1, repeat=args.repeat))
+            baseline = baseline or seconds
+            print('  {:<32} {:>9.1f} ms  {:>5.1f}x'.format(label, seconds * 1000, baseline / seconds))
+        fastjson.select('auto')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Concurrent reads and writes on one SQLite file, with and without the PRAGMA profile.
+
+Seeds a SQLite database, then runs a writer process rewriting batches of
+principals with persist_aa_data (as a collection run does) alongside reader
+processes querying /api/1/advisors through the Flask app, as an API container
+sharing the file would. Each setup runs on a fresh copy of the seeded file.
+Reports reader latency percentiles and failures ("database is locked") and the
+writer's throughput, for SQLite's default journal and for the SQLITE_PRAGMAS
+defaults.
+
+    python benchmarks/sqlite_concurrency.py --principals 5000 --readers 4 --duration 10
+"""
+
+# ensure absolute import for python3
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from aardvark import create_app, db
+from aardvark.manage import persist_aa_data
+from aardvark.updater.records import ServiceUsage
+
+from api_concurrency import percentile, seed
+
+
+PROFILES = {
+    # SQLite's defaults: rollback journal, synchronous FULL, no mmap, 2 MiB cache, and pysqlite's 5s lock timeout.
+    'sqlite defaults': {'journal_mode': 'DELETE', 'synchronous': None, 'mmap_size': None, 'cache_size': None,
+                        'busy_timeout': None},
+    'SQLITE_PRAGMAS defaults': {},
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--principals', type=int, default=5000)
+    parser.add_argument('--services', type=int, default=50)
+    parser.add_argument('--batch', type=int, default=500, help='principals rewritten per persist_aa_data call')
+    parser.add_argument('--readers', type=int, default=4, help='reader processes')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+
+def make_app(db_path, pragmas):
+    app = create_app(api_docs=False)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    app.config['SQLITE_PRAGMAS'] = pragmas
+    app.logger.setLevel(logging.CRITICAL)
+    return app
+
+
+def reader(db_path, pragmas, arns, deadline, seed_value, results):
+    app = make_app(db_path, pragmas)
+    client = app.test_client()
+    rng = random.Random(seed_value)
+    latencies, errors = [], 0
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            ok = client.get('/api/1/advisors', query_string={'arn': rng.choice(arns)}).status_code == 200
+        except Exception:
+            ok = False
+        if ok:
+            latencies.append(time.time() - start)
+        else:
+            errors += 1
+    results.put(('reader', latencies, errors))
+
+
+def writer(db_path, pragmas, arns, args, deadline, results):
+    app = make_app(db_path, pragmas)
+    rng = random.Random(1)
+    batches, errors = 0, 0
+    with app.app_context():
+        while time.time() < deadline:
+            batch = rng.sample(arns, args.batch)
+            try:
+                persist_aa_data(app, {arn: [ServiceUsage('svc{}'.format(s), 'Service {}'.format(s),
+                                                         rng.randint(1559390400000, 1569390400000), arn, 1)
+                                            for s in range(args.services)] for arn in batch})
+                batches += 1
+            except Exception:
+                db.session.rollback()
+                errors += 1
+    results.put(('writer', batches, errors))
+
+
+def run(name, pragmas, seeded, workdir, arns, args):
+    db_path = os.path.join(workdir, 'aardvark.db')
+    shutil.copy(seeded, db_path)
+    # Switch the copy's journal mode (it is stored in the file) before the processes start.
+    app = make_app(db_path, pragmas)
+    with app.app_context():
+        db.engine.execute('SELECT 1')
+        db.get_engine(app).dispose()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    deadline = time.time() + args.duration
+    processes = [context.Process(target=writer, args=(db_path, pragmas, arns, args, deadline, results))]
+    processes += [context.Process(target=reader, args=(db_path, pragmas, arns, deadline, i, results))
+                  for i in range(args.readers)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+    latencies = [value for kind, values, _ in collected if kind == 'reader' for value in values]
+    return dict(profile=name,
+                reads_per_second=round(len(latencies) / args.duration, 1),
+                read_p50_ms=round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+                read_p99_ms=round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+                read_errors=sum(errors for kind, _, errors in collected if kind == 'reader'),
+                batches_written=sum(batches for kind, batches, _ in collected if kind == 'writer'),
+                write_errors=sum(errors for kind, _, errors in collected if kind == 'writer'))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp()
+    try:
+        seeded = os.path.join(workdir, 'seeded.db')
+        arns = seed(seeded, args.principals, args.services)
+        results = [run(name, pragmas, seeded, workdir, arns, args) for name, pragmas in sorted(PROFILES.items())]
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('{} principals x {} services, {} readers and 1 writer ({} principals per batch) for {}s'.format(
+        args.principals, args.services, args.readers, args.batch, args.duration))
+    for result in results:
+        print('  {profile:<24} reads {reads_per_second:>7}/s  p50 {read_p50_ms!s:>7} ms  p99 {read_p99_ms!s:>8} ms  '
+              '{read_errors:>5} failed  |  {batches_written} batches written, {write_errors} failed'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
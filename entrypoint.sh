@@ -20,6 +20,9 @@ ARN_PARTITION = "$AWS_ARN_PARTITION"
 SQLALCHEMY_DATABASE_URI = "$AARDVARK_DATABASE_URI"
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 NUM_THREADS = 5
+# Keep the SWAG account snapshot with the other data rather than in the package's instance folder.
+SWAG_SNAPSHOT_FILE = "$AARDVARK_DATA_DIR/swag_snapshot.json"
+API_SPEC_FILE = "/usr/src/aardvark/apispec.json"
 LOG_CFG = {
     'version': 1,
     'disable_existing_loggers': False,
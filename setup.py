@@ -55,6 +55,16 @@ docs_require = [
 dev_requires = [
 ]
 
+orjson_requires = [
+    'orjson>=3.0'
+]
+
+async_requires = [
+    'uvicorn>=0.13',
+    'aiosqlite>=0.16',
+    'asyncpg>=0.21',
+]
+
 
 setup(
     name=about["__title__"],
@@ -73,6 +83,8 @@ setup(
         'tests': tests_require,
         'docs': docs_require,
         'dev': dev_requires,
+        'orjson': orjson_requires,
+        'async': async_requires,
     },
     entry_points={
         'console_scripts': [
@@ -0,0 +1,51 @@
+'''Test cases for the Swagger docs routes.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import json
+import os
+import tempfile
+
+import unittest
+
+from aardvark import build_api_spec, create_app, init_api_docs
+
+
+class TestAPIDocs(unittest.TestCase):
+
+    def build_app(self, **config):
+        # Apply the config before the docs routes are registered.
+        app = create_app(api_docs=False)
+        app.config.update(config)
+        init_api_docs(app)
+        return app.test_client()
+
+    def test_generated_spec(self):
+        client = self.build_app()
+        spec = json.loads(client.get('/apispec_1.json').data.decode('utf-8'))
+        self.assertIn('/api/1/advisors', spec['paths'])
+        self.assertEqual(client.get('/apidocs/').status_code, 200)
+
+    def test_spec_file(self):
+        expected = build_api_spec(create_app(api_docs=False))
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(expected, info={'title': 'from file'}), f)
+            client = self.build_app(API_SPEC_FILE=path)
+            spec = json.loads(client.get('/apispec_1.json').data.decode('utf-8'))
+        finally:
+            os.remove(path)
+        self.assertEqual(spec['info'], {'title': 'from file'})
+        self.assertEqual(spec['paths'], json.loads(json.dumps(expected['paths'])))
+
+    def test_docs_disabled(self):
+        client = self.build_app(API_DOCS=False)
+        self.assertEqual(client.get('/apispec_1.json').status_code, 404)
+        self.assertEqual(client.get('/apidocs/').status_code, 404)
+        self.assertEqual(client.get('/healthcheck').status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''Test cases for the async API, checked against the Flask API's responses.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import unittest
+
+from aardvark import create_app, db
+from aardvark.manage import persist_aa_data
+from aardvark.updater.records import ServiceUsage
+
+try:
+    import aiosqlite  # noqa
+    from aardvark.asgi import AsyncAPI
+except ImportError:
+    AsyncAPI = None
+
+ARNS = ['arn:aws:iam::123456789012:role/role{}'.format(i) for i in range(5)] + ['arn:aws:iam::210987654321:user/Bob']
+
+
+@unittest.skipUnless(AsyncAPI, 'needs the async extra')
+class TestAsyncAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(os.path.join(self.tmpdir, 'test.db'))
+        self.app.logger.setLevel(logging.CRITICAL)
+        with self.app.app_context():
+            db.create_all()
+            persist_aa_data(self.app, {arn: [ServiceUsage('s3', 'S3', 1000 * i, arn, 1),
+                                             ServiceUsage('ec2', 'EC2', 0, None, 0)] for i, arn in enumerate(ARNS)})
+            db.session.remove()
+        self.asgi = AsyncAPI(self.app)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi.db.close())
+        self.loop.close()
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, method, path, query='', body=None):
+        headers = [(b'host', b'testserver')]
+        if body is not None:
+            headers.append((b'content-type', b'application/json'))
+        body = json.dumps(body).encode('utf-8') if body is not None else b''
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode('utf-8'),
+                 'headers': headers, 'http_version': '1.1', 'scheme': 'http',
+                 'server': ('testserver', 80), 'client': ('127.0.0.1', 1), 'root_path': ''}
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.asgi(scope, receive, send))
+        status = sent[0]['status']
+        return status, json.loads(b''.join(message.get('body', b'') for message in sent[1:]))
+
+    def flask(self, method, path, query='', body=None):
+        client = self.app.test_client()
+        response = client.open(path + ('?' + query if query else ''), method=method, json=body)
+        return response.status_code, response.get_json()
+
+    def assertSame(self, method, path, query='', body=None):
+        self.assertEqual(self.request(method, path, query, body), self.flask(method, path, query, body))
+
+    def test_advisors_match_flask(self):
+        for query in ['', 'count=2&page=2', 'phrase=ROLE', 'arn={}&arn={}'.format(ARNS[0], ARNS[-1].upper()),
+                      'regex=.*user/.*', 'combine=true&count=10', 'combine=true&count=2', 'page=0', 'page=9',
+                      'count=x']:
+            self.assertSame('GET', '/api/1/advisors', query)
+        self.assertSame('POST', '/api/1/advisors', body={'phrase': 'role3'})
+        self.assertSame('POST', '/api/1/advisors', body={'arn': ARNS[:2], 'combine': 'true'})
+
+    def test_advisors_body_types(self):
+        for body in [{'arn': 1}, {'arn': [ARNS[0], 1]}, {'arn': None}, {'phrase': 1}, {'regex': ['x']}]:
+            self.assertEqual(self.request('POST', '/api/1/advisors', body=body)[0], 400)
+
+    def test_bulk_matches_flask(self):
+        self.assertSame('POST', '/api/1/advisors/bulk', body={'arns': ARNS + ['arn:aws:iam::1:role/missing']})
+        self.assertSame('POST', '/api/1/advisors/bulk', body={'arn': 'x'})
+
+    def test_other_routes_use_flask(self):
+        self.app.config['USAGE_HISTORY'] = True
+        self.assertSame('GET', '/api/1/advisors', 'as_of=0')
+        self.assertSame('GET', '/api/1/summary/services')
@@ -0,0 +1,50 @@
+'''Test cases for the API JSON encoders.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import datetime
+import json
+
+import unittest
+
+from flask import Flask
+from flask import json as flask_json
+
+from aardvark.utils import fastjson
+
+SERVICES = {1: ('Amazon S3', 's3'), 2: ('Amazon "Quoted" é', 'q')}
+ROWS = [(1, 1000, 'arn:aws:iam::123456789012:role/test', 1), (2, 0, None, 0), (1, None, None, None)]
+LAST_UPDATED = datetime.datetime(2019, 6, 1, 12, 30, 5)
+
+
+class TestFastJSON(unittest.TestCase):
+
+    def tearDown(self):
+        fastjson.select('auto')
+
+    def flask_dumps(self, obj):
+        with Flask('aardvark').app_context():
+            return flask_json.dumps(obj)
+
+    def test_backends_match_jsonify(self):
+        payload = {'page': 1, 'arn': [{'lastUpdated': LAST_UPDATED, 'day': LAST_UPDATED.date(), 'name': 'S3 é'}]}
+        expected = json.loads(self.flask_dumps(payload))
+        for name in fastjson.BACKENDS:
+            fastjson.select(name)
+            self.assertEqual(fastjson.backend(), name)
+            self.assertEqual(json.loads(fastjson.dumps(payload)), expected)
+
+    def test_usage_encoder_matches_entries(self):
+        from aardvark.model import usage_entry
+
+        expected = json.loads(self.flask_dumps([usage_entry(SERVICES, *row, lastUpdated=LAST_UPDATED) for row in ROWS]))
+        for name in fastjson.BACKENDS:
+            fastjson.select(name)
+            encoder = fastjson.UsageEncoder(SERVICES)
+            self.assertEqual(json.loads(encoder.encode(ROWS, LAST_UPDATED)), expected)
+            self.assertEqual(encoder.encode([], LAST_UPDATED), '[]')
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            fastjson.select('nope')
@@ -0,0 +1,91 @@
+'''Test cases for the Prometheus-style metrics registry and endpoint.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+
+import unittest
+
+from aardvark import create_app, metrics
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_render(self):
+        counter = metrics.Counter('test_calls_total', 'Calls.', ['operation'], registry=self.registry)
+        counter.inc(operation='List')
+        counter.inc(2, operation='List')
+
+        rendered = self.registry.render()
+        self.assertIn('# TYPE test_calls_total counter', rendered)
+        self.assertIn('test_calls_total{operation="List"} 3.0', rendered)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Latency.', buckets=(1, 10), registry=self.registry)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        rendered = self.registry.render()
+        self.assertIn('test_seconds_bucket{le="1.0"} 1.0', rendered)
+        self.assertIn('test_seconds_bucket{le="10.0"} 2.0', rendered)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2.0', rendered)
+        self.assertIn('test_seconds_count 2.0', rendered)
+
+    def test_label_mismatch(self):
+        counter = metrics.Counter('test_total', 'Calls.', ['operation'], registry=self.registry)
+        with self.assertRaises(ValueError):
+            counter.inc(phase='x')
+
+    def test_write_textfile(self):
+        metrics.Gauge('test_depth', 'Depth.', registry=self.registry).set(4)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'aardvark.prom')
+            self.registry.write_textfile(path)
+            with open(path) as f:
+                self.assertIn('test_depth 4.0', f.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+
+    def test_request_latency_by_shape(self):
+        app = create_app()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        client = app.test_client()
+
+        with app.app_context():
+            from aardvark import db
+            db.create_all()
+
+        before = metrics.REQUEST_SECONDS.count(endpoint='advisor.rolesearch', shape='phrase')
+        self.assertEqual(client.get('/api/1/advisors?phrase=role').status_code, 200)
+        after = metrics.REQUEST_SECONDS.count(endpoint='advisor.rolesearch', shape='phrase')
+        self.assertEqual(after, before + 1)
+
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'aardvark_api_request_seconds_bucket', response.data)
+
+    def test_warm_up_not_recorded(self):
+        from aardvark.serving import warm_up
+
+        app = create_app()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        with app.app_context():
+            from aardvark import db
+            db.create_all()
+
+        before = metrics.REQUEST_SECONDS.count(endpoint='advisor.rolesearch', shape='all')
+        warm_up(app)
+        self.assertEqual(metrics.REQUEST_SECONDS.count(endpoint='advisor.rolesearch', shape='all'), before)
+
+        app.test_client().get('/api/1/advisors?count=1')
+        self.assertEqual(metrics.REQUEST_SECONDS.count(endpoint='advisor.rolesearch', shape='all'), before + 1)
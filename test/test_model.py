@@ -0,0 +1,671 @@
+'''Test cases for persisting Access Advisor data and upgrading older schemas.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import unittest
+
+import sqlalchemy.exc
+
+from aardvark import create_app, db, replica
+from aardvark.manage import persist_aa_data
+from aardvark.updater.records import ServiceUsage
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/test'
+
+# The advisor tables as created by releases before the advisor_service table.
+LEGACY_SCHEMA = [
+    'CREATE TABLE aws_iam_object (id INTEGER NOT NULL, arn VARCHAR(2048), "lastUpdated" TIMESTAMP, '
+    'PRIMARY KEY (id))',
+    'CREATE UNIQUE INDEX ix_aws_iam_object_arn ON aws_iam_object (arn)',
+    'CREATE TABLE advisor_data (id INTEGER NOT NULL, item_id INTEGER NOT NULL, "lastAuthenticated" BIGINT, '
+    '"serviceName" VARCHAR(128), "serviceNamespace" VARCHAR(64), "lastAuthenticatedEntity" TEXT, '
+    '"totalAuthenticatedEntities" INTEGER, PRIMARY KEY (id), FOREIGN KEY(item_id) REFERENCES aws_iam_object (id))',
+    'CREATE INDEX ix_advisor_data_item_id ON advisor_data (item_id)',
+    'CREATE INDEX "ix_advisor_data_serviceName" ON advisor_data ("serviceName")',
+    'CREATE INDEX "ix_advisor_data_serviceNamespace" ON advisor_data ("serviceNamespace")',
+]
+
+
+def usage(namespace, last_authenticated, name=None):
+    return ServiceUsage(namespace, name or namespace.upper(), last_authenticated, ROLE_ARN, 1)
+
+
+class AardvarkDBTestCase(unittest.TestCase):
+    '''Runs each test against a fresh SQLite database file.'''
+
+    create_schema = True
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(os.path.join(self.tmpdir, 'test.db'))
+        self.app.logger.setLevel(logging.CRITICAL)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        if self.create_schema:
+            db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def advisors(self, **params):
+        response = self.app.test_client().get('/api/1/advisors', query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+
+class TestPersistence(AardvarkDBTestCase):
+
+    def test_persist_and_query(self):
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000), usage('ec2', 0)]})
+
+        result = self.advisors()
+        self.assertEqual(result['total'], 1)
+        services = {entry['serviceNamespace']: entry for entry in result[ROLE_ARN]}
+        self.assertEqual(set(services), {'s3', 'ec2'})
+        self.assertEqual(services['s3']['serviceName'], 'S3')
+        self.assertEqual(services['s3']['lastAuthenticated'], 1000)
+
+    def test_update_keeps_newest_time(self):
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]})
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000)]})
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1500)]})
+
+        self.assertEqual(self.advisors()[ROLE_ARN][0]['lastAuthenticated'], 2000)
+
+    def test_zero_clears_previous_time(self):
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]})
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 0)]})
+
+        self.assertEqual(self.advisors()[ROLE_ARN][0]['lastAuthenticated'], 0)
+
+    def test_services_stored_once(self):
+        from aardvark.model import AdvisorService
+
+        other_arn = 'arn:aws:iam::123456789012:role/other'
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)], other_arn: [usage('s3', 2000)]})
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 3000, name='Amazon S3')]})
+
+        self.assertEqual(AdvisorService.lookup(), {1: ('Amazon S3', 's3')})
+        # other_arn wasn't collected again, but its document serves the new name.
+        self.assertEqual([entry['serviceName'] for entry in self.advisors(arn=other_arn)[other_arn]], ['Amazon S3'])
+
+    def test_documents(self):
+        from aardvark.model import PrincipalUsage
+
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]})
+        self.assertIn('"lastAuthenticated":1000', PrincipalUsage.query.get(1).document)
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000)]})
+        self.assertIn('"lastAuthenticated":2000', PrincipalUsage.query.get(1).document)
+        expected = self.advisors()
+
+        # Principals without a stored document are built on the fly.
+        PrincipalUsage.query.delete()
+        db.session.commit()
+        self.assertEqual(self.advisors(), expected)
+        self.assertEqual(self.advisors(combine='true')['s3']['lastAuthenticated'], 2000)
+
+    def test_persist_returns_changes(self):
+        s3, ec2 = usage('s3', 1000), usage('ec2', 0)
+        self.assertEqual(persist_aa_data(self.app, {ROLE_ARN: [s3, ec2]}), [(1, 1, None, s3), (1, 2, None, ec2)])
+        s3, ec2 = usage('s3', 2000), usage('ec2', 0)
+        self.assertEqual(persist_aa_data(self.app, {ROLE_ARN: [s3, ec2]}), [(1, 1, 1000, s3)])
+        self.assertEqual(persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1500)]}), [])
+
+    def test_one_row_per_service(self):
+        from aardvark.model import AdvisorData
+
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]})
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            db.session.add(AdvisorData(item_id=1, service_id=1, lastAuthenticated=2000))
+            db.session.flush()
+
+
+class TestHistory(AardvarkDBTestCase):
+
+    def setUp(self):
+        super(TestHistory, self).setUp()
+        self.app.config['USAGE_HISTORY'] = True
+
+    def test_as_of(self):
+        day = 24 * 60 * 60 * 1000
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000), usage('ec2', 0)]}, 10 * day)
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000), usage('ec2', 0)]}, 20 * day)
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000), usage('ec2', 3000)]}, 40 * day)
+
+        def as_of(when):
+            result = self.advisors(as_of=when)[ROLE_ARN]
+            return {entry['serviceNamespace']: entry['lastAuthenticated'] for entry in result}
+
+        self.assertEqual(as_of(5 * day), {})
+        self.assertEqual(as_of(10 * day), {'s3': 1000, 'ec2': 0})
+        self.assertEqual(as_of(39 * day), {'s3': 2000, 'ec2': 0})
+        self.assertEqual(as_of('1970-03-01'), {'s3': 2000, 'ec2': 3000})
+        self.assertEqual({entry['serviceNamespace']: entry['lastAuthenticated'] for entry in self.advisors()[ROLE_ARN]},
+                         {'s3': 2000, 'ec2': 3000})
+
+    def test_history_enabled_on_existing_data(self):
+        import datetime
+
+        self.app.config['USAGE_HISTORY'] = False
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000), usage('ec2', 0)]})
+        before = int(time.time() * 1000)
+
+        self.app.config['USAGE_HISTORY'] = True
+        later = before + 24 * 60 * 60 * 1000
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000), usage('ec2', 3000)]}, later)
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000), usage('ec2', 3000)]}, later + 1000)
+
+        def as_of(when):
+            result = self.advisors(as_of=when)[ROLE_ARN]
+            return {entry['serviceNamespace']: entry['lastAuthenticated'] for entry in result}
+
+        # The unchanged s3 entry comes from the baseline taken when history was turned on.
+        self.assertEqual(as_of(before), {'s3': 1000, 'ec2': 0})
+        self.assertEqual(as_of(later), {'s3': 1000, 'ec2': 3000})
+        self.assertEqual(as_of(later + 1000), {'s3': 2000, 'ec2': 3000})
+        self.assertEqual(as_of(datetime.datetime(2000, 1, 1).isoformat()), {})
+
+    def test_as_of_requires_history(self):
+        self.app.config['USAGE_HISTORY'] = False
+        response = self.app.test_client().get('/api/1/advisors', query_string={'as_of': 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bad_as_of(self):
+        response = self.app.test_client().get('/api/1/advisors', query_string={'as_of': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestChangeLog(AardvarkDBTestCase):
+
+    def changes(self, **params):
+        response = self.app.test_client().get('/api/1/changes', query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_changes(self):
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000), usage('ec2', 0)]})
+        first = self.changes()
+        self.assertEqual([(change['seq'], change['kind']) for change in first['changes']],
+                         [(1, 'service'), (2, 'service'), (3, 'principal'), (4, 'usage'), (5, 'usage')])
+        self.assertEqual(first['changes'][0]['serviceNamespace'], 's3')
+        self.assertEqual(first['changes'][2]['arn'], ROLE_ARN)
+        self.assertEqual({key: first['changes'][3][key] for key in ('arn', 'serviceNamespace', 'previous',
+                                                                    'lastAuthenticated')},
+                         {'arn': ROLE_ARN, 'serviceNamespace': 's3', 'previous': None, 'lastAuthenticated': 1000})
+        self.assertEqual((first['next'], first['more']), (5, False))
+
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000), usage('ec2', 0)]})
+        # No longer used within the year: the time drops to 0.
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 0), usage('ec2', 0)]})
+        changes = self.changes(since=first['next'])['changes']
+        self.assertEqual([(change['seq'], change['previous'], change['lastAuthenticated']) for change in changes],
+                         [(6, 1000, 2000), (7, 2000, 0)])
+        self.assertEqual(self.changes(since=7), {'since': 7, 'next': 7, 'more': False, 'changes': []})
+
+    def test_pages(self):
+        persist_aa_data(self.app, {'arn:aws:iam::123456789012:role/{}'.format(i): [usage('s3', 1000)]
+                                   for i in range(5)})
+        expected = [change['seq'] for change in self.changes()['changes']]
+
+        seen, since, more = [], 0, True
+        while more:
+            page = self.changes(since=since, count=2)
+            seen.extend(change['seq'] for change in page['changes'])
+            since, more = page['next'], page['more']
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(seen), 11)
+
+    def test_retention(self):
+        day = 24 * 60 * 60 * 1000
+        self.app.config['CHANGE_LOG_RETENTION_DAYS'] = 30
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]}, 10 * day)
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000)]}, 20 * day)
+        self.assertEqual(len(self.changes()['changes']), 4)
+
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 3000)]}, 45 * day)
+        self.assertEqual([change['lastAuthenticated'] for change in self.changes(since=3)['changes']], [2000, 3000])
+
+        self.app.config['CHANGE_LOG_RETENTION_DAYS'] = 0
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 4000)]}, 1000 * day)
+        self.assertEqual(len(self.changes(since=3)['changes']), 3)
+
+    def test_fallen_behind_retention(self):
+        day = 24 * 60 * 60 * 1000
+        self.app.config['CHANGE_LOG_RETENTION_DAYS'] = 30
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]}, 10 * day)
+        seen = self.changes()['next']
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000)]}, 20 * day)
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 3000)]}, 45 * day)
+        self.assertEqual(self.changes(since=seen)['changes'][0]['seq'], 4)
+
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 4000)]}, 60 * day)
+        # seq 4, written on day 20, expired before the consumer saw it.
+        response = self.app.test_client().get('/api/1/changes', query_string={'since': seen})
+        self.assertEqual(response.status_code, 410)
+        self.assertIn('since=4', response.get_json()['message'])
+        self.assertEqual([change['seq'] for change in self.changes(since=4)['changes']], [5, 6])
+
+    def test_disabled(self):
+        self.app.config['CHANGE_LOG'] = False
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]})
+        self.assertEqual(self.changes()['changes'], [])
+
+    def test_bad_requests(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/api/1/changes?since=-1').status_code, 400)
+        self.assertEqual(client.get('/api/1/changes?count=0').status_code, 400)
+        self.assertEqual(client.get('/api/1/changes?count=10001').status_code, 400)
+        self.assertEqual(client.get('/api/1/changes?since=abc').status_code, 400)
+
+
+class TestRollups(AardvarkDBTestCase):
+
+    def get(self, path):
+        response = self.app.test_client().get('/api/1/summary/' + path)
+        return response.status_code, response.get_json()
+
+    def test_summaries(self):
+        import time
+        from aardvark.manage import _refresh_rollups
+
+        now = int(time.time() * 1000)
+        day = 24 * 60 * 60 * 1000
+        other_role = 'arn:aws:iam::123456789012:role/other'
+        other_account = 'arn:aws:iam::210987654321:role/test'
+        persist_aa_data(self.app, {
+            ROLE_ARN: [usage('s3', now - day), usage('ec2', 0)],
+            other_role: [usage('s3', now - 60 * day), usage('ec2', now - 200 * day)],
+            other_account: [usage('s3', 0)],
+        })
+        for account_number in ('123456789012', '210987654321'):
+            _refresh_rollups(self.app, account_number)
+
+        status, account = self.get('accounts/123456789012')
+        self.assertEqual(status, 200)
+        s3 = account['services']['s3']
+        self.assertEqual((s3['principalCount'], s3['usedCount'], s3['used90Days'], s3['used30Days']), (2, 2, 2, 1))
+        self.assertEqual(s3['lastAuthenticated'], now - day)
+        ec2 = account['services']['ec2']
+        self.assertEqual((ec2['principalCount'], ec2['usedCount'], ec2['used90Days']), (2, 1, 0))
+
+        status, services = self.get('services')
+        self.assertEqual(status, 200)
+        self.assertEqual((services['s3']['accountCount'], services['s3']['usedAccountCount']), (2, 1))
+        self.assertEqual(services['s3']['principalCount'], 3)
+        self.assertEqual(self.get('services/ec2')[1].keys(), {'ec2'})
+
+        # Re-persisting one account replaces its rollup rows and leaves the other account's alone.
+        persist_aa_data(self.app, {other_account: [usage('s3', now)]})
+        _refresh_rollups(self.app, '210987654321')
+        self.assertEqual(self.get('services/s3')[1]['s3']['usedAccountCount'], 2)
+        self.assertEqual(self.get('accounts/123456789012')[1]['services']['s3']['principalCount'], 2)
+
+    def test_unknown(self):
+        self.assertEqual(self.get('accounts/000000000000')[0], 404)
+        self.assertEqual(self.get('services/nope')[0], 404)
+
+
+class TestUnused(AardvarkDBTestCase):
+
+    def unused(self, **params):
+        response = self.app.test_client().get('/api/1/unused', query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_unused(self):
+        import time
+
+        now = int(time.time() * 1000)
+        day = 24 * 60 * 60 * 1000
+        other_account = 'arn:aws:iam::210987654321:role/test'
+        persist_aa_data(self.app, {
+            ROLE_ARN: [usage('s3', now - day), usage('ec2', 0), usage('sqs', now - 100 * day)],
+            other_account: [usage('s3', now - 60 * day)],
+        })
+
+        def namespaces(result):
+            return {arn: [entry['serviceNamespace'] for entry in entries] for arn, entries in result['unused'].items()}
+
+        self.assertEqual(namespaces(self.unused()), {ROLE_ARN: ['ec2', 'sqs']})
+        self.assertEqual(namespaces(self.unused(days=30)), {ROLE_ARN: ['ec2', 'sqs'], other_account: ['s3']})
+        self.assertEqual(namespaces(self.unused(days=30, account='210987654321')), {other_account: ['s3']})
+        self.assertEqual(namespaces(self.unused(days=30, namespace='s3')), {other_account: ['s3']})
+        self.assertEqual(namespaces(self.unused(days=0, arn=ROLE_ARN, namespace=['s3', 'ec2'])),
+                         {ROLE_ARN: ['s3', 'ec2']})
+
+        first = self.unused(days=30, count=2)
+        self.assertEqual((first['count'], first['more']), (2, True))
+        second = self.unused(days=30, count=2, after=first['next'])
+        self.assertEqual((second['count'], second['more']), (1, False))
+        # Pages follow the order principals were stored in; together they hold every entry once.
+        paged = namespaces(first)
+        for arn, entries in namespaces(second).items():
+            paged.setdefault(arn, []).extend(entries)
+        self.assertEqual(paged, namespaces(self.unused(days=30)))
+        last = self.unused(days=30, count=2, after=second['next'])
+        self.assertEqual((last['count'], last['more'], last['next'], last['unused']), (0, False, second['next'], {}))
+
+    def test_bad_window(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/api/1/unused', query_string={'days': -1}).status_code, 400)
+        self.assertEqual(client.get('/api/1/unused', query_string={'after': 'abc'}).status_code, 400)
+        self.assertEqual(client.get('/api/1/unused', query_string={'after': '1:2:3'}).status_code, 400)
+
+
+class TestBulkLookup(AardvarkDBTestCase):
+
+    def test_bulk_lookup(self):
+        from aardvark import model
+
+        arns = ['arn:aws:iam::123456789012:role/role{}'.format(i) for i in range(model.QUERY_CHUNK_SIZE + 10)]
+        persist_aa_data(self.app, {arn: [usage('s3', i)] for i, arn in enumerate(arns) if i % 2 == 0})
+
+        wanted = arns + arns[:3]
+        response = self.app.test_client().post('/api/1/advisors/bulk', json={'arns': wanted})
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+
+        self.assertEqual(list(result['results']), arns[::2])
+        self.assertEqual(result['missing'], arns[1::2])
+        self.assertEqual(result['results'][arns[4]][0]['lastAuthenticated'], 4)
+        self.assertEqual(result['results'][arns[4]][0]['serviceNamespace'], 's3')
+
+        response = self.app.test_client().post('/api/1/advisors/bulk', json=arns[:1])
+        self.assertEqual(list(response.get_json()['results']), arns[:1])
+
+    def test_bad_requests(self):
+        client = self.app.test_client()
+        self.assertEqual(client.post('/api/1/advisors/bulk', json={'arn': 'x'}).status_code, 400)
+        self.app.config['BULK_LOOKUP_MAX_ARNS'] = 2
+        self.assertEqual(client.post('/api/1/advisors/bulk', json=['a', 'b', 'c']).status_code, 400)
+
+
+class TestReadReplica(AardvarkDBTestCase):
+
+    OTHER_ARN = 'arn:aws:iam::123456789012:role/other'
+
+    def setUp(self):
+        super(TestReadReplica, self).setUp()
+        self.replica_path = os.path.join(self.tmpdir, 'replica.db')
+        self.app.config['SQLALCHEMY_REPLICA_URI'] = 'sqlite:///' + self.replica_path
+        replica.configure(self.app)
+
+        # The replica has the first principal, the primary both.
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 1000)]})
+        shutil.copy(os.path.join(self.tmpdir, 'test.db'), self.replica_path)
+        time.sleep(0.01)
+        persist_aa_data(self.app, {self.OTHER_ARN: [usage('s3', 2000)]})
+
+    def tearDown(self):
+        replica.LAG_CHECK.reset()
+        db.get_engine(self.app, bind=replica.REPLICA_BIND).dispose()
+        super(TestReadReplica, self).tearDown()
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.advisors()['total'], 1)
+        self.assertEqual(self.advisors(arn=self.OTHER_ARN)['total'], 0)
+        # Writes still go to the primary.
+        persist_aa_data(self.app, {ROLE_ARN: [usage('ec2', 3000)]})
+        self.assertEqual(len(self.advisors()[ROLE_ARN]), 1)
+
+    def test_falls_back_when_behind(self):
+        self.app.config['REPLICA_MAX_LAG'] = 3600
+        self.assertEqual(self.advisors()['total'], 1)
+
+        replica.LAG_CHECK.reset()
+        self.app.config['REPLICA_MAX_LAG'] = 0
+        self.assertEqual(self.advisors()['total'], 2)
+
+    def test_falls_back_when_unreachable(self):
+        db.get_engine(self.app, bind=replica.REPLICA_BIND).dispose()
+        os.remove(self.replica_path)
+        os.mkdir(self.replica_path)
+        self.app.config['REPLICA_MAX_LAG'] = 3600
+        self.assertEqual(self.advisors()['total'], 2)
+
+    def test_forked_workers_share_no_connections(self):
+        from unittest import mock
+        from aardvark.serving import dispose_engine, warm_up
+
+        warm_up(self.app)
+        primary, replica_engine = db.get_engine(self.app), db.get_engine(self.app, bind=replica.REPLICA_BIND)
+        with mock.patch.object(primary, 'dispose') as primary_dispose, \
+                mock.patch.object(replica_engine, 'dispose') as replica_dispose:
+            dispose_engine(self.app)
+        primary_dispose.assert_called_once_with()
+        replica_dispose.assert_called_once_with()
+
+
+class TestSQLiteTuning(AardvarkDBTestCase):
+
+    def pragma(self, name):
+        return db.engine.execute('PRAGMA {}'.format(name)).scalar()
+
+    def test_default_pragmas(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('foreign_keys'), 1)
+
+    def test_configured_pragmas(self):
+        db.get_engine(self.app).dispose()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(os.path.join(self.tmpdir, 'other.db'))
+        self.app.config['SQLITE_PRAGMAS'] = {'journal_mode': None, 'busy_timeout': 250, 'temp_store': 'MEMORY'}
+        self.assertEqual(self.pragma('journal_mode'), 'delete')
+        self.assertEqual(self.pragma('busy_timeout'), 250)
+        self.assertEqual(self.pragma('temp_store'), 2)
+
+
+class TestPrune(AardvarkDBTestCase):
+
+    GONE_ARN = 'arn:aws:iam::123456789012:role/gone'
+    NEW_ARN = 'arn:aws:iam::123456789012:role/new'
+    OTHER_ACCOUNT_ARN = 'arn:aws:iam::210987654321:role/test'
+
+    def setUp(self):
+        import datetime
+        from aardvark.model import AWSIAMObject
+
+        super(TestPrune, self).setUp()
+        persist_aa_data(self.app, {arn: [usage('s3', 1000)]
+                                   for arn in (ROLE_ARN, self.GONE_ARN, self.NEW_ARN, self.OTHER_ACCOUNT_ARN)})
+        # NEW_ARN was collected just now but isn't listed yet; the other two were last seen long ago.
+        AWSIAMObject.query.filter(AWSIAMObject.arn.in_([self.GONE_ARN, self.OTHER_ACCOUNT_ARN])).update(
+            {'lastUpdated': datetime.datetime.utcnow() - datetime.timedelta(days=30)}, synchronize_session=False)
+        db.session.commit()
+
+    def arns(self):
+        from aardvark.model import AWSIAMObject
+
+        return {arn for arn, in db.session.query(AWSIAMObject.arn)}
+
+    def test_prune(self):
+        from aardvark.manage import _prune, _refresh_rollups
+        from aardvark.model import AccountServiceRollup, AdvisorData, PrincipalUsage
+
+        self.app.config['PRUNE_BATCH_SIZE'] = 1
+        self.assertEqual(_prune(self.app, '123456789012', [ROLE_ARN]), 1)
+        _refresh_rollups(self.app, '123456789012')
+
+        self.assertEqual(self.arns(), {ROLE_ARN, self.NEW_ARN, self.OTHER_ACCOUNT_ARN})
+        self.assertEqual(AdvisorData.query.count(), 3)
+        self.assertEqual(PrincipalUsage.query.count(), 3)
+        self.assertEqual(AccountServiceRollup.query.get(('123456789012', 1)).principalCount, 2)
+        self.assertNotIn(self.GONE_ARN, self.advisors())
+
+        changes = self.app.test_client().get('/api/1/changes').get_json()['changes']
+        self.assertEqual([change['arn'] for change in changes if change['kind'] == 'deleted'], [self.GONE_ARN])
+        # Entries recorded before the principal was deleted still name it.
+        self.assertEqual([(change['kind'], change.get('serviceNamespace')) for change in changes
+                          if change.get('arn') == self.GONE_ARN],
+                         [('principal', None), ('usage', 's3'), ('deleted', None)])
+
+    def test_prune_keeps_history(self):
+        import datetime
+        from aardvark.manage import _prune
+        from aardvark.model import AdvisorHistory, AWSIAMObject
+
+        self.app.config['USAGE_HISTORY'] = True
+        now = int(time.time() * 1000)
+        persist_aa_data(self.app, {self.GONE_ARN: [usage('s3', 2000)]}, now)
+        AWSIAMObject.query.filter(AWSIAMObject.arn == self.GONE_ARN).update(
+            {'lastUpdated': datetime.datetime.utcnow() - datetime.timedelta(days=30)}, synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(_prune(self.app, '123456789012', [ROLE_ARN, self.NEW_ARN]), 1)
+
+        self.assertNotIn(self.GONE_ARN, self.arns())
+
+        def as_of(when):
+            return [row.lastAuthenticated for row in AdvisorHistory.as_of([self.GONE_ARN], when)[self.GONE_ARN]]
+
+        self.assertEqual(as_of(now), [2000])
+        self.assertEqual(as_of(now - 1), [1000])
+
+    def test_prune_disabled(self):
+        from aardvark.manage import _prune
+
+        self.app.config['PRUNE_PRINCIPALS'] = False
+        self.assertEqual(_prune(self.app, '123456789012', [ROLE_ARN]), 0)
+        self.assertEqual(len(self.arns()), 4)
+
+    def test_empty_inventory(self):
+        from aardvark.manage import _prune
+
+        self.assertEqual(_prune(self.app, '123456789012', []), 0)
+        self.assertEqual(len(self.arns()), 4)
+
+
+class TestUpdate(AardvarkDBTestCase):
+
+    def test_persist_failure(self):
+        import threading
+        from unittest import mock
+        from aardvark import manage
+
+        self.app.config['NUM_THREADS'] = 2
+        failures = []
+
+        def on_failure(thread, error=None):
+            failures.append(error)
+        manage.UpdateAccountThread.on_failure.connect(on_failure)
+        self.addCleanup(manage.UpdateAccountThread.on_failure.disconnect, on_failure)
+
+        with mock.patch('aardvark.updater.AccountToUpdate') as account_to_update, \
+                mock.patch('aardvark.manage.persist_aa_data', side_effect=sqlalchemy.exc.OperationalError(
+                    'INSERT', {}, Exception('database is locked'))):
+            account_to_update.return_value.update_account.return_value = (0, {ROLE_ARN: [usage('s3', 1000)]})
+            thread = threading.Thread(target=self.run_update, args=('123456789012,210987654321',))
+            thread.start()
+            thread.join(30)
+
+        self.assertFalse(thread.is_alive(), 'update hung after persist_aa_data failed')
+        self.assertEqual([type(error) for error in failures], [sqlalchemy.exc.OperationalError] * 2)
+        self.assertFalse(manage.DB_LOCK.locked())
+
+    def test_split_account_refreshes_rollups_once(self):
+        from unittest import mock
+        from aardvark.model import AWSIAMObject
+
+        self.app.config.update(NUM_THREADS=2, ACCOUNT_CHUNK_SIZE=1)
+        arns = ['arn:aws:iam::123456789012:role/{}'.format(i) for i in range(3)]
+
+        def account_to_update(app, account_number, role_name, arns_list, enumerated_arns=None):
+            account = mock.Mock(account_number=account_number, role_name=role_name, arn_list=arns_list)
+            account.enumerate_arns.return_value = arns
+            account.update_account.return_value = (0, {arn: [usage('s3', 1000)] for arn in enumerated_arns or []})
+            return account
+
+        with mock.patch('aardvark.updater.AccountToUpdate', side_effect=account_to_update), \
+                mock.patch('aardvark.model.AccountServiceRollup.refresh') as refresh:
+            self.run_update('123456789012')
+
+        self.assertEqual(AWSIAMObject.query.count(), 3)
+        refresh.assert_called_once_with({'123456789012'})
+
+    def run_update(self, accounts):
+        from aardvark import manage
+
+        with self.app.app_context():
+            manage.update(accounts, 'all')
+
+
+class TestUpgrade(AardvarkDBTestCase):
+
+    create_schema = False
+
+    def test_upgrade_legacy_schema(self):
+        from aardvark.migrations import upgrade
+
+        for statement in LEGACY_SCHEMA:
+            db.engine.execute(statement)
+        db.engine.execute("INSERT INTO aws_iam_object (id, arn) VALUES (1, '{}')".format(ROLE_ARN))
+        db.engine.execute('INSERT INTO advisor_data (item_id, "lastAuthenticated", "serviceName", '
+                          '"serviceNamespace", "totalAuthenticatedEntities") '
+                          "VALUES (1, 1000, 'Amazon S3', 's3', 1), (1, 0, 'Amazon EC2', 'ec2', 0)")
+
+        upgrade(db.engine, self.app.logger)
+        upgrade(db.engine, self.app.logger)
+
+        services = {entry['serviceNamespace']: entry for entry in self.advisors()[ROLE_ARN]}
+        self.assertEqual(services['s3']['serviceName'], 'Amazon S3')
+        self.assertEqual(services['s3']['lastAuthenticated'], 1000)
+        self.assertEqual(services['ec2']['serviceName'], 'Amazon EC2')
+
+        persist_aa_data(self.app, {ROLE_ARN: [usage('s3', 2000)]})
+        self.assertEqual(len(self.advisors()[ROLE_ARN]), 2)
+
+        from aardvark.model import AWSIAMObject, AdvisorData
+        self.assertEqual(AWSIAMObject.query.get(1).accountNumber, '123456789012')
+
+        # advisor_data was rebuilt with ON DELETE CASCADE.
+        db.session.delete(AWSIAMObject.query.get(1))
+        db.session.commit()
+        self.assertEqual(AdvisorData.query.count(), 0)
+
+    def test_normalize_drops_rows_without_namespace(self):
+        from aardvark.migrations import normalize_advisor_services
+
+        for statement in LEGACY_SCHEMA:
+            db.engine.execute(statement)
+        db.engine.execute("INSERT INTO aws_iam_object (id, arn) VALUES (1, '{}')".format(ROLE_ARN))
+        db.engine.execute('INSERT INTO advisor_data (item_id, "lastAuthenticated", "serviceName", '
+                          '"serviceNamespace", "totalAuthenticatedEntities") '
+                          "VALUES (1, 1000, 'Amazon S3', 's3', 1), (1, 500, NULL, NULL, 1)")
+
+        # On its own, as PostgreSQL runs it: no later table rebuild drops the row.
+        with db.engine.begin() as conn:
+            self.assertTrue(normalize_advisor_services(conn, sqlalchemy.inspect(conn)))
+        self.assertEqual(db.engine.execute('SELECT service_id FROM advisor_data').fetchall(), [(1,)])
+
+    def test_upgrade_removes_duplicates(self):
+        from aardvark.migrations import upgrade
+
+        for statement in LEGACY_SCHEMA:
+            db.engine.execute(statement)
+        db.engine.execute("INSERT INTO aws_iam_object (id, arn) VALUES (1, '{}')".format(ROLE_ARN))
+        db.engine.execute('INSERT INTO advisor_data (item_id, "lastAuthenticated", "serviceName", '
+                          '"serviceNamespace", "totalAuthenticatedEntities") '
+                          "VALUES (1, 1000, 'Amazon S3', 's3', 1), (1, 3000, 'Amazon S3', 's3', 1), "
+                          "(1, 2000, 'Amazon S3', 's3', 1), (1, 0, 'Amazon EC2', 'ec2', 0), "
+                          "(1, 0, 'Amazon EC2', 'ec2', 0)")
+
+        upgrade(db.engine, self.app.logger)
+
+        services = {entry['serviceNamespace']: entry['lastAuthenticated'] for entry in self.advisors()[ROLE_ARN]}
+        self.assertEqual(services, {'s3': 3000, 'ec2': 0})
+        indexes = {index['name']: index for index in sqlalchemy.inspect(db.engine).get_indexes('advisor_data')}
+        self.assertTrue(indexes['ix_advisor_data_item_service']['unique'])
+        self.assertEqual(indexes['ix_advisor_data_service_last']['column_names'],
+                         ['service_id', 'lastAuthenticated', 'item_id'])
+        self.assertEqual(set(indexes), {'ix_advisor_data_item_service', 'ix_advisor_data_service_last'})
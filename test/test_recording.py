@@ -0,0 +1,132 @@
+'''Test cases for recording IAM calls and replaying them.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import unittest
+
+from aardvark import create_app
+from aardvark.updater import AccountToUpdate
+from aardvark.updater.recording import read_recording
+
+ACCOUNT = '123456789012'
+ROLES = ['arn:aws:iam::{}:role/role{}'.format(ACCOUNT, i) for i in range(3)]
+GONE_ROLE = ROLES[2]
+JOB_SECONDS = 0.3
+
+
+class StubIAM(object):
+    '''Answers the IAM calls AccountToUpdate makes: three roles, one deleted before its job is generated.'''
+
+    class NoSuchEntityException(Exception):
+        pass
+
+    def __init__(self, **kwargs):
+        self.exceptions = self
+        self.jobs = {}
+
+    def list_roles(self, Marker=None):
+        # Two pages, to exercise Marker.
+        if Marker is None:
+            return {'Roles': [{'Arn': arn} for arn in ROLES[:2]], 'IsTruncated': True, 'Marker': 'next'}
+        return {'Roles': [{'Arn': arn} for arn in ROLES[2:]], 'IsTruncated': False}
+
+    def list_users(self, **kwargs):
+        return {'Users': [], 'IsTruncated': False}
+
+    def list_policies(self, **kwargs):
+        return {'Policies': [], 'IsTruncated': False}
+
+    def list_groups(self, **kwargs):
+        return {'Groups': [], 'IsTruncated': False}
+
+    def generate_service_last_accessed_details(self, Arn):
+        if Arn == GONE_ROLE:
+            raise self.NoSuchEntityException(Arn)
+        job_id = 'job-{}'.format(Arn)
+        self.jobs[job_id] = (Arn, time.time() + JOB_SECONDS)
+        return {'JobId': job_id}
+
+    def get_service_last_accessed_details(self, JobId, Marker=None):
+        arn, ready_at = self.jobs[JobId]
+        if time.time() < ready_at:
+            return {'JobStatus': 'IN_PROGRESS'}
+        return {'JobStatus': 'COMPLETED', 'IsTruncated': False, 'ServicesLastAccessed': [
+            {'ServiceName': 'Amazon S3', 'ServiceNamespace': 's3', 'TotalAuthenticatedEntities': 1,
+             'LastAuthenticatedEntity': arn,
+             'LastAuthenticated': datetime.datetime(2019, 6, 1, tzinfo=datetime.timezone.utc)},
+            {'ServiceName': 'Amazon EC2', 'ServiceNamespace': 'ec2', 'TotalAuthenticatedEntities': 0}]}
+
+
+class TestRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'iam.jsonl.gz')
+        self.app = create_app(api_docs=False)
+        self.app.logger.setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def collect(self, **config):
+        self.app.config.update(config)
+        start = time.time()
+        ret_code, aa_data = AccountToUpdate(self.app, ACCOUNT, 'Aardvark', ['all']).update_account()
+        self.assertEqual(ret_code, 0)
+        return aa_data, time.time() - start
+
+    def record(self):
+        from aardvark.updater import recording
+
+        aa_data, _ = self.collect(IAM_CLIENT_FACTORY=StubIAM, IAM_RECORD_FILE=self.path)
+        recording.close_recordings()
+        return aa_data
+
+    def test_record(self):
+        self.record()
+        calls = list(read_recording(self.path))
+        self.assertEqual([call['op'] for call in calls[:2]], ['list_roles', 'list_roles'])
+        self.assertEqual(calls[1]['p'], {'Marker': 'next'})
+        self.assertEqual([call['e']['Code'] for call in calls if 'e' in call], ['NoSuchEntity'])
+        details = [call['r'] for call in calls if call.get('r', {}).get('JobStatus') == 'COMPLETED']
+        self.assertEqual(len(details), 2)
+        self.assertEqual(details[0]['ServicesLastAccessed'][0]['LastAuthenticated'],
+                         datetime.datetime(2019, 6, 1, tzinfo=datetime.timezone.utc))
+
+    def test_list_calls_budgeted(self):
+        from unittest import mock
+
+        self.app.config.update(IAM_CLIENT_FACTORY=StubIAM, IAM_API_BUDGET=1000)
+        account = AccountToUpdate(self.app, ACCOUNT, 'Aardvark', ['all'])
+        account.api_budget = mock.Mock()
+        self.assertEqual(sorted(account.enumerate_arns()), sorted(ROLES))
+        # Two pages of roles, then one each of users, policies and groups.
+        self.assertEqual(account.api_budget.acquire.call_count, 5)
+
+    def test_replay(self):
+        recorded = self.record()
+        self.assertEqual(sorted(recorded), ROLES[:2])
+
+        replayed, elapsed = self.collect(IAM_CLIENT_FACTORY=None, IAM_RECORD_FILE=None, IAM_REPLAY_FILE=self.path)
+        self.assertEqual(replayed, recorded)
+        self.assertLess(elapsed, JOB_SECONDS)
+
+    def test_replay_speed(self):
+        recorded = self.record()
+
+        replayed, elapsed = self.collect(IAM_CLIENT_FACTORY=None, IAM_RECORD_FILE=None, IAM_REPLAY_FILE=self.path,
+                                         IAM_REPLAY_SPEED=1)
+        self.assertEqual(replayed, recorded)
+        self.assertGreaterEqual(elapsed, JOB_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+'''Test cases for the compact Access Advisor records built at collection time.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import datetime
+import time
+
+import unittest
+
+from aardvark.updater.records import ServiceUsage
+
+
+class TestServiceUsage(unittest.TestCase):
+
+    def test_from_detail(self):
+        last_auth = datetime.datetime(2020, 5, 1, 12, 0, 0)
+        record = ServiceUsage.from_detail({
+            'ServiceName': 'Amazon S3',
+            'ServiceNamespace': 's3',
+            'LastAuthenticated': last_auth,
+            'LastAuthenticatedEntity': 'arn:aws:iam::123456789012:role/test',
+            'TotalAuthenticatedEntities': 1,
+        })
+
+        self.assertEqual(record.namespace, 's3')
+        self.assertEqual(record.name, 'Amazon S3')
+        self.assertEqual(record.last_authenticated, int(time.mktime(last_auth.timetuple()) * 1000))
+        self.assertEqual(record.last_authenticated_entity, 'arn:aws:iam::123456789012:role/test')
+        self.assertEqual(record.total_authenticated_entities, 1)
+
+    def test_never_accessed(self):
+        record = ServiceUsage.from_detail({
+            'ServiceName': 'Amazon S3',
+            'ServiceNamespace': 's3',
+            'TotalAuthenticatedEntities': 0,
+        })
+
+        self.assertEqual(record.last_authenticated, 0)
+        self.assertIsNone(record.last_authenticated_entity)
+
+    def test_missing_total_stays_none(self):
+        record = ServiceUsage.from_detail({'ServiceName': 'Amazon S3', 'ServiceNamespace': 's3'})
+        self.assertIsNone(record.total_authenticated_entities)
+
+    def test_strings_are_interned(self):
+        first = ServiceUsage.from_detail({'ServiceName': 'Amazon S3', 'ServiceNamespace': ''.join(['s', '3'])})
+        second = ServiceUsage.from_detail({'ServiceName': 'Amazon S3', 'ServiceNamespace': ''.join(['s', '3'])})
+        self.assertIs(first.namespace, second.namespace)
+
+    def test_no_instance_dict(self):
+        record = ServiceUsage('s3', 'Amazon S3', 0, None, 0)
+        self.assertFalse(hasattr(record, '__dict__'))
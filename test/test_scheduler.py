@@ -0,0 +1,138 @@
+'''Test cases for the staleness-priority account scheduler.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+import unittest
+from unittest import mock
+
+from aardvark import create_app, db
+from aardvark.scheduler import CollectorDaemon, StalenessScheduler, longest_first
+
+
+def hours_ago(hours):
+    return datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+
+
+class TestStalenessScheduler(unittest.TestCase):
+
+    def test_stalest_account_first(self):
+        scheduler = StalenessScheduler(default_sla=3600)
+        scheduler.add('111111111111', hours_ago(2))
+        scheduler.add('222222222222', hours_ago(5))
+        scheduler.add('333333333333', None)
+
+        self.assertEqual(scheduler.next(block=False), '333333333333')
+        self.assertEqual(scheduler.next(block=False), '222222222222')
+        self.assertEqual(scheduler.next(block=False), '111111111111')
+        self.assertIsNone(scheduler.next(block=False))
+
+    def test_fresh_accounts_are_not_due(self):
+        scheduler = StalenessScheduler(default_sla=3600)
+        scheduler.add('111111111111', hours_ago(0.5))
+        self.assertIsNone(scheduler.next(block=False))
+
+    def test_per_account_sla(self):
+        scheduler = StalenessScheduler(default_sla=24 * 3600, account_slas={'111111111111': 3600})
+        scheduler.add('111111111111', hours_ago(2))
+        scheduler.add('222222222222', hours_ago(2))
+
+        self.assertEqual(scheduler.next(block=False), '111111111111')
+        self.assertIsNone(scheduler.next(block=False))
+
+    def test_done_reschedules_one_sla_later(self):
+        scheduler = StalenessScheduler(default_sla=3600)
+        scheduler.add('111111111111')
+        account = scheduler.next(block=False)
+        scheduler.done(account)
+
+        self.assertEqual(len(scheduler), 1)
+        self.assertIsNone(scheduler.next(block=False))
+
+    def test_failed_retries_after_delay(self):
+        scheduler = StalenessScheduler(default_sla=3600)
+        scheduler.add('111111111111')
+        scheduler.failed(scheduler.next(block=False), retry_delay=0)
+        self.assertEqual(scheduler.next(block=False), '111111111111')
+
+    def test_remove(self):
+        scheduler = StalenessScheduler(default_sla=3600)
+        scheduler.add('111111111111')
+        scheduler.add('222222222222', hours_ago(2))
+        scheduler.remove('111111111111')
+
+        self.assertEqual(scheduler.accounts(), {'222222222222'})
+        self.assertEqual(scheduler.next(block=False), '222222222222')
+
+
+class TestLongestFirst(unittest.TestCase):
+
+    def test_orders_by_last_duration(self):
+        history = {'a': (10.0, 100), 'b': (100.0, 1000), 'c': (50.0, 500)}
+        ordered, predicted = longest_first(['a', 'b', 'c'], history, 2)
+
+        self.assertEqual(ordered, ['b', 'c', 'a'])
+        self.assertEqual(predicted, 100.0)
+
+    def test_estimates_from_principal_count(self):
+        history = {'a': (10.0, 100), 'b': (None, 1000)}
+        ordered, predicted = longest_first(['a', 'b'], history, 1)
+
+        self.assertEqual(ordered, ['b', 'a'])
+        self.assertEqual(predicted, 110.0)
+
+    def test_unknown_accounts_start_early(self):
+        history = {'a': (10.0, 100), 'b': (30.0, 300)}
+        ordered, _ = longest_first(['a', 'b', 'new'], history, 2)
+        self.assertEqual(ordered[-1], 'a')
+
+    def test_no_history(self):
+        self.assertEqual(longest_first(['a', 'b'], {}, 2), (['a', 'b'], None))
+
+
+class TestCollectorDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app(api_docs=False)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(os.path.join(self.tmpdir, 'test.db'))
+        self.app.config['COLLECT_RETRY_DELAY'] = 0
+        self.app.logger.setLevel(logging.CRITICAL)
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.get_engine(self.app).dispose()
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('aardvark.scheduler.AccountToUpdate')
+    def test_persist_failure_is_retried(self, account_to_update):
+        account_to_update.return_value.update_account.return_value = (0, {'arn': []})
+        persisted = []
+
+        def persist(app, aa_data):
+            persisted.append(aa_data)
+            if len(persisted) == 1:
+                raise RuntimeError('database is locked')
+
+        daemon = CollectorDaemon(self.app, lambda: ['a'], persist, 'Aardvark', ['arn'], 1, daemon=False)
+        daemon.run()
+        self.assertEqual(len(persisted), 2)
+        # Rescheduled one SLA after the successful attempt rather than left in flight.
+        self.assertIsNone(daemon.scheduler.next(block=False))
+        self.assertEqual(daemon.scheduler.accounts(), {'a'})
+
+    def test_account_refresh_failure(self):
+        def resolve_accounts():
+            raise RuntimeError('SWAG unavailable')
+
+        daemon = CollectorDaemon(self.app, resolve_accounts, None, 'Aardvark', ['arn'], 1, daemon=False)
+        daemon.run()
+        self.assertEqual(daemon.scheduler.accounts(), set())
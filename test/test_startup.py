@@ -0,0 +1,54 @@
+'''Start-up cost of the aardvark command.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import unittest
+
+# Modules only the commands that use them should import.
+HEAVY_MODULES = ('boto3', 'cloudaux', 'swag_client', 'flasgger', 'better_exceptions', 'gunicorn')
+
+# Seconds to import aardvark.manage and build the CLI app, best of STARTUP_RUNS.
+# Before the heavy imports were deferred this took about 0.8s on a developer
+# laptop, after about 0.3s. STARTUP_BUDGET_SECONDS overrides it on slow machines.
+STARTUP_BUDGET = float(os.environ.get('STARTUP_BUDGET_SECONDS', 0.6))
+STARTUP_RUNS = 3
+
+STARTUP = '''
+import json, sys
+from aardvark import manage
+manage.manager()
+print(json.dumps(sorted(m for m in {} if m in sys.modules)))
+'''.format(HEAVY_MODULES)
+
+
+class TestStartup(unittest.TestCase):
+
+    def start(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            output = subprocess.check_output([sys.executable, '-c', STARTUP], cwd=workdir)
+            return time.time() - start, json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        finally:
+            os.rmdir(workdir)
+
+    def test_heavy_modules_are_deferred(self):
+        _, imported = self.start()
+        self.assertEqual(imported, [])
+
+    def test_startup_budget(self):
+        best = min(self.start()[0] for _ in range(STARTUP_RUNS))
+        self.assertLess(best, STARTUP_BUDGET,
+                        'aardvark took {:.2f}s to start, over the {:.2f}s budget'.format(best, STARTUP_BUDGET))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+'''Test cases for resolving account names through the local SWAG snapshot.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import unittest
+
+from aardvark import create_app, swag_snapshot
+from aardvark.manage import _prep_accounts
+
+
+def swag_account(account_id, name, aliases=()):
+    return dict(id=account_id, name=name, aliases=list(aliases), schemaVersion='2', environment='prod',
+                provider='aws', owner='security', contacts=[], description='', type='service', status=[],
+                services=[])
+
+
+class TestSWAGSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.swag_file = os.path.join(self.tmpdir, 'accounts.json')
+        self.snapshot_file = os.path.join(self.tmpdir, 'snapshot.json')
+        self.write_swag([swag_account('111111111111', 'prod', ['Production']),
+                         swag_account('222222222222', 'test')])
+
+        self.app = create_app(api_docs=False)
+        self.app.logger.setLevel(logging.CRITICAL)
+        # cache_expires 0 turns off swag_client's own in-process cache.
+        self.app.config.update(SWAG_OPTS={'swag.type': 'file', 'swag.data_dir': self.tmpdir, 'swag.cache_expires': 0},
+                               SWAG_SNAPSHOT_FILE=self.snapshot_file)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def write_swag(self, accounts):
+        with open(self.swag_file, 'w') as f:
+            json.dump(accounts, f)
+
+    def test_resolve(self):
+        self.assertEqual(sorted(_prep_accounts('all')), ['111111111111', '222222222222'])
+        self.assertEqual(sorted(_prep_accounts('production,test,333333333333,missing')),
+                         ['111111111111', '222222222222', '333333333333'])
+        with open(self.snapshot_file) as f:
+            self.assertEqual(json.load(f)['index'], {'prod': '111111111111', 'production': '111111111111',
+                                                     'test': '222222222222'})
+
+    def test_ttl(self):
+        _prep_accounts('prod')
+        self.write_swag([swag_account('444444444444', 'prod')])
+        self.assertEqual(_prep_accounts('prod'), ['111111111111'])
+
+        self.app.config['SWAG_SNAPSHOT_TTL'] = 0
+        self.assertEqual(_prep_accounts('prod'), ['444444444444'])
+
+    def test_unchanged_backend(self):
+        _prep_accounts('prod')
+        self.app.config['SWAG_SNAPSHOT_TTL'] = 0
+        fetched_at = swag_snapshot.read(self.snapshot_file).fetched_at
+        with self.assertLogs(self.app.logger, 'DEBUG') as logs:
+            self.assertEqual(_prep_accounts('prod'), ['111111111111'])
+        self.assertTrue(any('SWAG data unchanged' in line for line in logs.output))
+        self.assertGreater(swag_snapshot.read(self.snapshot_file).fetched_at, fetched_at)
+
+    def test_backend_unavailable(self):
+        _prep_accounts('prod')
+        os.remove(self.swag_file)
+        self.app.config['SWAG_SNAPSHOT_TTL'] = 0
+        self.assertEqual(_prep_accounts('prod'), ['111111111111'])
+
+        self.app.config['SWAG_SNAPSHOT_MAX_STALE'] = 0
+        self.assertEqual(_prep_accounts('prod'), [])
+
+    def test_settings_changed(self):
+        _prep_accounts('prod')
+        self.app.config['SWAG_FILTER'] = "[?name=='test']"
+        self.assertEqual(_prep_accounts('all'), ['222222222222'])
+
+    def test_without_snapshot_file(self):
+        self.app.config['SWAG_SNAPSHOT_FILE'] = None
+        self.assertEqual(_prep_accounts('test'), ['222222222222'])
+        self.assertFalse(os.path.exists(self.snapshot_file))
+
+    def test_default_file(self):
+        del self.app.config['SWAG_SNAPSHOT_FILE']
+        self.app.instance_path = os.path.join(self.tmpdir, 'instance')
+        self.assertEqual(_prep_accounts('test'), ['222222222222'])
+        self.assertEqual(swag_snapshot.read(os.path.join(self.app.instance_path, 'swag_snapshot.json')).accounts,
+                         ['111111111111', '222222222222'])
+
+
+if __name__ == '__main__':
+    unittest.main()
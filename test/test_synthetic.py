@@ -0,0 +1,83 @@
+'''Test cases for the synthetic dataset generator and the seed command.'''
+
+#adding for py3 support
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import unittest
+from unittest.mock import ANY
+
+from aardvark import create_app, db, synthetic
+from aardvark.manage import seed
+from aardvark.model import AccountCollection, AdvisorData, AWSIAMObject
+
+
+def flatten(batches):
+    return {arn: [(r.namespace, r.last_authenticated, r.last_authenticated_entity) for r in records]
+            for _, batch in batches for arn, records in batch.items()}
+
+
+class TestGenerate(unittest.TestCase):
+
+    def test_shape(self):
+        batches = list(synthetic.generate(2, 5, 45, batch_size=2, now=1500000000))
+        self.assertEqual([(account, len(batch)) for account, batch in batches],
+                         [('100000000000', 2), ('100000000000', 2), ('100000000000', 1),
+                          ('100000000001', 2), ('100000000001', 2), ('100000000001', 1)])
+        records = batches[0][1][next(iter(batches[0][1]))]
+        self.assertEqual([r.namespace for r in records][:3], ['s3', 'ec2', 'iam'])
+        self.assertEqual(records[-1].namespace, 'svc45')
+        # The top-ranked namespace is used by every principal.
+        self.assertTrue(all(batch[arn][0].last_authenticated > 0 for _, batch in batches for arn in batch))
+
+    def test_deterministic(self):
+        first = flatten(synthetic.generate(2, 20, 10, seed=3, now=1500000000))
+        self.assertEqual(flatten(synthetic.generate(2, 20, 10, seed=3, batch_size=7, now=1500000000)), first)
+        self.assertNotEqual(flatten(synthetic.generate(2, 20, 10, seed=4, now=1500000000)), first)
+
+    def test_skew(self):
+        def used(skew):
+            usage = flatten(synthetic.generate(1, 200, 20, skew=skew))
+            return sum(1 for records in usage.values() for _, last, _ in records if last)
+
+        self.assertEqual(used(0), 200 * 20)
+        self.assertGreater(used(0.5), used(2))
+
+
+class TestSeed(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app(api_docs=False)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(os.path.join(self.tmpdir, 'test.db'))
+        self.app.logger.setLevel(logging.CRITICAL)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        self.ctx.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_seed(self):
+        for _ in range(2):
+            seed(accounts=2, principals=30, namespaces=8, skew=1.0, random_seed=0, batch_size=20)
+            self.assertEqual(AWSIAMObject.query.count(), 60)
+            self.assertEqual(AdvisorData.query.count(), 60 * 8)
+        self.assertEqual(AccountCollection.history(), {'100000000000': (ANY, 30),
+                                                       '100000000001': (ANY, 30)})
+
+        arn = AWSIAMObject.query.first().arn
+        response = self.app.test_client().get('/api/1/advisors', query_string={'arn': arn})
+        self.assertEqual(len(json.loads(response.data)[arn]), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()